@@ -353,7 +353,7 @@ static PyObject *PyLdbControl_FromControl(struct ldb_control *control)
 static PyObject *PyLdbResult_FromResult(struct ldb_result *result)
 {
 	PyLdbResultObject *ret;
-	PyObject *list, *controls, *referals;
+	PyObject *controls, *referals;
 	Py_ssize_t i;
 
 	if (result == NULL) {
@@ -366,26 +366,39 @@ static PyObject *PyLdbResult_FromResult(struct ldb_result *result)
 		return NULL;
 	}
 
-	list = PyList_New(result->count);
-	if (list == NULL) {
-		PyErr_NoMemory();
+	ret->mem_ctx = talloc_new(NULL);
+	if (ret->mem_ctx == NULL) {
 		Py_DECREF(ret);
+		PyErr_NoMemory();
 		return NULL;
 	}
 
-	for (i = 0; i < result->count; i++) {
-		PyList_SetItem(list, i, PyLdbMessage_FromMessage(result->msgs[i]));
-	}
-
-	ret->mem_ctx = talloc_new(NULL);
-	if (ret->mem_ctx == NULL) {
-		Py_DECREF(list);
+	/*
+	 * Rather than making a Message object for each message now, we
+	 * hold a reference to each one and wrap it when it is used (see
+	 * py_ldb_result_get_msg()).
+	 */
+	ret->count = result->count;
+	ret->lazy_msgs = talloc_array(ret->mem_ctx, struct ldb_message *,
+				      result->count);
+	ret->lazy_cache = talloc_zero_array(ret->mem_ctx, PyObject *,
+					    result->count);
+	if (ret->lazy_msgs == NULL || ret->lazy_cache == NULL) {
 		Py_DECREF(ret);
 		PyErr_NoMemory();
 		return NULL;
 	}
-
-	ret->msgs = list;
+	for (i = 0; i < result->count; i++) {
+		ret->lazy_msgs[i] = talloc_reference(ret->mem_ctx,
+						     result->msgs[i]);
+		if (ret->lazy_msgs[i] == NULL) {
+			/* dealloc only looks at the first ret->count */
+			ret->count = i;
+			Py_DECREF(ret);
+			PyErr_NoMemory();
+			return NULL;
+		}
+	}
 
 	if (result->controls) {
 		i = 0;
@@ -1487,6 +1500,216 @@ static PyObject *py_ldb_add(PyLdbObject *self, PyObject *args, PyObject *kwargs)
 	Py_RETURN_NONE;
 }
 
+/*
+ * Add or modify many messages from an iterable, committing a
+ * transaction after each batch of them. Rather than raising an
+ * exception, failures of individual messages are returned in a list of
+ * (index, errno, errstring) tuples, unless stop_on_error is set, in
+ * which case the current batch is cancelled and LdbError is raised.
+ */
+static PyObject *py_ldb_write_many(PyLdbObject *self, PyObject *args,
+				   PyObject *kwargs,
+				   enum ldb_request_type operation)
+{
+	PyObject *py_msgs;
+	PyObject *py_controls = Py_None;
+	PyObject *iter = NULL;
+	PyObject *item = NULL;
+	PyObject *errors = NULL;
+	struct ldb_context *ldb_ctx;
+	struct ldb_control **parsed_controls;
+	TALLOC_CTX *mem_ctx;
+	unsigned int batch = 100;
+	unsigned int in_batch = 0;
+	Py_ssize_t index = 0;
+	int stop_on_error = 0;
+	int ret;
+	const char * const kwnames[] = { "messages", "controls", "batch",
+					 "stop_on_error", NULL };
+
+	if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|OIp",
+					 discard_const_p(char *, kwnames),
+					 &py_msgs, &py_controls, &batch,
+					 &stop_on_error))
+		return NULL;
+
+	if (batch == 0) {
+		PyErr_SetString(PyExc_ValueError, "batch must be at least 1");
+		return NULL;
+	}
+
+	mem_ctx = talloc_new(NULL);
+	if (mem_ctx == NULL) {
+		PyErr_NoMemory();
+		return NULL;
+	}
+	ldb_ctx = pyldb_Ldb_AS_LDBCONTEXT(self);
+
+	if (py_controls == Py_None) {
+		parsed_controls = NULL;
+	} else {
+		const char **controls = PyList_AsStrList(mem_ctx, py_controls, "controls");
+		if (controls == NULL) {
+			talloc_free(mem_ctx);
+			return NULL;
+		}
+		parsed_controls = ldb_parse_control_strings(ldb_ctx, mem_ctx, controls);
+		talloc_free(controls);
+	}
+
+	iter = PyObject_GetIter(py_msgs);
+	if (iter == NULL) {
+		talloc_free(mem_ctx);
+		return NULL;
+	}
+
+	errors = PyList_New(0);
+	if (errors == NULL) {
+		goto failed;
+	}
+
+	while ((item = PyIter_Next(iter)) != NULL) {
+		TALLOC_CTX *tmp_ctx;
+		struct ldb_message *msg = NULL;
+		struct ldb_request *req = NULL;
+
+		if (in_batch == 0) {
+			ret = ldb_transaction_start(ldb_ctx);
+			if (ret != LDB_SUCCESS) {
+				PyErr_SetLdbError(PyExc_LdbError, ret, ldb_ctx);
+				goto failed;
+			}
+		}
+		in_batch++;
+
+		tmp_ctx = talloc_new(mem_ctx);
+		if (tmp_ctx == NULL) {
+			PyErr_NoMemory();
+			goto failed;
+		}
+
+		if (PyLdbMessage_Check(item)) {
+			msg = pyldb_Message_AsMessage(item);
+		} else if (operation == LDB_ADD && PyDict_Check(item)) {
+			msg = PyDict_AsMessage(tmp_ctx, item, ldb_ctx,
+					       LDB_FLAG_MOD_ADD);
+		} else if (operation == LDB_ADD) {
+			PyErr_SetString(PyExc_TypeError,
+					"Dictionary or LdbMessage object expected!");
+		} else {
+			PyErr_SetString(PyExc_TypeError, "Expected Ldb Message");
+		}
+
+		if (msg == NULL) {
+			/* we should have a PyErr already set */
+			talloc_free(tmp_ctx);
+			goto failed;
+		}
+
+		ldb_reset_err_string(ldb_ctx);
+
+		ret = ldb_msg_sanity_check(ldb_ctx, msg);
+		if (ret == LDB_SUCCESS) {
+			if (operation == LDB_ADD) {
+				ret = ldb_build_add_req(&req, ldb_ctx, tmp_ctx,
+							msg, parsed_controls,
+							NULL,
+							ldb_op_default_callback,
+							NULL);
+			} else {
+				ret = ldb_build_mod_req(&req, ldb_ctx, tmp_ctx,
+							msg, parsed_controls,
+							NULL,
+							ldb_op_default_callback,
+							NULL);
+			}
+		}
+		if (ret == LDB_SUCCESS) {
+			ret = ldb_request(ldb_ctx, req);
+			if (ret == LDB_SUCCESS) {
+				ret = ldb_wait(req->handle, LDB_WAIT_ALL);
+			}
+		}
+
+		if (ret != LDB_SUCCESS) {
+			const char *errstr = ldb_errstring(ldb_ctx);
+			PyObject *py_error = NULL;
+
+			if (stop_on_error) {
+				PyErr_SetLdbError(PyExc_LdbError, ret, ldb_ctx);
+				talloc_free(tmp_ctx);
+				goto failed;
+			}
+
+			if (errstr == NULL) {
+				errstr = ldb_strerror(ret);
+			}
+			py_error = Py_BuildValue("(nis)", index, ret, errstr);
+			if (py_error == NULL ||
+			    PyList_Append(errors, py_error) != 0) {
+				Py_XDECREF(py_error);
+				talloc_free(tmp_ctx);
+				goto failed;
+			}
+			Py_DECREF(py_error);
+		}
+
+		talloc_free(tmp_ctx);
+		Py_CLEAR(item);
+		index++;
+
+		if (in_batch == batch) {
+			/* a failed commit cancels the transaction itself */
+			in_batch = 0;
+			ret = ldb_transaction_commit(ldb_ctx);
+			if (ret != LDB_SUCCESS) {
+				PyErr_SetLdbError(PyExc_LdbError, ret, ldb_ctx);
+				goto failed;
+			}
+		}
+	}
+
+	if (PyErr_Occurred()) {
+		/* the iterator raised an exception */
+		goto failed;
+	}
+
+	if (in_batch > 0) {
+		in_batch = 0;
+		ret = ldb_transaction_commit(ldb_ctx);
+		if (ret != LDB_SUCCESS) {
+			PyErr_SetLdbError(PyExc_LdbError, ret, ldb_ctx);
+			goto failed;
+		}
+	}
+
+	Py_DECREF(iter);
+	talloc_free(mem_ctx);
+	return errors;
+
+failed:
+	if (in_batch > 0) {
+		ldb_transaction_cancel(ldb_ctx);
+	}
+	Py_XDECREF(item);
+	Py_XDECREF(errors);
+	Py_DECREF(iter);
+	talloc_free(mem_ctx);
+	return NULL;
+}
+
+static PyObject *py_ldb_add_many(PyLdbObject *self, PyObject *args,
+				 PyObject *kwargs)
+{
+	return py_ldb_write_many(self, args, kwargs, LDB_ADD);
+}
+
+static PyObject *py_ldb_modify_many(PyLdbObject *self, PyObject *args,
+				    PyObject *kwargs)
+{
+	return py_ldb_write_many(self, args, kwargs, LDB_MODIFY);
+}
+
 static PyObject *py_ldb_delete(PyLdbObject *self, PyObject *args, PyObject *kwargs)
 {
 	PyObject *py_dn;
@@ -2349,6 +2572,16 @@ static PyMethodDef py_ldb_methods[] = {
 		METH_VARARGS|METH_KEYWORDS,
 		"S.add(message, controls=None) -> None\n"
 		"Add an entry." },
+	{ "add_many", PY_DISCARD_FUNC_SIG(PyCFunction, py_ldb_add_many),
+		METH_VARARGS|METH_KEYWORDS,
+		"S.add_many(messages, controls=None, batch=100, stop_on_error=False) -> list\n"
+		"Add entries from an iterable, committing a transaction after each batch.\n"
+		"Returns a list of (index, errno, errstring) for the entries that failed." },
+	{ "modify_many", PY_DISCARD_FUNC_SIG(PyCFunction, py_ldb_modify_many),
+		METH_VARARGS|METH_KEYWORDS,
+		"S.modify_many(messages, controls=None, batch=100, stop_on_error=False) -> list\n"
+		"Modify entries from an iterable, committing a transaction after each batch.\n"
+		"Returns a list of (index, errno, errstring) for the entries that failed." },
 	{ "delete", PY_DISCARD_FUNC_SIG(PyCFunction, py_ldb_delete),
 		METH_VARARGS|METH_KEYWORDS,
 		"S.delete(dn, controls=None) -> None\n"
@@ -2525,15 +2758,76 @@ static PyTypeObject PyLdb = {
 
 static void py_ldb_result_dealloc(PyLdbResultObject *self)
 {
+	Py_ssize_t i;
+
+	if (self->lazy_cache != NULL) {
+		for (i = 0; i < self->count; i++) {
+			Py_XDECREF(self->lazy_cache[i]);
+		}
+	}
 	talloc_free(self->mem_ctx);
-	Py_DECREF(self->msgs);
-	Py_DECREF(self->referals);
-	Py_DECREF(self->controls);
+	Py_XDECREF(self->msgs);
+	Py_XDECREF(self->referals);
+	Py_XDECREF(self->controls);
 	Py_TYPE(self)->tp_free(self);
 }
 
+/*
+ * Return a new reference to the Message object for message idx,
+ * making it if this is the first time it has been asked for.
+ */
+static PyObject *py_ldb_result_get_msg(PyLdbResultObject *self, Py_ssize_t idx)
+{
+	PyObject *msg = self->lazy_cache[idx];
+
+	if (msg == NULL) {
+		msg = PyLdbMessage_FromMessage(self->lazy_msgs[idx]);
+		if (msg == NULL) {
+			return NULL;
+		}
+		self->lazy_cache[idx] = msg;
+	}
+	Py_INCREF(msg);
+	return msg;
+}
+
+/*
+ * Make the msgs list, after which it is used for everything, just as
+ * it would have been if it had been made in the first place.
+ */
+static int py_ldb_result_materialize(PyLdbResultObject *self)
+{
+	PyObject *list;
+	Py_ssize_t i;
+
+	if (self->msgs != NULL) {
+		return 0;
+	}
+
+	list = PyList_New(self->count);
+	if (list == NULL) {
+		return -1;
+	}
+	for (i = 0; i < self->count; i++) {
+		PyObject *msg = py_ldb_result_get_msg(self, i);
+		if (msg == NULL) {
+			Py_DECREF(list);
+			return -1;
+		}
+		PyList_SET_ITEM(list, i, msg);
+	}
+	for (i = 0; i < self->count; i++) {
+		Py_CLEAR(self->lazy_cache[i]);
+	}
+	self->msgs = list;
+	return 0;
+}
+
 static PyObject *py_ldb_result_get_msgs(PyLdbResultObject *self, void *closure)
 {
+	if (py_ldb_result_materialize(self) != 0) {
+		return NULL;
+	}
 	Py_INCREF(self->msgs);
 	return self->msgs;
 }
@@ -2554,10 +2848,10 @@ static PyObject *py_ldb_result_get_count(PyLdbResultObject *self, void *closure)
 {
 	Py_ssize_t size;
 	if (self->msgs == NULL) {
-		PyErr_SetString(PyExc_AttributeError, "Count attribute is meaningless in this context");
-		return NULL;
+		size = self->count;
+	} else {
+		size = PyList_Size(self->msgs);
 	}
-	size = PyList_Size(self->msgs);
 	return PyLong_FromLong(size);
 }
 
@@ -2583,19 +2877,88 @@ static PyGetSetDef py_ldb_result_getset[] = {
 
 static PyObject *py_ldb_result_iter(PyLdbResultObject *self)
 {
-	return PyObject_GetIter(self->msgs);
+	if (self->msgs != NULL) {
+		return PyObject_GetIter(self->msgs);
+	}
+	/* this walks the result with py_ldb_result_find() */
+	return PySeqIter_New((PyObject *)self);
 }
 
 static Py_ssize_t py_ldb_result_len(PyLdbResultObject *self)
 {
+	if (self->msgs == NULL) {
+		return self->count;
+	}
 	return PySequence_Size(self->msgs);
 }
 
 static PyObject *py_ldb_result_find(PyLdbResultObject *self, Py_ssize_t idx)
 {
-	return PySequence_GetItem(self->msgs, idx);
+	if (self->msgs != NULL) {
+		return PySequence_GetItem(self->msgs, idx);
+	}
+	if (idx < 0 || idx >= self->count) {
+		PyErr_SetString(PyExc_IndexError, "list index out of range");
+		return NULL;
+	}
+	return py_ldb_result_get_msg(self, idx);
 }
 
+static PyObject *py_ldb_result_dns(PyLdbResultObject *self,
+		PyObject *Py_UNUSED(ignored))
+{
+	PyObject *list;
+	Py_ssize_t i, count;
+
+	count = py_ldb_result_len(self);
+	if (count < 0) {
+		return NULL;
+	}
+
+	list = PyList_New(count);
+	if (list == NULL) {
+		return NULL;
+	}
+
+	for (i = 0; i < count; i++) {
+		struct ldb_message *msg = NULL;
+		PyObject *py_dn = NULL;
+
+		if (self->msgs == NULL) {
+			msg = self->lazy_msgs[i];
+		} else {
+			PyObject *item = PyList_GetItem(self->msgs, i);
+			if (item == NULL) {
+				Py_DECREF(list);
+				return NULL;
+			}
+			if (!PyLdbMessage_Check(item)) {
+				PyErr_SetString(PyExc_TypeError,
+						"Expected Ldb Message");
+				Py_DECREF(list);
+				return NULL;
+			}
+			msg = pyldb_Message_AsMessage(item);
+		}
+
+		py_dn = pyldb_Dn_FromDn(msg->dn);
+		if (py_dn == NULL) {
+			Py_DECREF(list);
+			return NULL;
+		}
+		PyList_SET_ITEM(list, i, py_dn);
+	}
+
+	return list;
+}
+
+static PyMethodDef py_ldb_result_methods[] = {
+	{ "dns", (PyCFunction)py_ldb_result_dns, METH_NOARGS,
+		"S.dns() -> list\n"
+		"The DNs of the messages, without making Message objects." },
+	{0},
+};
+
 static PySequenceMethods py_ldb_result_seq = {
 	.sq_length = (lenfunc)py_ldb_result_len,
 	.sq_item = (ssizeargfunc)py_ldb_result_find,
@@ -2613,6 +2976,7 @@ static PyTypeObject PyLdbResult = {
 	.tp_dealloc = (destructor)py_ldb_result_dealloc,
 	.tp_iter = (getiterfunc)py_ldb_result_iter,
 	.tp_getset = py_ldb_result_getset,
+	.tp_methods = py_ldb_result_methods,
 	.tp_getattro = PyObject_GenericGetAttr,
 	.tp_basicsize = sizeof(PyLdbResultObject),
 	.tp_as_sequence = &py_ldb_result_seq,
@@ -3112,8 +3476,62 @@ static PyObject *py_ldb_msg_element_set_flags(PyLdbMessageElementObject *self, P
 	Py_RETURN_NONE;
 }
 
+static PyObject *PyLdbMessageElement_FromMessageElement(struct ldb_message_element *el, TALLOC_CTX *mem_ctx);
+
+/*
+ * Return a read-only memoryview of one value, without copying it. The
+ * view is exported by a new single-valued element that shares the
+ * value's data and holds a reference to this element's memory, so the
+ * data lives as long as the view does.
+ */
+static PyObject *py_ldb_msg_element_view(PyLdbMessageElementObject *self, PyObject *args)
+{
+	unsigned int i;
+	struct ldb_message_element *el = pyldb_MessageElement_AsMessageElement(self);
+	struct ldb_message_element *single = NULL;
+	PyObject *py_single = NULL;
+	PyObject *ret = NULL;
+
+	if (!PyArg_ParseTuple(args, "I", &i))
+		return NULL;
+	if (i >= el->num_values) {
+		PyErr_SetString(PyExc_IndexError, "Out of range");
+		return NULL;
+	}
+
+	single = talloc_zero(NULL, struct ldb_message_element);
+	if (single == NULL) {
+		PyErr_NoMemory();
+		return NULL;
+	}
+	single->values = talloc(single, struct ldb_val);
+	if (single->values == NULL) {
+		talloc_free(single);
+		PyErr_NoMemory();
+		return NULL;
+	}
+	single->flags = el->flags;
+	single->name = el->name;
+	single->num_values = 1;
+	single->values[0] = el->values[i];
+
+	py_single = PyLdbMessageElement_FromMessageElement(single, self->mem_ctx);
+	if (py_single == NULL) {
+		talloc_free(single);
+		return NULL;
+	}
+	talloc_steal(((PyLdbMessageElementObject *)py_single)->mem_ctx, single);
+
+	ret = PyMemoryView_FromObject(py_single);
+	Py_DECREF(py_single);
+	return ret;
+}
+
 static PyMethodDef py_ldb_msg_element_methods[] = {
 	{ "get", (PyCFunction)py_ldb_msg_element_get, METH_VARARGS, NULL },
+	{ "view", (PyCFunction)py_ldb_msg_element_view, METH_VARARGS,
+		"S.view(i) -> memoryview\n"
+		"Read-only view of value i, without copying it." },
 	{ "set_flags", (PyCFunction)py_ldb_msg_element_set_flags, METH_VARARGS, NULL },
 	{ "flags", (PyCFunction)py_ldb_msg_element_flags, METH_NOARGS, NULL },
 	{0},
@@ -3139,6 +3557,33 @@ static PySequenceMethods py_ldb_msg_element_seq = {
 	.sq_item = (ssizeargfunc)py_ldb_msg_element_find,
 };
 
+/*
+ * A single-valued element exports its value through the buffer
+ * protocol, so memoryview(el) and ndr_unpack(cls, el) don't need a
+ * copy. Multi-valued elements should use el.view(i).
+ */
+static int py_ldb_msg_element_getbuffer(PyLdbMessageElementObject *self,
+					Py_buffer *view, int flags)
+{
+	struct ldb_message_element *el = pyldb_MessageElement_AsMessageElement(self);
+
+	if (el->num_values != 1) {
+		PyErr_Format(PyExc_BufferError,
+			     "MessageElement has %u values, use view(i)",
+			     el->num_values);
+		view->obj = NULL;
+		return -1;
+	}
+
+	return PyBuffer_FillInfo(view, (PyObject *)self,
+				 el->values[0].data, el->values[0].length,
+				 1, flags);
+}
+
+static PyBufferProcs py_ldb_msg_element_buffer = {
+	.bf_getbuffer = (getbufferproc)py_ldb_msg_element_getbuffer,
+};
+
 static PyObject *py_ldb_msg_element_richcmp(PyObject *self, PyObject *other, int op)
 {
 	int ret;
@@ -3356,6 +3801,7 @@ static PyTypeObject PyLdbMessageElement = {
 	.tp_richcompare = (richcmpfunc)py_ldb_msg_element_richcmp,
 	.tp_iter = (getiterfunc)py_ldb_msg_element_iter,
 	.tp_as_sequence = &py_ldb_msg_element_seq,
+	.tp_as_buffer = &py_ldb_msg_element_buffer,
 	.tp_new = py_ldb_msg_element_new,
 	.tp_flags = Py_TPFLAGS_DEFAULT,
 	.tp_doc = "An element of a Message",
@@ -89,12 +89,21 @@ typedef struct {
 } PyLdbTreeObject;
 #define pyldb_Tree_AsTree(pyobj) ((PyLdbTreeObject *)pyobj)->tree
 
+/*
+ * The messages of a result are only wrapped as Python objects when
+ * they are used: msgs stays NULL until the list is asked for, and
+ * until then lazy_msgs and lazy_cache hold the count messages and
+ * any Message objects made for them.
+ */
 typedef struct {
 	PyObject_HEAD
 	TALLOC_CTX *mem_ctx;
 	PyObject *msgs;
 	PyObject *referals;
 	PyObject *controls;
+	struct ldb_message **lazy_msgs;
+	PyObject **lazy_cache;
+	Py_ssize_t count;
 } PyLdbResultObject;
 
 typedef struct {
@@ -260,6 +260,54 @@ class SimpleLdb(LdbBaseTest):
         finally:
             l.delete(ldb.Dn(l, "dc=foo4"))
 
+    def test_search_view(self):
+        l = ldb.Ldb(self.url(), flags=self.flags())
+        l.add({"dn": "dc=view",
+               "blob": b"\x00\x01\x02" * 100,
+               "objectUUID": b"0123456789abcdef"})
+        try:
+            res = l.search(ldb.Dn(l, "dc=view"), scope=ldb.SCOPE_BASE,
+                           attrs=["blob"])
+            v = res[0]["blob"].view(0)
+            # the view keeps the result's memory alive
+            del res
+            self.assertEqual(b"\x00\x01\x02" * 100, v.tobytes())
+        finally:
+            l.delete(ldb.Dn(l, "dc=view"))
+
+    def test_search_lazy(self):
+        l = ldb.Ldb(self.url(), flags=self.flags())
+        for i in range(3):
+            l.add({"dn": "dc=lazy%d" % i,
+                   "dc": "lazy%d" % i,
+                   "objectUUID": b"0123456789abcde%d" % i})
+        try:
+            res = l.search(expression="(dc=lazy*)")
+            self.assertEqual(3, len(res))
+            self.assertEqual(3, res.count)
+            dns = sorted(str(dn) for dn in res.dns())
+            self.assertEqual(["dc=lazy0", "dc=lazy1", "dc=lazy2"], dns)
+            self.assertIs(res[0], res[0])
+            self.assertEqual(str(res[-1].dn), str(res[2].dn))
+            self.assertRaises(IndexError, lambda: res[3])
+            self.assertEqual(set(dns), set(str(m.dn) for m in res))
+
+            # after .msgs is used, it is the same list every time
+            msgs = res.msgs
+            self.assertIs(msgs, res.msgs)
+            msgs.pop()
+            self.assertEqual(2, len(res))
+            self.assertEqual(2, len(res.dns()))
+
+            # messages outlive their result
+            msg = l.search(expression="(dc=lazy1)")[0]
+            self.assertEqual("dc=lazy1", str(msg.dn))
+            dn = l.search(expression="(dc=lazy2)").dns()[0]
+            self.assertEqual("dc=lazy2", str(dn))
+        finally:
+            for i in range(3):
+                l.delete(ldb.Dn(l, "dc=lazy%d" % i))
+
     def test_search_iterator(self):
         l = ldb.Ldb(self.url(), flags=self.flags())
         s = l.search_iterator()
@@ -2282,6 +2330,77 @@ class AddModifyTests(LdbBaseTest):
                     "objectUUID": b"0123456789abcde3"})
 
 
+    def test_add_many(self):
+        msgs = []
+        for i in range(7):
+            msgs.append({"dn": "OU=MANY%d,DC=SAMBA,DC=ORG" % i,
+                         "description": b"many",
+                         "objectUUID": b"0123456789abc%03d" % i})
+        # a duplicate and a bad DN
+        msgs.insert(3, dict(msgs[1]))
+        msgs.insert(5, {"dn": "BAD,DC=SAMBA,DC=ORG",
+                        "objectUUID": b"0123456789abcbad"})
+
+        errors = self.l.add_many(iter(msgs), batch=3)
+        self.assertEqual([(i, e) for i, e, s in errors],
+                         [(3, ldb.ERR_ENTRY_ALREADY_EXISTS),
+                          (5, ldb.ERR_INVALID_DN_SYNTAX)])
+
+        res = self.l.search(base="DC=SAMBA,DC=ORG",
+                            scope=ldb.SCOPE_ONELEVEL,
+                            expression="(description=many)")
+        self.assertEqual(len(res), 7)
+
+    def test_add_many_stop_on_error(self):
+        msgs = []
+        for i in range(5):
+            msgs.append({"dn": "OU=MANY%d,DC=SAMBA,DC=ORG" % i,
+                         "description": b"many",
+                         "objectUUID": b"0123456789abc%03d" % i})
+        msgs.insert(3, dict(msgs[0]))
+        try:
+            self.l.add_many(msgs, batch=2, stop_on_error=True)
+            self.fail("Should have failed adding duplicate entry")
+        except ldb.LdbError as err:
+            enum = err.args[0]
+            self.assertEqual(enum, ldb.ERR_ENTRY_ALREADY_EXISTS)
+
+        # the first batch was committed, the second cancelled
+        res = self.l.search(base="DC=SAMBA,DC=ORG",
+                            scope=ldb.SCOPE_ONELEVEL,
+                            expression="(description=many)")
+        self.assertEqual(sorted(str(m.dn) for m in res),
+                         ["OU=MANY0,DC=SAMBA,DC=ORG",
+                          "OU=MANY1,DC=SAMBA,DC=ORG"])
+
+        self.assertRaises(ValueError, self.l.add_many, msgs, batch=0)
+        self.assertRaises(TypeError, self.l.add_many, [1])
+
+    def test_modify_many(self):
+        for i in range(4):
+            self.l.add({"dn": "OU=MANY%d,DC=SAMBA,DC=ORG" % i,
+                        "name": b"many",
+                        "objectUUID": b"0123456789abc%03d" % i})
+
+        msgs = []
+        for i in range(5):
+            m = ldb.Message(ldb.Dn(self.l, "OU=MANY%d,DC=SAMBA,DC=ORG" % i))
+            m["x"] = ldb.MessageElement([b"%d" % i], ldb.FLAG_MOD_ADD, "x")
+            msgs.append(m)
+
+        errors = self.l.modify_many(msgs, batch=2)
+        self.assertEqual([(i, e) for i, e, s in errors],
+                         [(4, ldb.ERR_NO_SUCH_OBJECT)])
+
+        res = self.l.search(base="DC=SAMBA,DC=ORG",
+                            scope=ldb.SCOPE_ONELEVEL,
+                            expression="(x=*)")
+        self.assertEqual(len(res), 4)
+
+        self.assertRaises(TypeError, self.l.modify_many,
+                          [{"dn": "OU=MANY0,DC=SAMBA,DC=ORG"}])
+
+
 class AddModifyTestsLmdb(AddModifyTests):
 
     def setUp(self):
@@ -3350,6 +3469,24 @@ class MessageElementTests(TestCase):
         self.assertEqual("MessageElement([b'foo',b'bla'])", repr(x))
         self.assertEqual("MessageElement([b'foo',b'bla']).text", repr(x.text))
 
+    def test_view(self):
+        x = ldb.MessageElement([b"foo", b"bar"])
+        v = x.view(1)
+        self.assertIsInstance(v, memoryview)
+        self.assertTrue(v.readonly)
+        self.assertEqual(b"bar", v.tobytes())
+        self.assertRaises(IndexError, x.view, 2)
+        self.assertRaises(BufferError, memoryview, x)
+
+        # the view outlives the element
+        del x
+        self.assertEqual(b"bar", bytes(v))
+
+    def test_buffer(self):
+        x = ldb.MessageElement([b"foo"])
+        self.assertEqual(b"foo", bytes(memoryview(x)))
+        self.assertEqual(b"foo", bytes(x))
+
     def test_get_item(self):
         x = ldb.MessageElement([b"foo", b"bar"])
         self.assertEqual(b"foo", x[0])
@@ -49,6 +49,23 @@ class TdbTextWrapper(object):
         value = value.encode('utf-8')
         self._tdb.store(key, value)
 
+    def items(self):
+        return [(k.decode('utf-8'), v.decode('utf-8'))
+                for k, v in self._tdb.items()]
+
+    def values(self):
+        return [v.decode('utf-8') for v in self._tdb.values()]
+
+    def traverse(self, callback, read_only=False):
+        def text_callback(key, value):
+            return callback(key.decode('utf-8'), value.decode('utf-8'))
+        return self._tdb.traverse(text_callback, read_only)
+
+    def traverse_chains(self, callback, *args, **kwargs):
+        def text_callback(key, value):
+            return callback(key.decode('utf-8'), value.decode('utf-8'))
+        return self._tdb.traverse_chains(text_callback, *args, **kwargs)
+
     def __iter__(self):
         for key in iter(self._tdb):
             yield key.decode('utf-8')
@@ -537,6 +537,198 @@ static PyObject *obj_increment_seqnum_nonblock(PyTdbObject *self,
 	Py_RETURN_NONE;
 }
 
+struct py_tdb_traverse_state {
+	PyObject *callback;	/* called with (key, value), or NULL */
+	PyObject *list;		/* otherwise items are appended here */
+	int what;		/* for the list: 0 items, 1 keys, 2 values */
+	bool failed;
+};
+
+/*
+ * The key and value are only valid during the traverse, so they are
+ * copied into bytes objects. If the callback returns a true value,
+ * the traverse stops, as it does in C.
+ */
+static int py_tdb_traverse_fn(TDB_CONTEXT *tdb, TDB_DATA key, TDB_DATA data,
+			      void *private_data)
+{
+	struct py_tdb_traverse_state *state = private_data;
+	PyObject *py_key = NULL, *py_data = NULL, *item = NULL;
+	int ret = 0;
+
+	if (state->list == NULL || state->what != 2) {
+		py_key = PyBytes_FromStringAndSize((const char *)key.dptr,
+						   key.dsize);
+		if (py_key == NULL) {
+			goto fail;
+		}
+	}
+	if (state->list == NULL || state->what != 1) {
+		py_data = PyBytes_FromStringAndSize((const char *)data.dptr,
+						    data.dsize);
+		if (py_data == NULL) {
+			goto fail;
+		}
+	}
+
+	if (state->callback != NULL) {
+		PyObject *result;
+		result = PyObject_CallFunctionObjArgs(state->callback,
+						      py_key, py_data, NULL);
+		if (result == NULL) {
+			goto fail;
+		}
+		ret = PyObject_IsTrue(result);
+		Py_DECREF(result);
+		if (ret == -1) {
+			goto fail;
+		}
+	} else {
+		switch (state->what) {
+		case 1:
+			item = py_key;
+			Py_INCREF(item);
+			break;
+		case 2:
+			item = py_data;
+			Py_INCREF(item);
+			break;
+		default:
+			item = PyTuple_Pack(2, py_key, py_data);
+			if (item == NULL) {
+				goto fail;
+			}
+		}
+		if (PyList_Append(state->list, item) != 0) {
+			goto fail;
+		}
+	}
+
+	Py_XDECREF(item);
+	Py_XDECREF(py_key);
+	Py_XDECREF(py_data);
+	return ret;
+
+fail:
+	state->failed = true;
+	Py_XDECREF(item);
+	Py_XDECREF(py_key);
+	Py_XDECREF(py_data);
+	return 1;
+}
+
+static PyObject *obj_traverse(PyTdbObject *self, PyObject *args,
+			      PyObject *kwargs)
+{
+	struct py_tdb_traverse_state state = { .what = 0 };
+	int read_only = false;
+	int ret;
+	const char *_kwnames[] = { "callback", "read_only", NULL };
+	char **kwnames = discard_const_p(char *, _kwnames);
+
+	PyErr_TDB_RAISE_IF_CLOSED(self);
+
+	if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|p", kwnames,
+					 &state.callback, &read_only)) {
+		return NULL;
+	}
+	if (!PyCallable_Check(state.callback)) {
+		PyErr_SetString(PyExc_TypeError, "callback must be callable");
+		return NULL;
+	}
+
+	if (read_only) {
+		ret = tdb_traverse_read(self->ctx, py_tdb_traverse_fn, &state);
+	} else {
+		ret = tdb_traverse(self->ctx, py_tdb_traverse_fn, &state);
+	}
+	if (state.failed) {
+		return NULL;
+	}
+	if (ret == -1) {
+		PyErr_SetTDBError(self->ctx);
+		return NULL;
+	}
+	return PyLong_FromLong(ret);
+}
+
+static PyObject *py_tdb_traverse_list(PyTdbObject *self, int what)
+{
+	struct py_tdb_traverse_state state = { .what = what };
+	int ret;
+
+	PyErr_TDB_RAISE_IF_CLOSED(self);
+
+	state.list = PyList_New(0);
+	if (state.list == NULL) {
+		return NULL;
+	}
+
+	ret = tdb_traverse_read(self->ctx, py_tdb_traverse_fn, &state);
+	if (state.failed) {
+		Py_DECREF(state.list);
+		return NULL;
+	}
+	if (ret == -1) {
+		Py_DECREF(state.list);
+		PyErr_SetTDBError(self->ctx);
+		return NULL;
+	}
+	return state.list;
+}
+
+static PyObject *obj_items(PyTdbObject *self, PyObject *Py_UNUSED(ignored))
+{
+	return py_tdb_traverse_list(self, 0);
+}
+
+static PyObject *obj_values(PyTdbObject *self, PyObject *Py_UNUSED(ignored))
+{
+	return py_tdb_traverse_list(self, 2);
+}
+
+static PyObject *obj_traverse_chains(PyTdbObject *self, PyObject *args,
+				     PyObject *kwargs)
+{
+	struct py_tdb_traverse_state state = { .what = 0 };
+	unsigned int start = 0, stop, chain, hash_size;
+	long count = 0;
+	int ret;
+	const char *_kwnames[] = { "callback", "start", "stop", NULL };
+	char **kwnames = discard_const_p(char *, _kwnames);
+
+	PyErr_TDB_RAISE_IF_CLOSED(self);
+
+	hash_size = tdb_hash_size(self->ctx);
+	stop = hash_size;
+
+	if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|II", kwnames,
+					 &state.callback, &start, &stop)) {
+		return NULL;
+	}
+	if (!PyCallable_Check(state.callback)) {
+		PyErr_SetString(PyExc_TypeError, "callback must be callable");
+		return NULL;
+	}
+	if (stop > hash_size) {
+		stop = hash_size;
+	}
+
+	for (chain = start; chain < stop; chain++) {
+		ret = tdb_traverse_chain(self->ctx, chain, py_tdb_traverse_fn,
+					 &state);
+		if (state.failed) {
+			return NULL;
+		}
+		if (ret == -1) {
+			PyErr_SetTDBError(self->ctx);
+			return NULL;
+		}
+		count += ret;
+	}
+	return PyLong_FromLong(count);
+}
+
 static PyMethodDef tdb_object_methods[] = {
 	{ "transaction_cancel", (PyCFunction)obj_transaction_cancel, METH_NOARGS, 
 		"S.transaction_cancel() -> None\n"
@@ -581,6 +773,20 @@ static PyMethodDef tdb_object_methods[] = {
 #else
 	{ "iterkeys", (PyCFunction)tdb_object_iter, METH_NOARGS, "S.iterkeys() -> iterator" },
 #endif
+	{ "traverse", PY_DISCARD_FUNC_SIG(PyCFunction, obj_traverse),
+		METH_VARARGS|METH_KEYWORDS,
+		"S.traverse(callback, read_only=False) -> count\n"
+		"Call callback(key, value) for each record, in a single locked pass.\n"
+		"The traverse stops early if callback returns a true value." },
+	{ "traverse_chains", PY_DISCARD_FUNC_SIG(PyCFunction, obj_traverse_chains),
+		METH_VARARGS|METH_KEYWORDS,
+		"S.traverse_chains(callback, start=0, stop=hash_size) -> count\n"
+		"Call callback(key, value) for each record in the hash chains\n"
+		"start <= chain < stop, read-locking one chain at a time." },
+	{ "items", (PyCFunction)obj_items, METH_NOARGS, "S.items() -> list\n"
+		"Return a list of (key, value) pairs, read in a single traverse." },
+	{ "values", (PyCFunction)obj_values, METH_NOARGS, "S.values() -> list\n"
+		"Return a list of the values, read in a single traverse." },
 	{ "clear", (PyCFunction)obj_clear, METH_NOARGS, "S.clear() -> None\n"
 		"Wipe the entire database." },
 	{ "repack", (PyCFunction)obj_repack, METH_NOARGS, "S.repack() -> None\n"
@@ -7,6 +7,10 @@ if len(sys.argv) < 2:
     print("Usage: tdbdump.py <tdb-file>")
     sys.exit(1)
 
-db = tdb.Tdb(sys.argv[1])
-for (k, v) in db.items():
+
+def dump_record(k, v):
     print("{\nkey(%d) = %r\ndata(%d) = %r\n}" % (len(k), k, len(v), v))
+
+
+db = tdb.Tdb(sys.argv[1])
+db.traverse(dump_record, read_only=True)
@@ -145,6 +145,50 @@ class SimpleTdbTests(TestCase):
         l.sort()
         self.assertEqual([b"bla", b"brainslug"], l)
 
+    def test_items(self):
+        self.tdb[b"bla"] = b"1"
+        self.tdb[b"brainslug"] = b"2"
+        self.assertEqual([(b"bla", b"1"), (b"brainslug", b"2")],
+                         sorted(self.tdb.items()))
+        self.assertEqual([b"1", b"2"], sorted(self.tdb.values()))
+
+    def test_traverse(self):
+        for i in range(20):
+            self.tdb[b"key%d" % i] = b"value%d" % i
+        seen = {}
+
+        def add(k, v):
+            seen[k] = v
+        self.assertEqual(20, self.tdb.traverse(add))
+        self.assertEqual(dict(self.tdb.items()), seen)
+
+        # returning true stops the traverse
+        self.assertEqual(1, self.tdb.traverse(lambda k, v: True,
+                                              read_only=True))
+
+        def fail(k, v):
+            raise ValueError(k)
+        self.assertRaises(ValueError, self.tdb.traverse, fail)
+
+        # records can be deleted during a writable traverse
+        self.tdb.traverse(lambda k, v: self.tdb.delete(k))
+        self.assertEqual([], self.tdb.items())
+
+    def test_traverse_chains(self):
+        for i in range(100):
+            self.tdb[b"key%d" % i] = b"value%d" % i
+        seen = []
+
+        def add(k, v):
+            seen.append((k, v))
+        hash_size = self.tdb.hash_size
+        middle = hash_size // 2
+        n = self.tdb.traverse_chains(add, 0, middle)
+        n += self.tdb.traverse_chains(add, start=middle)
+        self.assertEqual(100, n)
+        self.assertEqual(sorted(self.tdb.items()), sorted(seen))
+        self.assertEqual(0, self.tdb.traverse_chains(add, hash_size))
+
     def test_transaction_cancel(self):
         self.tdb[b"bloe"] = b"2"
         self.tdb.transaction_start()
@@ -294,6 +338,16 @@ class TdbTextTests(TestCase):
         self.tdb.text["entry"] = "value"
         self.assertEqual(1, len(list(self.tdb.text)))
 
+    def test_items(self):
+        self.tdb.text["bla"] = "1"
+        self.tdb.text["brainslug"] = "2"
+        self.assertEqual([("bla", "1"), ("brainslug", "2")],
+                         sorted(self.tdb.text.items()))
+        self.assertEqual(["1", "2"], sorted(self.tdb.text.values()))
+        seen = []
+        self.tdb.text.traverse(lambda k, v: seen.append((k, v)))
+        self.assertEqual(sorted(self.tdb.text.items()), sorted(seen))
+
     def test_text_and_binary(self):
         text = u'\xfa\u0148\xef\xe7\xf8\xf0\xea'
         bytestr = text.encode('utf-8')
@@ -291,23 +291,25 @@ sub PythonStruct($$$$$$)
 		$self->indent;
 		$self->pidl("$cname *object = ($cname *)pytalloc_get_ptr(py_obj);");
 		$self->pidl("DATA_BLOB blob = {.data = NULL, .length = 0};");
-		$self->pidl("Py_ssize_t blob_length = 0;");
+		$self->pidl("Py_buffer view;");
 		$self->pidl("enum ndr_err_code err;");
 		$self->pidl("const char * const kwnames[] = { \"data_blob\", \"allow_remaining\", NULL };");
 		$self->pidl("PyObject *allow_remaining_obj = NULL;");
 		$self->pidl("bool allow_remaining = false;");
 		$self->pidl("");
-		$self->pidl("if (!PyArg_ParseTupleAndKeywords(args, kwargs, PYARG_BYTES_LEN \"|O:__ndr_unpack__\",");
+		$self->pidl("/* any bytes-like object, including a memoryview, without a copy */");
+		$self->pidl("if (!PyArg_ParseTupleAndKeywords(args, kwargs, \"y*|O:__ndr_unpack__\",");
 		$self->indent;
 		$self->pidl("discard_const_p(char *, kwnames),");
-		$self->pidl("&blob.data, &blob_length,");
+		$self->pidl("&view,");
 		$self->pidl("&allow_remaining_obj)) {");
 		$self->deindent;
 		$self->indent;
 		$self->pidl("return NULL;");
 		$self->deindent;
 		$self->pidl("}");
-		$self->pidl("blob.length = blob_length;");
+		$self->pidl("blob.data = (uint8_t *)view.buf;");
+		$self->pidl("blob.length = view.len;");
 		$self->pidl("");
 		$self->pidl("if (allow_remaining_obj && PyObject_IsTrue(allow_remaining_obj)) {");
 		$self->indent;
@@ -324,6 +326,7 @@ sub PythonStruct($$$$$$)
 		$self->pidl("err = ndr_pull_struct_blob_all(&blob, pytalloc_get_mem_ctx(py_obj), object, (ndr_pull_flags_fn_t)ndr_pull_$name);");
 		$self->deindent;
 		$self->pidl("}");
+		$self->pidl("PyBuffer_Release(&view);");
 		$self->pidl("if (!NDR_ERR_CODE_IS_SUCCESS(err)) {");
 		$self->indent;
 		$self->pidl("PyErr_SetNdrError(err);");
@@ -30,6 +30,12 @@ import samba.param
 from samba import _glue
 from samba._ldb import Ldb as _Ldb
 
+# load_ldif_file_add() adds this many records in each transaction
+LDIF_BATCH_SIZE = 1000
+
+# and parses roughly this many characters of LDIF at a time
+LDIF_CHUNK_SIZE = 1024 * 1024
+
 
 def source_tree_topdir():
     """Return the top level source directory."""
@@ -212,22 +218,100 @@ class Ldb(_Ldb):
                     # Ignore missing dn errors
                     raise
 
-    def load_ldif_file_add(self, ldif_path):
+    def load_ldif_file_add(self, ldif_path, controls=None,
+                           batch_size=LDIF_BATCH_SIZE, progress=None):
         """Load a LDIF file.
 
+        The file is read and added a few records at a time, so it never
+        needs to fit in memory. See add_ldif() for the other parameters.
+
         :param ldif_path: Path to LDIF file.
+        :return: The number of records added.
         """
-        with open(ldif_path, 'r') as ldif_file:
-            self.add_ldif(ldif_file.read())
+        with open(ldif_path, 'r', encoding="utf-8") as ldif_file:
+            return self.add_ldif(ldif_file, controls, batch_size=batch_size,
+                                 progress=progress)
 
-    def add_ldif(self, ldif, controls=None):
+    def parse_ldif_file(self, ldif_file, chunk_size=LDIF_CHUNK_SIZE):
+        """Parse LDIF from a file object, yielding (changetype, msg) pairs.
+
+        Unlike parse_ldif(), this doesn't need the whole text at once.
+        Lines are collected until a record ends after at least chunk_size
+        characters, and only those records are parsed together.
+
+        :param ldif_file: A file object opened in text mode.
+        :param chunk_size: The approximate number of characters to parse
+            at a time.
+        """
+        lines = []
+        size = 0
+        # Trailing blank lines and comments are left out, because
+        # parse_ldif() treats them as an empty record and fails.
+        end = 0
+        for line in ldif_file:
+            lines.append(line)
+            size += len(line)
+            if line == '\n':
+                # a blank line ends a record
+                if size >= chunk_size:
+                    if end:
+                        for record in self.parse_ldif(''.join(lines[:end])):
+                            yield record
+                    lines = []
+                    size = 0
+                    end = 0
+            elif not line.startswith('#') and not line.isspace():
+                end = len(lines)
+
+        if end:
+            for record in self.parse_ldif(''.join(lines[:end])):
+                yield record
+
+    def add_ldif(self, ldif, controls=None, batch_size=None, progress=None):
         """Add data based on a LDIF string.
 
-        :param ldif: LDIF text.
+        :param ldif: LDIF text, or a file object to read it from.
+        :param controls: Controls to use for each add.
+        :param batch_size: If set, add this many records in each
+            transaction. Batches that have been committed stay added if
+            a later record fails.
+        :param progress: Optional function, called as
+            progress(records, seconds) after each batch and at the end,
+            which can be used to report records per second.
+        :return: The number of records added.
         """
-        for changetype, msg in self.parse_ldif(ldif):
+        if isinstance(ldif, str):
+            records = self.parse_ldif(ldif)
+        else:
+            records = self.parse_ldif_file(ldif)
+
+        start = time.time()
+        count = 0
+        batch = []
+        for changetype, msg in records:
             assert changetype == ldb.CHANGETYPE_NONE
-            self.add(msg, controls)
+            if batch_size is None:
+                self.add(msg, controls)
+                count += 1
+                continue
+
+            batch.append(msg)
+            if len(batch) >= batch_size:
+                self.add_many(batch, controls, batch=batch_size,
+                              stop_on_error=True)
+                count += len(batch)
+                batch = []
+                if progress is not None:
+                    progress(count, time.time() - start)
+
+        if batch:
+            self.add_many(batch, controls, batch=batch_size,
+                          stop_on_error=True)
+            count += len(batch)
+
+        if progress is not None:
+            progress(count, time.time() - start)
+        return count
 
     def modify_ldif(self, ldif, controls=None):
         """Modify database based on a LDIF string.
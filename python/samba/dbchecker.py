@@ -20,6 +20,7 @@
 import ldb
 import samba
 import time
+import functools
 from base64 import b64decode
 from samba import dsdb
 from samba import common
@@ -49,6 +50,43 @@ def dump_attr_values(vals):
     return ','.join(result)
 
 
+ZERO_GUID = "00000000-0000-0000-0000-000000000000"
+
+# How many distinct security descriptors process_sd() remembers the
+# analysis of. Most objects share one of a few dozen.
+SD_CACHE_SIZE = 1024
+
+
+class ReplMetadata(object):
+    """The replPropertyMetaData of one object, unpacked once and shared
+    by all the metadata checks.
+
+    Reading ctr.array of the NDR object builds a new list of new python
+    objects every time, so we read it once here and keep the fields the
+    checks look at in plain lists, in the order they are stored.
+    """
+
+    def __init__(self, val):
+        self.repl = ndr_unpack(drsblobs.replPropertyMetaDataBlob, val)
+        self.entries = self.repl.ctr.array
+        self.attids = [o.attid for o in self.entries]
+        self.invocation_ids = [str(o.originating_invocation_id)
+                               for o in self.entries]
+        self.local_usns = [o.local_usn for o in self.entries]
+        self.change_times = [o.originating_change_time
+                             for o in self.entries]
+        self.index = {}
+        for i, attid in enumerate(self.attids):
+            self.index.setdefault(attid, i)
+
+    def find(self, attid):
+        """The (first) entry for attid, or None."""
+        i = self.index.get(attid)
+        if i is None:
+            return None
+        return self.entries[i]
+
+
 class dbcheck(object):
     """check a SAM database for errors"""
 
@@ -113,6 +151,8 @@ class dbcheck(object):
         self.rid_dn = ldb.Dn(samdb, "CN=RID Manager$,CN=System," + samdb.domain_dn())
         self.ntds_dsa = ldb.Dn(samdb, samdb.get_dsServiceName())
         self.class_schemaIDGUID = {}
+        self.analyse_sd = functools.lru_cache(maxsize=SD_CACHE_SIZE)(
+            self._analyse_sd)
         self.wellknown_sds = get_wellknown_sds(self.samdb)
         self.fix_all_missing_objectclass = False
         self.fix_missing_deleted_objects = False
@@ -122,6 +162,8 @@ class dbcheck(object):
 
         self.dn_set = set()
         self.link_id_cache = {}
+        self.attid_name_cache = {}
+        self.name_attid_cache = {}
         self.name_map = {}
         try:
             base_dn = "CN=DnsAdmins,%s" % samdb.get_wellknown_dn(
@@ -267,6 +309,12 @@ class dbcheck(object):
         if error_count != 0 and not self.fix:
             self.report("Please use --fix to fix these errors")
 
+        if self.verbose:
+            info = self.analyse_sd.cache_info()
+            self.report("Security descriptor cache: %u hits, %u misses "
+                        "(%u distinct descriptors kept)" %
+                        (info.hits, info.misses, info.currsize))
+
         self.report('Checked %u objects (%u errors)' % (len(res), error_count))
         return error_count
 
@@ -1207,7 +1255,7 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
             # Try to get the local_usn and time from objectClass
             # if possible and fallback to any other one.
             repl = ndr_unpack(drsblobs.replPropertyMetaDataBlob,
-                              obj['replPropertyMetadata'][0])
+                              obj['replPropertyMetadata'].view(0))
             for o in repl.ctr.array:
                 local_usn = o.local_usn
                 t = o.originating_change_time
@@ -1375,7 +1423,7 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
                 if local_usn:
                     if 'replPropertyMetaData' in res[0]:
                         repl = ndr_unpack(drsblobs.replPropertyMetaDataBlob,
-                                          res[0]['replPropertyMetadata'][0])
+                                          res[0]['replPropertyMetadata'].view(0))
                         found_data = False
                         for o in repl.ctr.array:
                             if o.attid == drsuapi.DRSUAPI_ATTID_isDeleted:
@@ -1544,47 +1592,57 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
 
         return error_count
 
-    def find_repl_attid(self, repl, attid):
-        for o in repl.ctr.array:
-            if o.attid == attid:
-                return o
-
-        return None
-
-    def get_originating_time(self, val, attid):
-        '''Read metadata properties and return the originating time for
-           a given attributeId.
+    def get_attid_name(self, attid):
+        '''get_lDAPDisplayName_by_attid(), remembering the answers.
+           raises KeyError if the attid is unknown.'''
+        try:
+            att = self.attid_name_cache[attid]
+        except KeyError:
+            try:
+                att = self.samdb_schema.get_lDAPDisplayName_by_attid(attid)
+            except KeyError:
+                att = None
+            self.attid_name_cache[attid] = att
+        if att is None:
+            raise KeyError(attid)
+        return att
+
+    def get_name_attid(self, att, in_schema_nc):
+        '''get_attid_from_lDAPDisplayName(), remembering the answers'''
+        key = (att, in_schema_nc)
+        if key not in self.name_attid_cache:
+            self.name_attid_cache[key] = \
+                self.samdb_schema.get_attid_from_lDAPDisplayName(att,
+                                                                 is_schema_nc=in_schema_nc)
+        return self.name_attid_cache[key]
+
+    def get_originating_time(self, repl_meta, attid):
+        '''Read metadata properties (a ReplMetadata) and return the
+           originating time for a given attributeId.
 
            :return: the originating time or 0 if not found
         '''
-
-        repl = ndr_unpack(drsblobs.replPropertyMetaDataBlob, val)
-        o = self.find_repl_attid(repl, attid)
+        o = repl_meta.find(attid)
         if o is not None:
             return o.originating_change_time
         return 0
 
-    def process_metadata(self, dn, val):
-        '''Read metadata properties and list attributes in it.
+    def process_metadata(self, dn, repl_meta):
+        '''Read metadata properties (a ReplMetadata) and list attributes
+           in it.
            raises KeyError if the attid is unknown.'''
 
         set_att = set()
         wrong_attids = set()
-        list_attid = []
         in_schema_nc = dn.is_child_of(self.schema_dn)
 
-        repl = ndr_unpack(drsblobs.replPropertyMetaDataBlob, val)
-
-        for o in repl.ctr.array:
-            att = self.samdb_schema.get_lDAPDisplayName_by_attid(o.attid)
+        for attid in repl_meta.attids:
+            att = self.get_attid_name(attid)
             set_att.add(att.lower())
-            list_attid.append(o.attid)
-            correct_attid = self.samdb_schema.get_attid_from_lDAPDisplayName(att,
-                                                                             is_schema_nc=in_schema_nc)
-            if correct_attid != o.attid:
-                wrong_attids.add(o.attid)
+            if self.get_name_attid(att, in_schema_nc) != attid:
+                wrong_attids.add(attid)
 
-        return (set_att, list_attid, wrong_attids)
+        return (set_att, list(repl_meta.attids), wrong_attids)
 
     def fix_metadata(self, obj, attr):
         '''re-write replPropertyMetaData elements for a single attribute for a
@@ -1637,16 +1695,18 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
         self.class_schemaIDGUID[cls] = t
         return t
 
-    def process_sd(self, dn, obj):
-        sd_attr = "nTSecurityDescriptor"
-        sd_val = obj[sd_attr]
+    def _analyse_sd(self, sd_val):
+        '''Look at the inherited ACEs of a packed security descriptor.
 
-        sd = ndr_unpack(security.descriptor, sd_val[0])
+           This only depends on the descriptor, so it is wrapped in an
+           LRU cache (as self.analyse_sd) and done once for each distinct
+           descriptor.
 
-        is_deleted = 'isDeleted' in obj and str(obj['isDeleted'][0]).upper() == 'TRUE'
-        if is_deleted:
-            # we don't fix deleted objects
-            return (sd, None)
+           :return: a (last_inherited_type, broken, sd_clean_val) tuple,
+           where sd_clean_val is the packed descriptor without the
+           inherited ACEs, or None if that won't be needed.
+        '''
+        sd = ndr_unpack(security.descriptor, sd_val)
 
         sd_clean = security.descriptor()
         sd_clean.owner_sid = sd.owner_sid
@@ -1709,8 +1769,26 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
 
             last_inherited_type = t
 
+        if broken or last_inherited_type is not None:
+            return (last_inherited_type, broken, ndr_pack(sd_clean))
+        return (last_inherited_type, broken, None)
+
+    def process_sd(self, dn, obj):
+        sd_attr = "nTSecurityDescriptor"
+        sd_val = obj[sd_attr]
+
+        sd = ndr_unpack(security.descriptor, sd_val.view(0))
+
+        is_deleted = 'isDeleted' in obj and str(obj['isDeleted'][0]).upper() == 'TRUE'
+        if is_deleted:
+            # we don't fix deleted objects
+            return (sd, None)
+
+        (last_inherited_type, broken, sd_clean_val) = \
+            self.analyse_sd(sd_val[0])
+
         if broken:
-            return (sd_clean, sd)
+            return (ndr_unpack(security.descriptor, sd_clean_val), sd)
 
         if last_inherited_type is None:
             # ok
@@ -1737,7 +1815,7 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
 
         if t != last_inherited_type:
             # broken
-            return (sd_clean, sd)
+            return (ndr_unpack(security.descriptor, sd_clean_val), sd)
 
         # ok
         return (sd, None)
@@ -1811,7 +1889,7 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
             self.report("Fixed attribute '%s' of '%s'\n" % (sd_attr, dn))
         self.samdb.set_session_info(self.system_session_info)
 
-    def is_expired_tombstone(self, dn, repl_val):
+    def is_expired_tombstone(self, dn, repl_meta):
         if self.check_expired_tombstones:
             # This is not the default, it's just
             # used to keep dbcheck tests work with
@@ -1823,9 +1901,7 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
             # tombstone
             return False
 
-        repl = ndr_unpack(drsblobs.replPropertyMetaDataBlob, repl_val)
-
-        isDeleted = self.find_repl_attid(repl, drsuapi.DRSUAPI_ATTID_isDeleted)
+        isDeleted = repl_meta.find(drsuapi.DRSUAPI_ATTID_isDeleted)
 
         delete_time = samba.nttime2unix(isDeleted.originating_change_time)
         current_time = time.time()
@@ -1865,27 +1941,27 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
         self.expired_tombstones += 1
         return True
 
-    def find_changes_after_deletion(self, repl_val):
-        repl = ndr_unpack(drsblobs.replPropertyMetaDataBlob, repl_val)
-
-        isDeleted = self.find_repl_attid(repl, drsuapi.DRSUAPI_ATTID_isDeleted)
+    def find_changes_after_deletion(self, repl_meta):
+        isDeleted = repl_meta.find(drsuapi.DRSUAPI_ATTID_isDeleted)
 
         delete_time = samba.nttime2unix(isDeleted.originating_change_time)
+        deleted_usn = isDeleted.local_usn
+        deleted_change_time = isDeleted.originating_change_time
 
         tombstone_delta = self.tombstoneLifetime * (24 * 60 * 60)
 
         found = []
-        for o in repl.ctr.array:
-            if o.attid == drsuapi.DRSUAPI_ATTID_isDeleted:
+        for i, attid in enumerate(repl_meta.attids):
+            if attid == drsuapi.DRSUAPI_ATTID_isDeleted:
                 continue
 
-            if o.local_usn <= isDeleted.local_usn:
+            if repl_meta.local_usns[i] <= deleted_usn:
                 continue
 
-            if o.originating_change_time <= isDeleted.originating_change_time:
+            if repl_meta.change_times[i] <= deleted_change_time:
                 continue
 
-            change_time = samba.nttime2unix(o.originating_change_time)
+            change_time = samba.nttime2unix(repl_meta.change_times[i])
 
             delta = change_time - delete_time
             if delta <= tombstone_delta:
@@ -1895,18 +1971,18 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
             # has passed, we have a bug as the object might be deleted
             # already on other DCs and won't be able to replicate
             # back
-            found.append(o)
+            found.append(repl_meta.entries[i])
 
         return found, isDeleted
 
-    def has_changes_after_deletion(self, dn, repl_val):
-        found, isDeleted = self.find_changes_after_deletion(repl_val)
+    def has_changes_after_deletion(self, dn, repl_meta):
+        found, isDeleted = self.find_changes_after_deletion(repl_meta)
         if len(found) == 0:
             return False
 
         def report_attid(o):
             try:
-                attname = self.samdb_schema.get_lDAPDisplayName_by_attid(o.attid)
+                attname = self.get_attid_name(o.attid)
             except KeyError:
                 attname = "<unknown:0x%x08x>" % o.attid
 
@@ -1924,8 +2000,8 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
 
         return True
 
-    def err_changes_after_deletion(self, dn, repl_val):
-        found, isDeleted = self.find_changes_after_deletion(repl_val)
+    def err_changes_after_deletion(self, dn, repl_meta):
+        found, isDeleted = self.find_changes_after_deletion(repl_meta)
 
         in_schema_nc = dn.is_child_of(self.schema_dn)
         rdn_attr = dn.get_rdn_name()
@@ -1941,7 +2017,7 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
             if o.attid == drsuapi.DRSUAPI_ATTID_lastKnownParent:
                 continue
             try:
-                attname = self.samdb_schema.get_lDAPDisplayName_by_attid(o.attid)
+                attname = self.get_attid_name(o.attid)
             except KeyError:
                 attname = "<unknown:0x%x08x>" % o.attid
             unexpected.append(attname)
@@ -1960,17 +2036,15 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
                           "Failed to remove DN %s" % dn):
             self.report("Removed DN %s" % dn)
 
-    def has_replmetadata_zero_invocationid(self, dn, repl_meta_data):
-        repl = ndr_unpack(drsblobs.replPropertyMetaDataBlob,
-                          repl_meta_data)
-        ctr = repl.ctr
+    def has_replmetadata_zero_invocationid(self, dn, repl_meta):
         found = False
-        for o in ctr.array:
+        for i, invocation_id in enumerate(repl_meta.invocation_ids):
             # Search for a zero invocationID
-            if o.originating_invocation_id != misc.GUID("00000000-0000-0000-0000-000000000000"):
+            if invocation_id != ZERO_GUID:
                 continue
 
             found = True
+            o = repl_meta.entries[i]
             self.report('''ERROR: on replPropertyMetaData of %s, the instanceType on attribute 0x%08x,
                            version %d changed at %s is 00000000-0000-0000-0000-000000000000,
                            but should be non-zero.  Proposed fix is to set to our invocationID (%s).'''
@@ -2332,6 +2406,7 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
         set_attrs_from_md = set()
         set_attrs_seen = set()
         got_objectclass = False
+        repl_meta = None
 
         nc_dn = self.samdb.get_nc_root(obj.dn)
         try:
@@ -2358,14 +2433,19 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
                 systemFlags = int(obj[attrname][0])
 
             if attrname.lower() == 'replpropertymetadata':
-                repl_meta_data_val = obj[attrname][0]
+                # only unpacked, so no need for a copy
+                repl_meta_data_val = obj[attrname].view(0)
+
+        if repl_meta_data_val:
+            # all the metadata checks share this one decoding
+            repl_meta = ReplMetadata(repl_meta_data_val)
 
         if isDeleted and repl_meta_data_val:
-            if self.has_changes_after_deletion(dn, repl_meta_data_val):
+            if self.has_changes_after_deletion(dn, repl_meta):
                 error_count += 1
-                self.err_changes_after_deletion(dn, repl_meta_data_val)
+                self.err_changes_after_deletion(dn, repl_meta)
                 return error_count
-            if self.is_expired_tombstone(dn, repl_meta_data_val):
+            if self.is_expired_tombstone(dn, repl_meta):
                 return error_count
 
         for attrname in obj:
@@ -2393,15 +2473,15 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
                     object_rdn_val = str(obj[attrname][0])
 
             if attrname.lower() == 'replpropertymetadata':
-                if self.has_replmetadata_zero_invocationid(dn, obj[attrname][0]):
+                if self.has_replmetadata_zero_invocationid(dn, repl_meta):
                     error_count += 1
-                    self.err_replmetadata_zero_invocationid(dn, attrname, obj[attrname][0])
+                    self.err_replmetadata_zero_invocationid(dn, attrname, repl_meta_data_val)
                     # We don't continue, as we may also have other fixes for this attribute
                     # based on what other attributes we see.
 
                 try:
                     (set_attrs_from_md, list_attid_from_md, wrong_attids) \
-                        = self.process_metadata(dn, obj[attrname][0])
+                        = self.process_metadata(dn, repl_meta)
                 except KeyError:
                     error_count += 1
                     self.err_replmetadata_unknown_attid(dn, attrname, obj[attrname])
@@ -2411,7 +2491,7 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
                    or len(wrong_attids) > 0 \
                    or sorted(list_attid_from_md) != list_attid_from_md:
                     error_count += 1
-                    self.err_replmetadata_incorrect_attid(dn, attrname, obj[attrname][0], wrong_attids)
+                    self.err_replmetadata_incorrect_attid(dn, attrname, repl_meta_data_val, wrong_attids)
 
                 else:
                     # Here we check that the first attid is 0
@@ -2619,7 +2699,7 @@ newSuperior: %s""" % (str(from_dn), str(to_rdn), str(to_base)))
                 # It's 29/12/9999 at 23:59:59 UTC as specified in MS-ADTS 7.1.1.4.2 Deleted Objects Container
 
                 expectedTimeDo = 2650466015990000000
-                originating = self.get_originating_time(repl_meta_data_val, isDeletedAttId)
+                originating = self.get_originating_time(repl_meta, isDeletedAttId)
                 if originating != expectedTimeDo:
                     if self.confirm_all("Fix isDeleted originating_change_time on '%s'" % str(dn), 'fix_time_metadata'):
                         nmsg = ldb.Message()
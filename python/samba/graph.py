@@ -453,6 +453,18 @@ CHARSETS = {
 
 
 def find_transitive_distance(vertices, edges):
+    """Find the number of hops along directed edges between vertices.
+
+    Returns a dictionary of dictionaries, where answer[a][b] is the
+    length of the shortest path from a to b. Unreachable pairs are
+    left out. Vertices that appear in edges but not in vertices can be
+    stepped through, but are not included in the answer.
+
+    Each vertex is given an index, and sets of vertices are kept as
+    bits in a Python integer. A breadth-first search from each vertex
+    then costs O(V * (V + E)) at worst, and usually a lot less because
+    whole frontiers are combined with a single bitwise or.
+    """
     all_vertices = (set(vertices) |
                     set(e[0] for e in edges) |
                     set(e[1] for e in edges))
@@ -462,44 +474,41 @@ def find_transitive_distance(vertices, edges):
               (all_vertices - set(vertices)),
               file=sys.stderr)
 
-    # with n vertices, we are always less than n hops away from
-    # anywhere else.
-    inf = len(all_vertices)
-    distances = {}
-    for v in all_vertices:
-        distances[v] = {v: 0}
+    all_vertices = list(all_vertices)
+    index = dict((v, i) for i, v in enumerate(all_vertices))
 
+    # successors[i] has a bit set for each vertex one hop from vertex i
+    successors = [0] * len(all_vertices)
     for src, dest in edges:
-        distances[src][dest] = distances[src].get(dest, 1)
-
-    # This algorithm (and implementation) seems very suboptimal.
-    # potentially O(n^4), though n is smallish.
-    for i in range(inf):
-        changed = False
-        new_distances = {}
-        for v, d in distances.items():
-            new_d = d.copy()
-            new_distances[v] = new_d
-            for dest, cost in d.items():
-                for leaf, cost2 in distances[dest].items():
-                    new_cost = cost + cost2
-                    old_cost = d.get(leaf, inf)
-                    if new_cost < old_cost:
-                        new_d[leaf] = new_cost
-                        changed = True
-
-        distances = new_distances
-        if not changed:
-            break
-
-    # filter out unwanted vertices and infinite links
+        successors[index[src]] |= 1 << index[dest]
+
+    wanted = 0
+    for v in vertices:
+        wanted |= 1 << index[v]
+
     answer = {}
     for v in vertices:
-        answer[v] = {}
-        for v2 in vertices:
-            a = distances[v].get(v2, inf)
-            if a < inf:
-                answer[v][v2] = a
+        distances = {}
+        seen = frontier = 1 << index[v]
+        hops = 0
+        while frontier:
+            found = frontier & wanted
+            while found:
+                bit = found & -found
+                distances[all_vertices[bit.bit_length() - 1]] = hops
+                found ^= bit
+
+            reachable = 0
+            while frontier:
+                bit = frontier & -frontier
+                reachable |= successors[bit.bit_length() - 1]
+                frontier ^= bit
+
+            frontier = reachable & ~seen
+            seen |= frontier
+            hops += 1
+
+        answer[v] = distances
 
     return answer
 
@@ -522,15 +531,19 @@ def get_transitive_colourer(colours, n_vertices):
     return f
 
 
-def distance_matrix(vertices, edges,
-                    utf8=False,
-                    colour=None,
-                    shorten_names=False,
-                    generate_key=False,
-                    grouping_function=None,
-                    row_comments=None):
-    lines = []
-    write = lines.append
+def distance_matrix_lines(vertices, edges,
+                          utf8=False,
+                          colour=None,
+                          shorten_names=False,
+                          generate_key=False,
+                          grouping_function=None,
+                          row_comments=None):
+    """Generate the lines of a text matrix showing the number of hops
+    between each pair of vertices.
+
+    The lines are yielded as they are made, so large matrices can be
+    written out without first being joined into a single string.
+    """
 
     charset = CHARSETS['utf8' if utf8 else 'ascii']
     vertical = charset['vertical']
@@ -579,10 +592,10 @@ def distance_matrix(vertices, edges,
 
     vspace = ' ' * vlen
     verticals = ''
-    write("%*s %s  %sdestination%s" % (vlen, '',
+    yield "%*s %s  %sdestination%s" % (vlen, '',
                                        ' ' * len(vertices),
                                        c_header,
-                                       c_reset))
+                                       c_reset)
     for i, v in enumerate(vertices):
         j = len(vertices) - i
         c = colour_list[i]
@@ -590,7 +603,7 @@ def distance_matrix(vertices, edges,
             start = '%s%ssource%s' % (vspace[:-6], c_header, c_reset)
         else:
             start = vspace
-        write('%s %s%s%s%s%s %s%s' % (start,
+        yield '%s %s%s%s%s%s %s%s' % (start,
                                       verticals,
                                       c_reset,
                                       c,
@@ -598,7 +611,7 @@ def distance_matrix(vertices, edges,
                                       horizontal * j,
                                       v,
                                       c_reset
-                                      ))
+                                      )
         verticals += c + vertical
 
     connections = find_transitive_distance(vertices, edges)
@@ -625,34 +638,37 @@ def distance_matrix(vertices, edges,
         if row_comments is not None and row_comments[i]:
             row.append('%s %s %s' % (c_reset, right_arrow, row_comments[i]))
 
-        write('%s%*s%s %s%s' % (c, vlen, v, c_reset,
-                                ''.join(row), c_reset))
+        yield '%s%*s%s %s%s' % (c, vlen, v, c_reset,
+                                ''.join(row), c_reset)
 
     example_c = next(colour_cycle)
     if shorten_names:
-        write('')
+        yield ''
         for substitute, original in reversed(replacements):
-            write("'%s%s%s' stands for '%s%s%s'" % (example_c,
+            yield "'%s%s%s' stands for '%s%s%s'" % (example_c,
                                                     substitute,
                                                     c_reset,
                                                     example_c,
                                                     original,
-                                                    c_reset))
+                                                    c_reset)
     if generate_key:
-        write('')
-        write("Data can get from %ssource%s to %sdestination%s in the "
-              "indicated number of steps." % (c_header, c_reset,
-                                              c_header, c_reset))
-        write("%s%s%s means zero steps (it is the same DC)" %
-              (example_c, diagonal, c_reset))
-        write("%s1%s means a direct link" % (c_conn, c_reset))
-        write("%s2%s means a transitive link involving two steps "
-              "(i.e. one intermediate DC)" %
-              (colour_transitive(2), c_reset))
-        write("%s%s%s means there is no connection, even through other DCs" %
-              (c_disconn, missing, c_reset))
-
-    return '\n'.join(lines)
+        yield ''
+        yield ("Data can get from %ssource%s to %sdestination%s in the "
+               "indicated number of steps." % (c_header, c_reset,
+                                               c_header, c_reset))
+        yield ("%s%s%s means zero steps (it is the same DC)" %
+               (example_c, diagonal, c_reset))
+        yield "%s1%s means a direct link" % (c_conn, c_reset)
+        yield ("%s2%s means a transitive link involving two steps "
+               "(i.e. one intermediate DC)" %
+               (colour_transitive(2), c_reset))
+        yield ("%s%s%s means there is no connection, even through other "
+               "DCs" % (c_disconn, missing, c_reset))
+
+
+def distance_matrix(*args, **kwargs):
+    """Like distance_matrix_lines(), but returns a single string."""
+    return '\n'.join(distance_matrix_lines(*args, **kwargs))
 
 
 def pad_char(char, digits, padding=' '):
@@ -669,20 +685,23 @@ def transpose_dict_matrix(m):
     return m2
 
 
-def full_matrix(rows,
-                utf8=False,
-                colour=None,
-                shorten_names=False,
-                generate_key=False,
-                grouping_function=None,
-                row_comments=None,
-                colour_scale=None,
-                digits=1,
-                ylabel='source',
-                xlabel='destination',
-                transpose=True):
-    lines = []
-    write = lines.append
+def full_matrix_lines(rows,
+                      utf8=False,
+                      colour=None,
+                      shorten_names=False,
+                      generate_key=False,
+                      grouping_function=None,
+                      row_comments=None,
+                      colour_scale=None,
+                      digits=1,
+                      ylabel='source',
+                      xlabel='destination',
+                      transpose=True):
+    """Generate the lines of a text matrix showing the values in rows,
+    which is a dictionary of dictionaries.
+
+    The lines are yielded as they are made (see distance_matrix_lines()).
+    """
 
     if transpose:
         rows = transpose_dict_matrix(rows)
@@ -739,11 +758,11 @@ def full_matrix(rows,
 
     vspace = ' ' * vlen
     verticals = ''
-    write("%s %s %s%s%s" % (vspace,
+    yield "%s %s %s%s%s" % (vspace,
                             empty * (len(rows) + 1),
                             c_header,
                             xlabel,
-                            c_reset))
+                            c_reset)
     for i, v in enumerate(vertices):
         j = len(rows) - i
         c = colour_list[i]
@@ -754,7 +773,7 @@ def full_matrix(rows,
                                   c_reset)
         else:
             start = vspace
-        write('%s %s%s%s%s%s %s%s' % (start,
+        yield '%s %s%s%s%s%s %s%s' % (start,
                                       verticals,
                                       c_reset,
                                       c,
@@ -762,7 +781,7 @@ def full_matrix(rows,
                                       horizontal * j,
                                       v,
                                       c_reset
-                                      ))
+                                      )
         verticals += '%s%s' % (c, vertical)
 
     end_cell = '%s%s' % (' ' * use_padding, c_reset)
@@ -792,27 +811,30 @@ def full_matrix(rows,
         if row_comments is not None and row_comments[i]:
             row.append('%s %s %s' % (c_reset, right_arrow, row_comments[i]))
 
-        write('%s%*s%s %s%s' % (c, vlen, v, c_reset,
-                                ''.join(row), c_reset))
+        yield '%s%*s%s %s%s' % (c, vlen, v, c_reset,
+                                ''.join(row), c_reset)
 
     if overflow or shorten_names:
-        write('')
+        yield ''
 
     if overflow:
-            write("'%s%s%s' means greater than %d " %
-                  (colour_transitive(10 ** digits),
-                   toobig,
-                   c_reset,
-                   10 ** digits - 1))
+            yield ("'%s%s%s' means greater than %d " %
+                   (colour_transitive(10 ** digits),
+                    toobig,
+                    c_reset,
+                    10 ** digits - 1))
 
     if shorten_names:
         example_c = next(colour_cycle)
         for substitute, original in reversed(replacements):
-            write("'%s%s%s' stands for '%s%s%s'" % (example_c,
+            yield "'%s%s%s' stands for '%s%s%s'" % (example_c,
                                                     substitute,
                                                     c_reset,
                                                     example_c,
                                                     original,
-                                                    c_reset))
+                                                    c_reset)
+
 
-    return '\n'.join(lines)
+def full_matrix(*args, **kwargs):
+    """Like full_matrix_lines(), but returns a single string."""
+    return '\n'.join(full_matrix_lines(*args, **kwargs))
@@ -20,6 +20,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import random
+import resource
+import time
 import uuid
 from functools import cmp_to_key
 import itertools
@@ -130,6 +132,29 @@ class KCC(object):
         self.debug = debug
         self.dot_file_dir = dot_file_dir
 
+        # The time, peak memory, and number of connections after each
+        # step of run(), for benchmarking.
+        self.phase_stats = []
+
+    def record_phase(self, phase, start):
+        """Note the cost of a step of the KCC run, which started at the
+        given time.time()."""
+        n_connections = 0
+        n_reps_from = 0
+        for site in self.site_table.values():
+            for dsa in site.dsa_table.values():
+                n_connections += len(dsa.connect_table)
+        if self.my_dsa is not None:
+            for rep in self.my_dsa.needed_rep_table.values():
+                n_reps_from += len(rep.rep_repsFrom)
+        self.phase_stats.append({
+            'phase': phase,
+            'seconds': time.time() - start,
+            'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'connections': n_connections,
+            'repsFrom': n_reps_from,
+        })
+
     def load_ip_transport(self):
         """Loads the inter-site transport objects for Sites
 
@@ -2544,6 +2569,7 @@ class KCC(object):
 
         try:
             # Setup
+            start = time.time()
             self.load_my_site()
             self.load_my_dsa()
 
@@ -2551,6 +2577,7 @@ class KCC(object):
             self.load_all_partitions()
             self.load_ip_transport()
             self.load_all_sitelinks()
+            self.record_phase('load', start)
 
             if self.verify or self.dot_file_dir is not None:
                 guid_to_dnstr = {}
@@ -2639,25 +2666,40 @@ class KCC(object):
             # MS-TECH description of the KCC algorithm ([MS-ADTS] 6.2.2)
 
             # Step 1
+            start = time.time()
             self.refresh_failed_links_connections(ping)
+            self.record_phase('refresh_failed_links_connections', start)
 
             # Step 2
+            start = time.time()
             self.intrasite()
+            self.record_phase('intrasite', start)
 
             # Step 3
+            start = time.time()
             all_connected = self.intersite(ping)
+            self.record_phase('intersite', start)
 
             # Step 4
+            start = time.time()
             self.remove_unneeded_ntdsconn(all_connected)
+            self.record_phase('remove_unneeded_ntdsconn', start)
 
             # Step 5
+            start = time.time()
             self.translate_ntdsconn()
+            self.record_phase('translate_ntdsconn', start)
 
             # Step 6
+            start = time.time()
             self.remove_unneeded_failed_links_connections()
+            self.record_phase('remove_unneeded_failed_links_connections',
+                              start)
 
             # Step 7
+            start = time.time()
             self.update_rodc_connection()
+            self.record_phase('update_rodc_connection', start)
 
             if self.verify or self.dot_file_dir is not None:
                 self.plot_all_connections('dsa_final',
@@ -57,6 +57,104 @@ def verify_graph_complete(edges, vertices, edge_vertices):
             raise GraphError("graph is not fully connected")
 
 
+def _find_components(edges):
+    """Union-find the edges, returning a dictionary mapping each edge
+    vertex to a representative vertex of its connected component."""
+    parent = {}
+
+    def find(x):
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        # path compression
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    for a, b in edges:
+        parent.setdefault(a, a)
+        parent.setdefault(b, b)
+        ra = find(a)
+        rb = find(b)
+        if ra != rb:
+            parent[ra] = rb
+
+    return dict((v, find(v)) for v in parent)
+
+
+def _is_connected(edges, vertices):
+    """The verify_graph_connected() test, without the explanation."""
+    if not edges:
+        return len(vertices) <= 1
+    components = _find_components(edges)
+    return (len(set(components.values())) == 1 and
+            set(components) == set(vertices))
+
+
+def _adjacency_list(edges):
+    """Map each vertex to a list of (neighbour, edge index) pairs,
+    ignoring loops. Parallel edges are kept, so they are not bridges."""
+    adjacent = {}
+    for i, (a, b) in enumerate(edges):
+        if a == b:
+            continue
+        adjacent.setdefault(a, []).append((b, i))
+        adjacent.setdefault(b, []).append((a, i))
+    return adjacent
+
+
+def _find_bridges_and_articulation_points(edges):
+    """Find the edges and vertices whose removal would split the graph,
+    using Tarjan's depth first search (without recursion, because the
+    graph can be deeper than the Python stack).
+
+    Returns a set of edge indices and a set of vertices.
+    """
+    adjacent = _adjacency_list(edges)
+    order = {}
+    low = {}
+    bridges = set()
+    articulation_points = set()
+    counter = 0
+
+    for root in adjacent:
+        if root in order:
+            continue
+        order[root] = low[root] = counter
+        counter += 1
+        root_children = 0
+        # each frame is (vertex, the edge we arrived by, neighbour iterator)
+        stack = [(root, None, iter(adjacent[root]))]
+        while stack:
+            v, via, neighbours = stack[-1]
+            for w, i in neighbours:
+                if i == via:
+                    continue
+                if w in order:
+                    low[v] = min(low[v], order[w])
+                else:
+                    order[w] = low[w] = counter
+                    counter += 1
+                    stack.append((w, i, iter(adjacent[w])))
+                    break
+            else:
+                stack.pop()
+                if not stack:
+                    continue
+                parent = stack[-1][0]
+                low[parent] = min(low[parent], low[v])
+                if low[v] > order[parent]:
+                    bridges.add(via)
+                if parent == root:
+                    root_children += 1
+                elif low[v] >= order[parent]:
+                    articulation_points.add(parent)
+        if root_children > 1:
+            articulation_points.add(root)
+
+    return bridges, articulation_points
+
+
 def verify_graph_connected(edges, vertices, edge_vertices):
     """There is a path between any two nodes."""
     if not edges:
@@ -65,24 +163,13 @@ def verify_graph_connected(edges, vertices, edge_vertices):
         raise GraphError("all vertices are disconnected because "
                          "there are no edges:")
 
-    remaining_edges = list(edges)
-    reached = set(remaining_edges.pop())
-    while True:
-        doomed = []
-        for i, e in enumerate(remaining_edges):
-            a, b = e
-            if a in reached:
-                reached.add(b)
-                doomed.append(i)
-            elif b in reached:
-                reached.add(a)
-                doomed.append(i)
-        if not doomed:
-            break
-        for i in reversed(doomed):
-            del remaining_edges[i]
-
-    if remaining_edges or reached != set(vertices):
+    # We report the vertices that can't be reached from the last edge.
+    edges = list(edges)
+    components = _find_components(edges)
+    start = components[edges[-1][0]]
+    reached = set(v for v, c in components.items() if c == start)
+
+    if len(reached) != len(components) or reached != set(vertices):
         s = ("the graph is not connected, "
              "as the following vertices are unreachable:\n ")
         s += '\n '.join(v for v in sorted(vertices)
@@ -95,22 +182,55 @@ def verify_graph_connected_under_edge_failures(edges, vertices, edge_vertices):
     if len(edges) == 0:
         return verify_graph_connected(edges, vertices, edge_vertices)
 
-    for subset in itertools.combinations(edges, len(edges) - 1):
-        try:
-            verify_graph_connected(subset, vertices, edge_vertices)
-        except GraphError as e:
-            for edge in edges:
-                if edge not in subset:
-                    raise GraphError("The graph will be disconnected when the "
-                                     "connection from %s to %s fails" % edge)
+    # If the whole graph is connected, the edges whose loss disconnects
+    # it are the bridges. Otherwise we check each edge in turn, which
+    # will almost always fail at the first one.
+    edges = list(edges)
+    if _is_connected(edges, vertices):
+        bridges = _find_bridges_and_articulation_points(edges)[0]
+    else:
+        bridges = None
+
+    # An edge that is repeated does not disconnect anything when one
+    # copy fails. The edges are checked from the last to the first.
+    counts = {}
+    for edge in edges:
+        counts[edge] = counts.get(edge, 0) + 1
+
+    for i in reversed(range(len(edges))):
+        edge = edges[i]
+        if counts[edge] > 1:
+            continue
+        if bridges is None:
+            failed = not _is_connected(edges[:i] + edges[i + 1:], vertices)
+        else:
+            failed = i in bridges
+        if failed:
+            raise GraphError("The graph will be disconnected when the "
+                             "connection from %s to %s fails" % edge)
 
 
 def verify_graph_connected_under_vertex_failures(edges, vertices,
                                                  edge_vertices):
     """The graph stays connected when any single vertex is removed."""
+    # If the whole graph is connected, the vertices whose loss
+    # disconnects it are the articulation points. Otherwise we check
+    # each vertex in turn, which will almost always fail at the first
+    # one.
+    edges = list(edges)
+    if _is_connected(edges, vertices):
+        articulation_points = _find_bridges_and_articulation_points(edges)[1]
+    else:
+        articulation_points = None
+
     for v in vertices:
+        if (articulation_points is not None and
+            v not in articulation_points):
+            continue
         sub_vertices = [x for x in vertices if x is not v]
         sub_edges = [x for x in edges if v not in x]
+        # this raises the GraphError, with the list of unreachable
+        # vertices.
         verify_graph_connected(sub_edges, sub_vertices, sub_vertices)
 
 
@@ -309,11 +309,14 @@ class NCReplica(NamingContext):
 
         # Possibly no repsFrom if this is a singleton DC
         if "repsFrom" in msg:
-            for value in msg["repsFrom"]:
+            el = msg["repsFrom"]
+            for i in range(len(el)):
+                # unpack the values in place, without copying them
+                value = el.view(i)
                 try:
                     unpacked = ndr_unpack(drsblobs.repsFromToBlob, value)
                 except RuntimeError as e:
-                    print("bad repsFrom NDR: %r" % (value),
+                    print("bad repsFrom NDR: %r" % bytes(value),
                           file=sys.stderr)
                     continue
                 rep = RepsFromTo(self.nc_dnstr, unpacked)
@@ -403,7 +406,7 @@ class NCReplica(NamingContext):
 
         # Possibly no replUpToDateVector if this is a singleton DC
         if "replUpToDateVector" in msg:
-            value = msg["replUpToDateVector"][0]
+            value = msg["replUpToDateVector"].view(0)
             blob = ndr_unpack(drsblobs.replUpToDateVectorBlob,
                               value)
             if blob.version != 2:
@@ -468,11 +471,14 @@ class NCReplica(NamingContext):
 
         # Possibly no repsTo if this is a singleton DC
         if "repsTo" in msg:
-            for value in msg["repsTo"]:
+            el = msg["repsTo"]
+            for i in range(len(el)):
+                # unpack the values in place, without copying them
+                value = el.view(i)
                 try:
                     unpacked = ndr_unpack(drsblobs.repsFromToBlob, value)
                 except RuntimeError as e:
-                    print("bad repsTo NDR: %r" % (value),
+                    print("bad repsTo NDR: %r" % bytes(value),
                           file=sys.stderr)
                     continue
                 rep = RepsFromTo(self.nc_dnstr, unpacked)
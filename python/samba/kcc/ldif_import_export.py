@@ -21,7 +21,7 @@
 
 import os
 
-from samba import Ldb, ldb, read_and_sub_file
+from samba import Ldb, ldb
 from samba.auth import system_session
 from samba.samdb import SamDB, dsdb_Dn
 
@@ -62,8 +62,7 @@ def ldif_to_samdb(dburl, lp, ldif_file, forced_local_dsa=None):
 
     tmpdb.transaction_start()
     try:
-        data = read_and_sub_file(ldif_file, None)
-        tmpdb.add_ldif(data, None)
+        tmpdb.load_ldif_file_add(ldif_file)
         if forced_local_dsa:
             tmpdb.modify_ldif("""dn: @ROOTDSE
 changetype: modify
@@ -0,0 +1,566 @@
+# Generate synthetic forest topologies for testing the KCC at scale
+#
+# Copyright (C) Catalyst IT Ltd. 2026
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Synthetic forests in the LDIF format of samba_kcc --exportldif.
+
+The KCC tests use LDIF files exported from small real domains. To see
+how the KCC behaves with hundreds of sites and thousands of DCs, this
+makes up a forest of a given size and writes it in the same form, so it
+can be loaded with samba_kcc --importldif (or ldif_to_samdb()).
+
+The forest has:
+
+ - a root domain and optionally child domains, each with a
+   DomainDnsZones partition, and a ForestDnsZones partition;
+ - sites joined by a random spanning tree of site links, plus extra
+   links, with a range of costs and replication intervals, some of
+   them with restricted schedules;
+ - a number of DCs in each site, some of them RODCs and some of them
+   global catalogs, each site having at least one writable DC;
+ - preferred bridgeheads for some sites;
+ - the existing intrasite connections of some sites;
+ - repsFrom on the local DC's partitions, some of which have failed.
+
+The same seed always gives the same forest.
+"""
+
+import base64
+import random
+import uuid
+
+from samba import dsdb
+from samba.ndr import ndr_pack
+from samba.dcerpc import misc, drsuapi
+from samba.kcc.kcc_utils import RepsFromTo, new_connection_schedule
+
+WHEN_CHANGED = '20260101000000.0Z'
+SCHEMA_VERSION = 6
+
+# systemFlags, as seen in a Windows forest
+CROSSREF_DOMAIN_FLAGS = 3
+CROSSREF_CONFIG_FLAGS = 1
+CROSSREF_APP_FLAGS = 5
+SERVER_FLAGS = 1375731712
+CONNECTION_FLAGS = 1610612736
+
+SITE_LINK_COSTS = (100, 100, 100, 200, 500, 1000)
+SITE_LINK_INTERVALS = (15, 60, 180)
+
+# nTDSDSA options
+NTDSDSA_GC = dsdb.DS_NTDSDSA_OPT_IS_GC
+NTDSDSA_RODC = (dsdb.DS_NTDSDSA_OPT_DISABLE_OUTBOUND_REPL |
+                dsdb.DS_NTDSDSA_OPT_DISABLE_NTDSCONN_XLATE)
+
+# msDS-HasInstantiatedNCs flags (instanceType)
+INSTANCE_WRITABLE = 0x5
+INSTANCE_WRITABLE_ABOVE = 0xd
+INSTANCE_READ_ONLY = 0x1
+
+
+def ldif_value(attr, value):
+    """Format an attribute line, base64 encoding binary values"""
+    if isinstance(value, bytes):
+        return '%s:: %s\n' % (attr, base64.b64encode(value).decode('ascii'))
+    return '%s: %s\n' % (attr, value)
+
+
+def guid_dn(guid, dn):
+    """A DN with its GUID extended component, as stored in siteList"""
+    return '<GUID=%s>;%s' % (uuid.UUID(guid).bytes_le.hex(), dn)
+
+
+def site_link_schedule(hours):
+    """A packed siteLink schedule open during the given hours of each day"""
+    schedule = new_connection_schedule()
+    slots = []
+    for day in range(7):
+        for hour in range(24):
+            slots.append(0x0f if hour in hours else 0)
+    schedule.dataArray[0].slots = slots
+    return ndr_pack(schedule)
+
+
+class SyntheticForest(object):
+    """A made up forest. The constructor decides everything, and
+    write_ldif() writes it out."""
+
+    def __init__(self, sites=10, dcs_per_site=3, domains=1, seed=1,
+                 extra_links=0.2, rodc_fraction=0.1, gc_fraction=0.3,
+                 bridgehead_fraction=0.1, scheduled_fraction=0.2,
+                 failed_fraction=0.1, connected_fraction=0.5,
+                 realm='kcc.samba.example.com'):
+        """
+        :param sites: the number of sites
+        :param dcs_per_site: the average number of DCs in each site (sites
+                             have between 1 and twice this many)
+        :param domains: the number of domains (one root, the rest children)
+        :param seed: the random seed
+        :param extra_links: the number of site links beyond the spanning
+                            tree, as a fraction of the number of sites
+        :param rodc_fraction: the fraction of DCs that are RODCs
+        :param gc_fraction: the fraction of DCs that are global catalogs
+                            (the first DC in each site always is)
+        :param bridgehead_fraction: the fraction of sites with preferred
+                                    bridgeheads
+        :param scheduled_fraction: the fraction of site links that have a
+                                   restricted schedule
+        :param failed_fraction: the fraction of the local DC's repsFrom
+                                sources that are failing
+        :param connected_fraction: the fraction of sites that already have
+                                   intrasite connections
+        :param realm: the DNS name of the root domain
+        """
+        self.rng = random.Random(seed)
+        self.realm = realm
+        self.root_dn = ','.join('DC=%s' % x for x in realm.split('.'))
+        self.config_dn = 'CN=Configuration,%s' % self.root_dn
+        self.schema_dn = 'CN=Schema,%s' % self.config_dn
+        self.sites_dn = 'CN=Sites,%s' % self.config_dn
+        self.partitions_dn = 'CN=Partitions,%s' % self.config_dn
+        self.transports_dn = 'CN=Inter-Site Transports,%s' % self.sites_dn
+        self.ip_dn = 'CN=IP,%s' % self.transports_dn
+        self.forest_dns_dn = 'DC=ForestDnsZones,%s' % self.root_dn
+
+        self.scheduled_fraction = scheduled_fraction
+        self.failed_fraction = failed_fraction
+
+        self.domains = []
+        for i in range(max(1, domains)):
+            if i == 0:
+                name = realm.split('.')[0].upper()
+                dns = realm
+                dn = self.root_dn
+            else:
+                name = 'CHILD%d' % i
+                dns = '%s.%s' % (name.lower(), realm)
+                dn = 'DC=%s,%s' % (name.lower(), self.root_dn)
+            self.domains.append({
+                'name': name,
+                'dns': dns,
+                'dn': dn,
+                'dns_zones_dn': 'DC=DomainDnsZones,%s' % dn,
+                'guid': self.new_guid(),
+                'dns_zones_guid': self.new_guid(),
+                'sid': 'S-1-5-21-%d-%d-%d' % (self.rng.getrandbits(31),
+                                              self.rng.getrandbits(31),
+                                              self.rng.getrandbits(31)),
+                'dcs': [],
+            })
+
+        self.sites = []
+        self.dcs = []
+        for i in range(sites):
+            if i == 0:
+                name = 'Default-First-Site-Name'
+                domain = self.domains[0]
+            else:
+                name = 'Site-%04d' % i
+                domain = self.rng.choice(self.domains)
+            site = {
+                'name': name,
+                'dn': 'CN=%s,%s' % (name, self.sites_dn),
+                'guid': self.new_guid(),
+                'dcs': [],
+            }
+            self.sites.append(site)
+
+            n_dcs = self.rng.randint(1, max(1, 2 * dcs_per_site - 1))
+            for j in range(n_dcs):
+                self.add_dc(site, domain, j == 0, rodc_fraction,
+                            gc_fraction)
+
+            site['istg'] = site['dcs'][0]
+            site['connected'] = self.rng.random() < connected_fraction
+            rw_dcs = [dc for dc in site['dcs'] if not dc['rodc']]
+            if self.rng.random() < bridgehead_fraction:
+                n = min(len(rw_dcs), self.rng.randint(1, 2))
+                site['bridgeheads'] = self.rng.sample(rw_dcs, n)
+            else:
+                site['bridgeheads'] = []
+
+        self.local_dc = self.dcs[0]
+        self.site_links = self.make_site_links(extra_links)
+
+    def new_guid(self):
+        return str(uuid.UUID(int=self.rng.getrandbits(128), version=4))
+
+    def add_dc(self, site, domain, first, rodc_fraction, gc_fraction):
+        n = len(self.dcs) + 1
+        name = 'DC%05d' % n
+        server_dn = 'CN=%s,CN=Servers,%s' % (name, site['dn'])
+        dc = {
+            'name': name,
+            'server_dn': server_dn,
+            'dsa_dn': 'CN=NTDS Settings,%s' % server_dn,
+            'dns': '%s.%s' % (name.lower(), domain['dns']),
+            'domain': domain,
+            'server_guid': self.new_guid(),
+            'dsa_guid': self.new_guid(),
+            'invocation_id': self.new_guid(),
+            'rodc': not first and self.rng.random() < rodc_fraction,
+            'gc': first or self.rng.random() < gc_fraction,
+        }
+        site['dcs'].append(dc)
+        domain['dcs'].append(dc)
+        self.dcs.append(dc)
+
+    def make_site_links(self, extra_links):
+        links = []
+        pairs = set()
+
+        def add_link(site_list):
+            i = len(links) + 1
+            if self.rng.random() < self.scheduled_fraction:
+                # open outside business hours
+                start = self.rng.randint(17, 20)
+                hours = set(range(start, 24)) | set(range(0, 7))
+            else:
+                hours = None
+            links.append({
+                'name': 'LINK-%05d' % i,
+                'guid': self.new_guid(),
+                'sites': site_list,
+                'cost': self.rng.choice(SITE_LINK_COSTS),
+                'interval': self.rng.choice(SITE_LINK_INTERVALS),
+                'hours': hours,
+            })
+
+        # each site joins the tree at a random earlier site, so
+        # everything is connected, with some sites becoming hubs.
+        for i in range(1, len(self.sites)):
+            j = self.rng.randrange(i)
+            pairs.add((j, i))
+            add_link([self.sites[j], self.sites[i]])
+
+        n_extra = int(extra_links * len(self.sites))
+        attempts = 0
+        while n_extra > 0 and attempts < 10 * len(self.sites):
+            attempts += 1
+            a, b = sorted(self.rng.sample(range(len(self.sites)), 2))
+            if (a, b) in pairs:
+                continue
+            pairs.add((a, b))
+            add_link([self.sites[a], self.sites[b]])
+            n_extra -= 1
+
+        return links
+
+    def partitions(self):
+        """The naming contexts, as (dn, guid, kind) tuples"""
+        parts = [(self.config_dn, None, 'config'),
+                 (self.schema_dn, None, 'schema'),
+                 (self.forest_dns_dn, None, 'app')]
+        for domain in self.domains:
+            parts.append((domain['dn'], domain, 'domain'))
+            parts.append((domain['dns_zones_dn'], domain, 'app'))
+        return parts
+
+    def write_ldif(self, f):
+        """Write the forest to a file object as LDIF, in the order that
+        samba_kcc --exportldif uses."""
+        self.write_partitions(f)
+        self.write_sites(f)
+        self.write_dsas(f)
+        self.write_transports(f)
+        self.write_servers(f)
+        self.write_nc_heads(f)
+        self.write_rootdse(f)
+
+    def write_object(self, f, dn, object_classes, attrs):
+        f.write('dn: %s\n' % dn)
+        for oc in object_classes:
+            f.write('objectClass: %s\n' % oc)
+        for attr, values in attrs:
+            if not isinstance(values, (list, tuple)):
+                values = [values]
+            for value in values:
+                f.write(ldif_value(attr, value))
+        f.write('whenChanged: %s\n\n' % WHEN_CHANGED)
+
+    def write_partitions(self, f):
+        for domain in self.domains:
+            self.write_object(
+                f, 'CN=%s,%s' % (domain['name'], self.partitions_dn),
+                ['top', 'crossRef'],
+                [('cn', domain['name']),
+                 ('nCName', domain['dn']),
+                 ('objectGUID', self.new_guid()),
+                 ('dnsRoot', domain['dns']),
+                 ('systemFlags', CROSSREF_DOMAIN_FLAGS)])
+
+        for cn, nc in (('Enterprise Configuration', self.config_dn),
+                       ('Enterprise Schema', self.schema_dn)):
+            self.write_object(
+                f, 'CN=%s,%s' % (cn, self.partitions_dn),
+                ['top', 'crossRef'],
+                [('cn', cn),
+                 ('nCName', nc),
+                 ('objectGUID', self.new_guid()),
+                 ('dnsRoot', self.realm),
+                 ('systemFlags', CROSSREF_CONFIG_FLAGS)])
+
+        app_ncs = [(self.forest_dns_dn, 'ForestDnsZones.' + self.realm,
+                    self.dcs)]
+        for domain in self.domains:
+            app_ncs.append((domain['dns_zones_dn'],
+                            'DomainDnsZones.' + domain['dns'],
+                            domain['dcs']))
+        for nc, dns, dcs in app_ncs:
+            cn = self.new_guid()
+            self.write_object(
+                f, 'CN=%s,%s' % (cn, self.partitions_dn),
+                ['top', 'crossRef'],
+                [('cn', cn),
+                 ('nCName', nc),
+                 ('objectGUID', self.new_guid()),
+                 ('dnsRoot', dns),
+                 ('systemFlags', CROSSREF_APP_FLAGS),
+                 ('msDS-NC-Replica-Locations',
+                  [dc['dsa_dn'] for dc in dcs if not dc['rodc']]),
+                 ('msDS-NC-RO-Replica-Locations',
+                  [dc['dsa_dn'] for dc in dcs if dc['rodc']])])
+
+        self.write_object(f, self.partitions_dn,
+                          ['top', 'crossRefContainer'],
+                          [('cn', 'Partitions'),
+                           ('objectGUID', self.new_guid()),
+                           ('fSMORoleOwner', self.local_dc['dsa_dn']),
+                           ('systemFlags', -2147483648),
+                           ('msDS-Behavior-Version', SCHEMA_VERSION)])
+
+    def write_sites(self, f):
+        for site in self.sites:
+            self.write_object(f, site['dn'], ['top', 'site'],
+                              [('cn', site['name']),
+                               ('objectGUID', site['guid']),
+                               ('systemFlags', 1107296256)])
+
+        for site in self.sites:
+            self.write_object(f, 'CN=NTDS Site Settings,%s' % site['dn'],
+                              ['top', 'applicationSiteSettings',
+                               'nTDSSiteSettings'],
+                              [('cn', 'NTDS Site Settings'),
+                               ('objectGUID', self.new_guid()),
+                               ('interSiteTopologyGenerator',
+                                site['istg']['dsa_dn'])])
+
+    def write_dsas(self, f):
+        for site in self.sites:
+            for dc in site['dcs']:
+                self.write_dsa(f, dc)
+            if site['connected']:
+                self.write_connections(f, site)
+
+    def write_dsa(self, f, dc):
+        domain = dc['domain']
+        partial = []
+        if dc['gc']:
+            partial = [d['dn'] for d in self.domains if d is not domain]
+
+        options = 0
+        if dc['gc']:
+            options |= NTDSDSA_GC
+
+        attrs = [('cn', 'NTDS Settings'),
+                 ('objectGUID', dc['dsa_guid']),
+                 ('msDS-Behavior-Version', SCHEMA_VERSION),
+                 ('msDS-HasDomainNCs', domain['dn'])]
+
+        if dc['rodc']:
+            options |= NTDSDSA_RODC
+            attrs += [('options', options),
+                      ('msDS-hasFullReplicaNCs', [self.config_dn,
+                                                  self.schema_dn,
+                                                  domain['dn']]),
+                      ('msDS-isRODC', 'TRUE')]
+        else:
+            instantiated = ['B:8:%08X:%s' % (INSTANCE_WRITABLE_ABOVE, nc)
+                            for nc in (self.config_dn, self.schema_dn,
+                                       self.forest_dns_dn,
+                                       domain['dns_zones_dn'])]
+            instantiated.append('B:8:%08X:%s' % (INSTANCE_WRITABLE,
+                                                 domain['dn']))
+            instantiated += ['B:8:%08X:%s' % (INSTANCE_READ_ONLY, nc)
+                             for nc in partial]
+            attrs += [('invocationId', dc['invocation_id']),
+                      ('options', options),
+                      ('hasMasterNCs', [domain['dn'], self.config_dn,
+                                        self.schema_dn]),
+                      ('msDS-hasMasterNCs', [domain['dn'], self.config_dn,
+                                             self.schema_dn,
+                                             self.forest_dns_dn,
+                                             domain['dns_zones_dn']]),
+                      ('msDS-HasInstantiatedNCs', instantiated),
+                      ('msDS-isRODC', 'FALSE')]
+        if partial:
+            attrs.append(('hasPartialReplicaNCs', partial))
+
+        self.write_object(f, dc['dsa_dn'],
+                          ['top', 'applicationSettings', 'nTDSDSA'],
+                          attrs)
+
+    def write_connections(self, f, site):
+        """Connect the writable DCs of a site in a ring, as a previous KCC
+        run might have done."""
+        rw_dcs = [dc for dc in site['dcs'] if not dc['rodc']]
+        if len(rw_dcs) < 2:
+            return
+        schedule = ndr_pack(new_connection_schedule())
+        for i, dc in enumerate(rw_dcs):
+            source = rw_dcs[i - 1]
+            cn = self.new_guid()
+            self.write_object(f, 'CN=%s,%s' % (cn, dc['dsa_dn']),
+                              ['top', 'leaf', 'nTDSConnection'],
+                              [('cn', cn),
+                               ('objectGUID', self.new_guid()),
+                               ('whenCreated', WHEN_CHANGED),
+                               ('enabledConnection', 'TRUE'),
+                               ('fromServer', source['dsa_dn']),
+                               ('schedule', schedule),
+                               ('options', 1),
+                               ('systemFlags', CONNECTION_FLAGS)])
+
+    def write_transports(self, f):
+        self.write_object(f, 'CN=SMTP,%s' % self.transports_dn,
+                          ['top', 'interSiteTransport'],
+                          [('cn', 'SMTP'),
+                           ('name', 'SMTP'),
+                           ('objectGUID', self.new_guid()),
+                           ('options', 1),
+                           ('transportAddressAttribute', 'mailAddress')])
+
+        bridgeheads = [dc['server_dn'] for site in self.sites
+                       for dc in site['bridgeheads']]
+        self.write_object(f, self.ip_dn,
+                          ['top', 'interSiteTransport'],
+                          [('cn', 'IP'),
+                           ('name', 'IP'),
+                           ('objectGUID', self.new_guid()),
+                           ('transportAddressAttribute', 'dNSHostName'),
+                           ('bridgeheadServerListBL', bridgeheads)])
+
+        for link in self.site_links:
+            attrs = [('cn', link['name']),
+                     ('cost', link['cost']),
+                     ('objectGUID', link['guid']),
+                     ('systemFlags', 1073741824),
+                     ('replInterval', link['interval']),
+                     ('siteList', [guid_dn(site['guid'], site['dn'])
+                                   for site in link['sites']])]
+            if link['hours'] is not None:
+                attrs.append(('schedule', site_link_schedule(link['hours'])))
+            self.write_object(f, 'CN=%s,%s' % (link['name'], self.ip_dn),
+                              ['top', 'siteLink'], attrs)
+
+    def write_servers(self, f):
+        for site in self.sites:
+            self.write_object(f, 'CN=Servers,%s' % site['dn'],
+                              ['top', 'serversContainer'],
+                              [('cn', 'Servers'),
+                               ('objectGUID', self.new_guid()),
+                               ('systemFlags', 33554432)])
+
+        for dc in self.dcs:
+            self.write_object(f, dc['server_dn'], ['top', 'server'],
+                              [('cn', dc['name']),
+                               ('objectGUID', dc['server_guid']),
+                               ('systemFlags', SERVER_FLAGS),
+                               ('dNSHostName', dc['dns'])])
+
+    def holds_replica(self, dc, kind, domain):
+        """Can the DC be a replication source for the partition?"""
+        if dc['rodc']:
+            return False
+        if kind == 'domain':
+            return dc['domain'] is domain or dc['gc']
+        if domain is not None:
+            # DomainDnsZones
+            return dc['domain'] is domain
+        return True
+
+    def local_reps_from(self, nc_dn, kind, domain):
+        """repsFrom for the local DC: the other writable DCs in its site,
+        and a few in other sites, some of which are failing."""
+        local = self.local_dc
+        if not self.holds_replica(local, kind, domain):
+            return []
+
+        n_local = len(self.sites[0]['dcs'])
+        sources = [dc for dc in self.dcs[1:n_local]
+                   if self.holds_replica(dc, kind, domain)]
+        sources += [dc for dc in self.dcs[n_local:]
+                    if self.holds_replica(dc, kind, domain)][:3]
+
+        values = []
+        for dc in sources:
+            rep = RepsFromTo(nc_dn)
+            rep.source_dsa_obj_guid = misc.GUID(dc['dsa_guid'])
+            rep.source_dsa_invocation_id = misc.GUID(dc['invocation_id'])
+            rep.replica_flags = (drsuapi.DRSUAPI_DRS_INIT_SYNC |
+                                 drsuapi.DRSUAPI_DRS_PER_SYNC |
+                                 drsuapi.DRSUAPI_DRS_WRIT_REP)
+            rep.dns_name1 = '%s._msdcs.%s' % (dc['dsa_guid'], self.realm)
+            if self.rng.random() < self.failed_fraction:
+                rep.consecutive_sync_failures = self.rng.randint(1, 100)
+            values.append(ndr_pack(rep.ndr_blob))
+        return values
+
+    def write_nc_heads(self, f):
+        for nc_dn, domain, kind in self.partitions():
+            if kind == 'config':
+                object_classes = ['top', 'configuration']
+                attrs = [('cn', 'Configuration')]
+            elif kind == 'schema':
+                object_classes = ['top', 'dMD']
+                attrs = [('cn', 'Schema'),
+                         ('fSMORoleOwner', self.local_dc['dsa_dn'])]
+            elif kind == 'domain':
+                object_classes = ['top', 'domain', 'domainDNS']
+                attrs = [('objectSid', domain['sid']),
+                         ('fSMORoleOwner', domain['dcs'][0]['dsa_dn']),
+                         ('msDS-Behavior-Version', SCHEMA_VERSION)]
+            else:
+                object_classes = ['top', 'domain', 'domainDNS']
+                attrs = []
+
+            if kind == 'domain':
+                guid = domain['guid']
+            elif domain is not None:
+                guid = domain['dns_zones_guid']
+            else:
+                guid = self.new_guid()
+            attrs.append(('objectGUID', guid))
+            attrs.append(('repsFrom', self.local_reps_from(nc_dn, kind,
+                                                           domain)))
+            self.write_object(f, nc_dn, object_classes, attrs)
+
+    def write_rootdse(self, f):
+        f.write('dn: @ROOTDSE\n')
+        f.write('configurationNamingContext: %s\n' % self.config_dn)
+        f.write('defaultNamingContext: %s\n' % self.local_dc['domain']['dn'])
+        f.write('rootDomainNamingContext: %s\n' % self.root_dn)
+        f.write('schemaNamingContext: %s\n' % self.schema_dn)
+        f.write('dsServiceName: %s\n\n' % self.local_dc['dsa_dn'])
+
+
+def write_forest_ldif(filename, **kwargs):
+    """Write a synthetic forest to a file, returning the SyntheticForest.
+    The keyword arguments are those of SyntheticForest()."""
+    forest = SyntheticForest(**kwargs)
+    with open(filename, 'w') as f:
+        forest.write_ldif(f)
+    return forest
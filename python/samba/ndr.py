@@ -37,7 +37,8 @@ def ndr_unpack(cls, data, allow_remaining=False):
     """NDR unpack an object.
 
     :param cls: Class of the object to unpack
-    :param data: Buffer to unpack
+    :param data: Buffer to unpack. Any bytes-like object will do, and a
+        memoryview or single-valued ldb.MessageElement is not copied.
     :param allow_remaining: allows remaining data at the end (default=False)
     :return: Unpacked object
     """
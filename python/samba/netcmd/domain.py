@@ -294,6 +294,10 @@ class cmd_domain_provision(Command):
         Option("--partitions-only",
                help="Configure Samba's partitions, but do not modify them (ie, join a BDC)", action="store_true"),
         Option("--use-rfc2307", action="store_true", help="Use AD to store posix attributes (default = no)"),
+        Option("--template-dir", type="string", metavar="DIR",
+               help="Clone the SAM database from a template kept in DIR, "
+               "building the template first if there isn't one for these "
+               "options. Much faster."),
     ]
 
     ntvfs_options = [
@@ -347,7 +351,8 @@ class cmd_domain_provision(Command):
             base_schema=None,
             plaintext_secrets=False,
             backend_store=None,
-            backend_store_size=None):
+            backend_store_size=None,
+            template_dir=None):
 
         self.logger = self.get_logger(name="provision", quiet=quiet)
 
@@ -508,7 +513,8 @@ class cmd_domain_provision(Command):
                                base_schema=base_schema,
                                plaintext_secrets=plaintext_secrets,
                                backend_store=backend_store,
-                               backend_store_size=backend_store_size)
+                               backend_store_size=backend_store_size,
+                               template_dir=template_dir)
 
         except ProvisioningError as e:
             raise CommandError("Provision failed", e)
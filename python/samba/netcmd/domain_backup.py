@@ -16,14 +16,20 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 import datetime
+import hashlib
+import io
+import json
+import multiprocessing
 import os
 import sys
 import tarfile
 import logging
 import shutil
 import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import samba
-import tdb
 import samba.getopt as options
 from samba.samdb import SamDB, get_default_backend_store
 import ldb
@@ -48,15 +54,20 @@ from samba.provision import guess_names, determine_host_ip, determine_host_ip6
 from samba.provision.sambadns import (fill_dns_data_partitions,
                                       get_dnsadmins_sid,
                                       get_domainguid)
-from samba.tdb_util import tdb_copy
+from samba.tdb_util import tdb_backup
 from samba.mdb_util import mdb_copy
 import errno
-from subprocess import CalledProcessError
 from samba import sites
 from samba.dsdb import _dsdb_load_udv_v2
 from samba.ndr import ndr_pack
 from samba.credentials import SMB_SIGNING_REQUIRED
 
+# The offline backup ends with a manifest of the size and sha256 of every
+# file in the tar, which 'samba-tool domain backup verify' checks.
+BACKUP_MANIFEST = 'backup-manifest.json'
+BACKUP_MANIFEST_VERSION = 1
+BACKUP_CHUNK_SIZE = 1024 * 1024
+
 
 # work out a SID (based on a free RID) to use when the domain gets restored.
 # This ensures that the restored DC's SID won't clash with any other RIDs
@@ -109,18 +120,27 @@ def get_sid_for_restore(samdb, logger):
     return str(sid) + '-' + str(rid)
 
 
-def smb_sysvol_conn(server, lp, creds):
+# The backup workers connect from several threads with the same
+# credentials, whose signing state is changed for each connection.
+_smb_signing_lock = threading.Lock()
+
+
+def smb_sysvol_conn(server, lp, creds, multi_threaded=False):
     """Returns an SMB connection to the sysvol share on the DC"""
     # the SMB bindings rely on having a s3 loadparm
     s3_lp = s3param.get_context()
     s3_lp.load(lp.configfile)
 
-    # Force signing for the connection
-    saved_signing_state = creds.get_smb_signing()
-    creds.set_smb_signing(SMB_SIGNING_REQUIRED)
-    conn = libsmb.Conn(server, "sysvol", lp=s3_lp, creds=creds)
-    # Reset signing state
-    creds.set_smb_signing(saved_signing_state)
+    with _smb_signing_lock:
+        # Force signing for the connection
+        saved_signing_state = creds.get_smb_signing()
+        creds.set_smb_signing(SMB_SIGNING_REQUIRED)
+        try:
+            conn = libsmb.Conn(server, "sysvol", lp=s3_lp, creds=creds,
+                               multi_threaded=multi_threaded)
+        finally:
+            # Reset signing state
+            creds.set_smb_signing(saved_signing_state)
     return conn
 
 
@@ -277,7 +297,9 @@ class cmd_domain_backup_online(samba.netcmd.Command):
             logger.info("Backing up sysvol files (via SMB)...")
             sysvol_tar = os.path.join(tmpdir, 'sysvol.tar.gz')
             smb_conn = smb_sysvol_conn(server, lp, creds)
-            backup_online(smb_conn, sysvol_tar, remote_sam.get_domain_sid())
+            backup_online(smb_conn, sysvol_tar, remote_sam.get_domain_sid(),
+                          connect=lambda: smb_sysvol_conn(server, lp, creds,
+                                                          multi_threaded=True))
 
             # remove the default sysvol files created by the clone (we want to
             # make sure we restore the sysvol.tar.gz files instead)
@@ -901,7 +923,9 @@ class cmd_domain_backup_rename(samba.netcmd.Command):
         # for the new realm as part of the clone/join.
         sysvol_tar = os.path.join(tmpdir, 'sysvol.tar.gz')
         smb_conn = smb_sysvol_conn(server, lp, creds)
-        backup_online(smb_conn, sysvol_tar, remote_sam.get_domain_sid())
+        backup_online(smb_conn, sysvol_tar, remote_sam.get_domain_sid(),
+                      connect=lambda: smb_sysvol_conn(server, lp, creds,
+                                                      multi_threaded=True))
 
         # connect to the local DB (making sure we use the new/renamed config)
         lp.load(paths.smbconf)
@@ -941,6 +965,123 @@ class cmd_domain_backup_rename(samba.netcmd.Command):
         shutil.rmtree(tmpdir)
 
 
+def _offline_backup_sysvol(sysvol, sysvol_tar, smbconf, dom_sid_str):
+    """Back up the sysvol with its ntacls, in a worker process."""
+    backup_offline(sysvol, sysvol_tar, smbconf,
+                   security.dom_sid(dom_sid_str))
+
+
+class _HashingReader(object):
+    """Pass on reads from a file, keeping a checksum of the data."""
+
+    def __init__(self, f):
+        self.f = f
+        self.hash = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.hash.update(data)
+        return data
+
+
+def add_file_to_backup_tar(tar, path, arcname, manifest):
+    """Add a file to the tar, recording the size and checksum of a
+    regular file in the manifest dictionary as it is written."""
+    info = tar.gettarinfo(path, arcname)
+    if not info.isreg():
+        tar.addfile(info)
+        return
+    with open(path, 'rb') as f:
+        reader = _HashingReader(f)
+        tar.addfile(info, reader)
+    manifest[info.name] = {'size': info.size,
+                           'sha256': reader.hash.hexdigest()}
+
+
+def add_manifest_to_backup_tar(tar, manifest):
+    data = json.dumps({'version': BACKUP_MANIFEST_VERSION,
+                       'files': manifest},
+                      sort_keys=True, indent=1).encode('utf-8')
+    info = tarfile.TarInfo(BACKUP_MANIFEST)
+    info.size = len(data)
+    info.mtime = time.time()
+    info.mode = 0o644
+    tar.addfile(info, io.BytesIO(data))
+
+
+def verify_backup_file(backup_file):
+    """Check the files in a backup tar against its manifest, reading the
+    tar as a stream without extracting it.
+
+    Returns the number of files in the manifest, and a list of
+    problems.
+    """
+    manifest = None
+    found = {}
+    with tarfile.open(backup_file, 'r|*') as tar:
+        for member in tar:
+            if not member.isreg():
+                continue
+            f = tar.extractfile(member)
+            if member.name == BACKUP_MANIFEST:
+                manifest = json.loads(f.read().decode('utf-8'))
+                continue
+            h = hashlib.sha256()
+            size = 0
+            while True:
+                data = f.read(BACKUP_CHUNK_SIZE)
+                if not data:
+                    break
+                h.update(data)
+                size += len(data)
+            found[member.name] = {'size': size, 'sha256': h.hexdigest()}
+
+    if manifest is None:
+        raise CommandError('%s has no %s (only offline backups have one)' %
+                           (backup_file, BACKUP_MANIFEST))
+    if manifest.get('version') != BACKUP_MANIFEST_VERSION:
+        raise CommandError('Unknown backup manifest version %s' %
+                           manifest.get('version'))
+
+    problems = []
+    expected = manifest['files']
+    for name in sorted(expected):
+        if name not in found:
+            problems.append('%s is missing' % name)
+        elif found[name]['size'] != expected[name]['size']:
+            problems.append('%s is %d bytes, not %d' %
+                            (name, found[name]['size'],
+                             expected[name]['size']))
+        elif found[name]['sha256'] != expected[name]['sha256']:
+            problems.append('%s has the wrong checksum' % name)
+    for name in sorted(set(found) - set(expected)):
+        problems.append('%s is not in the manifest' % name)
+    return len(expected), problems
+
+
+def _offline_backup_file(method, path, backup_path):
+    """Copy a database for an offline backup, in a worker process.
+
+    'tdb' copies a tdb file under a read lock, for files that the parent
+    process holds a transaction (or read lock) on. 'tdb-transaction'
+    holds a transaction on the file during the copy instead. 'mdb' uses
+    mdb_copy, and 'file' makes a plain copy.
+    """
+    if method == 'mdb':
+        mdb_copy(path, backup_path)
+    elif method == 'file':
+        shutil.copyfile(path, backup_path)
+    else:
+        try:
+            tdb_backup(path, backup_path,
+                       readonly=(method != 'tdb-transaction'))
+        except OSError as e:
+            # If the DB can't be opened with EINVAL, it's a mutex
+            # locked database, which we can safely ignore.
+            if e.errno != errno.EINVAL:
+                raise
+
+
 class cmd_domain_backup_offline(samba.netcmd.Command):
     '''Backup the local domain directories safely into a tar file.
 
@@ -964,31 +1105,31 @@ class cmd_domain_backup_offline(samba.netcmd.Command):
         Option("--targetdir",
                help="Output directory (required)",
                type=str),
+        Option("--jobs", type=int,
+               help="Number of databases to copy at once "
+               "(default: the number of CPUs)"),
+        Option("--compress-level", type=int,
+               help="bzip2 compression level, from 1 (fastest) to 9 "
+               "(smallest, the default)"),
+        Option("--no-compress", action="store_true", default=False,
+               help="Write an uncompressed .tar file"),
     ]
 
     backup_ext = '.bak-offline'
 
-    def offline_tdb_copy(self, path):
-        backup_path = path + self.backup_ext
-        try:
-            tdb_copy(path, backup_path, readonly=True)
-        except CalledProcessError as copy_err:
-            # If the copy didn't work, check if it was caused by an EINVAL
-            # error on opening the DB.  If so, it's a mutex locked database,
-            # which we can safely ignore.
-            try:
-                tdb.open(path)
-            except Exception as e:
-                if hasattr(e, 'errno') and e.errno == errno.EINVAL:
-                    return
-                raise e
-            raise copy_err
-        if not os.path.exists(backup_path):
-            s = "tdbbackup said backup succeeded but {0} not found"
-            raise CommandError(s.format(backup_path))
-
-    def offline_mdb_copy(self, path):
-        mdb_copy(path, path + self.backup_ext)
+    # Start copying a file in a worker process, with one of the
+    # methods of _offline_backup_file().
+    def start_copy(self, method, path):
+        r = self.pool.apply_async(_offline_backup_file,
+                                  (method, path, path + self.backup_ext))
+        self.pending.append(r)
+
+    # Wait for all the copies to finish, raising the first error.
+    def wait_for_copies(self):
+        pending = self.pending
+        self.pending = []
+        for r in pending:
+            r.get()
 
     # Secrets databases are a special case: a transaction must be started
     # on the secrets.ldb file before backing up that file and secrets.tdb
@@ -998,9 +1139,12 @@ class cmd_domain_backup_offline(samba.netcmd.Command):
                           flags=ldb.FLG_DONT_CREATE_DB)
         logger.info('Starting transaction on ' + secrets_path)
         secrets_obj.transaction_start()
-        self.offline_tdb_copy(secrets_path + '.ldb')
-        self.offline_tdb_copy(secrets_path + '.tdb')
-        secrets_obj.transaction_cancel()
+        try:
+            self.start_copy('tdb', secrets_path + '.ldb')
+            self.start_copy('tdb', secrets_path + '.tdb')
+            self.wait_for_copies()
+        finally:
+            secrets_obj.transaction_cancel()
 
     # sam.ldb must have a transaction started on it before backing up
     # everything in sam.ldb.d with the appropriate backup function.
@@ -1021,10 +1165,10 @@ class cmd_domain_backup_offline(samba.netcmd.Command):
         # of the transaction.
         res_iterator = None
 
-        copy_function = None
+        copy_method = None
         if mdb_backend:
             logger.info('MDB backend detected.  Using mdb backup function.')
-            copy_function = self.offline_mdb_copy
+            copy_method = 'mdb'
 
             # We can't backup with a write transaction open, so get a
             # read lock with a search_iterator().
@@ -1037,33 +1181,98 @@ class cmd_domain_backup_offline(samba.netcmd.Command):
             res_iterator = samdb.search_iterator()
         else:
             logger.info('Starting transaction on ' + sam_ldb_path)
-            copy_function = self.offline_tdb_copy
+            copy_method = 'tdb'
             samdb.transaction_start()
 
-        logger.info('   backing up ' + sam_ldb_path)
-        self.offline_tdb_copy(sam_ldb_path)
-        sam_ldb_d = sam_ldb_path + '.d'
-        for sam_file in os.listdir(sam_ldb_d):
-            sam_file = os.path.join(sam_ldb_d, sam_file)
-            if sam_file.endswith('.ldb'):
-                logger.info('   backing up locked/related file ' + sam_file)
-                copy_function(sam_file)
-            elif sam_file.endswith('.tdb'):
-                logger.info('   tdbbackup of locked/related file ' + sam_file)
-                self.offline_tdb_copy(sam_file)
+        # All the partitions are copied at once, so the lock is only
+        # held for as long as the biggest one takes.
+        try:
+            logger.info('   backing up ' + sam_ldb_path)
+            self.start_copy('tdb', sam_ldb_path)
+            sam_ldb_d = sam_ldb_path + '.d'
+            for sam_file in os.listdir(sam_ldb_d):
+                sam_file = os.path.join(sam_ldb_d, sam_file)
+                if sam_file.endswith('.ldb'):
+                    logger.info('   backing up locked/related file ' + sam_file)
+                    self.start_copy(copy_method, sam_file)
+                elif sam_file.endswith('.tdb'):
+                    logger.info('   tdb backup of locked/related file ' +
+                                sam_file)
+                    self.start_copy('tdb', sam_file)
+                else:
+                    logger.info('   copying locked/related file ' + sam_file)
+                    self.start_copy('file', sam_file)
+
+            sid = get_sid_for_restore(samdb, logger)
+
+            self.wait_for_copies()
+        finally:
+            if mdb_backend:
+                # Delete the iterator, release the read lock
+                del(res_iterator)
             else:
-                logger.info('   copying locked/related file ' + sam_file)
-                shutil.copyfile(sam_file, sam_file + self.backup_ext)
+                samdb.transaction_cancel()
 
-        sid = get_sid_for_restore(samdb, logger)
+        return sid
 
-        if mdb_backend:
-            # Delete the iterator, release the read lock
-            del(res_iterator)
-        else:
-            samdb.transaction_cancel()
+    # Back up sam.ldb, secrets and all the other databases, returning
+    # the backup date. The sysvol backup is started in the background,
+    # as soon as we know the domain SID.
+    def backup_dbs(self, paths, lp, all_files, sysvol_tar, logger):
+        # We would prefer to open with FLG_RDONLY but then we can't
+        # start a transaction which is the strong isolation we want
+        # for the backup.
+        samdb = SamDB(url=paths.samdb, session_info=system_session(), lp=lp,
+                      flags=ldb.FLG_DONT_CREATE_DB)
 
-        return sid
+        # Get the domain SID for the sysvol ntacls
+        dom_sid_str = samdb.get_domain_sid()
+        logger.info('running offline ntacl backup of sysvol')
+        self.sysvol_result = self.sysvol_pool.apply_async(
+            _offline_backup_sysvol,
+            (paths.sysvol, sysvol_tar, paths.smbconf, dom_sid_str))
+
+        # Backup secrets, sam.ldb and their downstream files
+        self.backup_secrets(paths.private_dir, lp, logger)
+        sid = self.backup_smb_dbs(paths.private_dir, samdb, lp, logger)
+
+        # Close the original samdb, to avoid any confusion, we will
+        # not use this any more as the data has all been copied under
+        # the transaction
+        samdb = None
+
+        # Open the new backed up samdb, flag it as backed up, and write
+        # the next SID so the restore tool can add objects. We use
+        # options=["modules:"] here to prevent any modules from loading.
+        # WARNING: Don't change this code unless you know what you're doing.
+        #          Writing to a .bak file only works because the DN being
+        #          written to happens to be top level.
+        samdb = Ldb(url=paths.samdb + self.backup_ext,
+                      session_info=system_session(), lp=lp,
+                      options=["modules:"], flags=ldb.FLG_DONT_CREATE_DB)
+        time_str = get_timestamp()
+        add_backup_marker(samdb, "backupDate", time_str)
+        add_backup_marker(samdb, "sidForRestore", sid)
+        add_backup_marker(samdb, "backupType", "offline")
+
+        # Close the backed up samdb
+        samdb = None
+
+        # Now handle all the LDB and TDB files that are not linked to
+        # anything else.  The LDBs are copied under a transaction on
+        # the file, which is all an LDB transaction would be.
+        for path in all_files:
+            if not os.path.exists(path + self.backup_ext):
+                if path.endswith('.ldb'):
+                    logger.info('backing up solo db under a transaction: ' +
+                                path)
+                    self.start_copy('tdb-transaction', path)
+                elif path.endswith('.tdb'):
+                    logger.info('backing up lone tdb file ' + path)
+                    self.start_copy('tdb', path)
+        self.wait_for_copies()
+
+        return time_str
 
     # Find where a path should go in the fixed backup archive structure.
     def get_arc_path(self, path, conf_paths):
@@ -1082,7 +1291,8 @@ class cmd_domain_backup_offline(samba.netcmd.Command):
 
         return arc_path
 
-    def run(self, sambaopts=None, targetdir=None):
+    def run(self, sambaopts=None, targetdir=None, jobs=None,
+            compress_level=None, no_compress=False):
 
         logger = logging.getLogger()
         logger.setLevel(logging.DEBUG)
@@ -1141,102 +1351,139 @@ class cmd_domain_backup_offline(samba.netcmd.Command):
 
                     all_files.append(full_path)
 
-        # We would prefer to open with FLG_RDONLY but then we can't
-        # start a transaction which is the strong isolation we want
-        # for the backup.
-        samdb = SamDB(url=paths.samdb, session_info=system_session(), lp=lp,
-                      flags=ldb.FLG_DONT_CREATE_DB)
-
-        # Backup secrets, sam.ldb and their downstream files
-        self.backup_secrets(paths.private_dir, lp, logger)
-        sid = self.backup_smb_dbs(paths.private_dir, samdb, lp, logger)
-
-        # Get the domain SID so we can later place it in the backup
-        dom_sid_str = samdb.get_domain_sid()
-        dom_sid = security.dom_sid(dom_sid_str)
-
-        # Close the original samdb, to avoid any confusion, we will
-        # not use this any more as the data has all been copied under
-        # the transaction
-        samdb = None
+        if compress_level is not None and not 1 <= compress_level <= 9:
+            raise CommandError('--compress-level must be from 1 to 9')
 
-        # Open the new backed up samdb, flag it as backed up, and write
-        # the next SID so the restore tool can add objects. We use
-        # options=["modules:"] here to prevent any modules from loading.
-        # WARNING: Don't change this code unless you know what you're doing.
-        #          Writing to a .bak file only works because the DN being
-        #          written to happens to be top level.
-        samdb = Ldb(url=paths.samdb + self.backup_ext,
-                      session_info=system_session(), lp=lp,
-                      options=["modules:"], flags=ldb.FLG_DONT_CREATE_DB)
-        time_str = get_timestamp()
-        add_backup_marker(samdb, "backupDate", time_str)
-        add_backup_marker(samdb, "sidForRestore", sid)
-        add_backup_marker(samdb, "backupType", "offline")
-
-        # Close the backed up samdb
-        samdb = None
-
-        # Now handle all the LDB and TDB files that are not linked to
-        # anything else.  Use transactions for LDBs.
-        for path in all_files:
-            if not os.path.exists(path + self.backup_ext):
-                if path.endswith('.ldb'):
-                    logger.info('Starting transaction on solo db: ' + path)
-                    ldb_obj = Ldb(path, lp=lp, flags=ldb.FLG_DONT_CREATE_DB)
-                    ldb_obj.transaction_start()
-                    logger.info('   running tdbbackup on the same file')
-                    self.offline_tdb_copy(path)
-                    ldb_obj.transaction_cancel()
-                elif path.endswith('.tdb'):
-                    logger.info('running tdbbackup on lone tdb file ' + path)
-                    self.offline_tdb_copy(path)
-
-        # Now make the backup tar file and add all
-        # backed up files and any other files to it.
         temp_tar_dir = tempfile.mkdtemp(dir=targetdir,
                                         prefix='INCOMPLETEsambabackupfile')
-        temp_tar_name = os.path.join(temp_tar_dir, "samba-backup.tar.bz2")
-        tar = tarfile.open(temp_tar_name, 'w:bz2')
+        if no_compress:
+            tar_ext = '.tar'
+            tar = tarfile.open(os.path.join(temp_tar_dir,
+                                            "samba-backup" + tar_ext), 'w')
+        else:
+            tar_ext = '.tar.bz2'
+            if compress_level is None:
+                compress_level = 9
+            tar = tarfile.open(os.path.join(temp_tar_dir,
+                                            "samba-backup" + tar_ext),
+                               'w:bz2', compresslevel=compress_level)
+        temp_tar_name = tar.name
+        manifest = {}
 
-        logger.info('running offline ntacl backup of sysvol')
         sysvol_tar_fn = 'sysvol.tar.gz'
         sysvol_tar = os.path.join(temp_tar_dir, sysvol_tar_fn)
-        backup_offline(paths.sysvol, sysvol_tar, paths.smbconf, dom_sid)
-        tar.add(sysvol_tar, sysvol_tar_fn)
+
+        # Files that aren't databases don't need locking or copying, so
+        # they are added to the tar (and compressed) in a thread while the
+        # databases are copied.
+        sam_ldb_d = os.path.join(paths.private_dir, 'sam.ldb.d') + os.sep
+        misc_files = [path for path in all_files
+                      if not (path.endswith('.ldb') or path.endswith('.tdb') or
+                              path.startswith(sam_ldb_d))]
+
+        def add_misc_files():
+            for path in misc_files:
+                arc_path = self.get_arc_path(path, paths)
+                logger.info('   adding misc file ' + arc_path)
+                add_file_to_backup_tar(tar, path, arc_path, manifest)
+
+        # The databases and the sysvol are copied by worker processes.
+        # tdb won't open a file twice in one process (or in a child that
+        # inherited it), so the workers are forked before we open any
+        # databases. The sysvol backup opens (and keeps open) sam.ldb,
+        # idmap.ldb and secrets through passdb, so it has a worker of
+        # its own, which must never copy a tdb afterwards.
+        if jobs is None:
+            jobs = multiprocessing.cpu_count()
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(max(1, jobs)) as self.pool, \
+             ctx.Pool(1) as self.sysvol_pool, \
+             ThreadPoolExecutor(max_workers=1) as tar_thread:
+            misc_result = tar_thread.submit(add_misc_files)
+            self.pending = []
+            time_str = self.backup_dbs(paths, lp, all_files, sysvol_tar,
+                                       logger)
+            self.sysvol_result.get()
+            misc_result.result()
+        self.pool = None
+        self.sysvol_pool = None
+
+        logger.info('building backup tar')
+        add_file_to_backup_tar(tar, sysvol_tar, sysvol_tar_fn, manifest)
         os.remove(sysvol_tar)
 
         create_log_file(temp_tar_dir, lp, "offline", "localhost", True)
         backup_fn = os.path.join(temp_tar_dir, "backup.txt")
-        tar.add(backup_fn, os.path.basename(backup_fn))
+        add_file_to_backup_tar(tar, backup_fn, os.path.basename(backup_fn),
+                               manifest)
         os.remove(backup_fn)
 
-        logger.info('building backup tar')
+        misc_files = set(misc_files)
         for path in all_files:
+            if path in misc_files:
+                continue
             arc_path = self.get_arc_path(path, paths)
 
             if os.path.exists(path + self.backup_ext):
                 logger.info('   adding backup ' + arc_path + self.backup_ext +
                             ' to tar and deleting file')
-                tar.add(path + self.backup_ext, arcname=arc_path)
+                add_file_to_backup_tar(tar, path + self.backup_ext, arc_path,
+                                       manifest)
                 os.remove(path + self.backup_ext)
             elif path.endswith('.ldb') or path.endswith('.tdb'):
                 logger.info('   skipping ' + arc_path)
             else:
                 logger.info('   adding misc file ' + arc_path)
-                tar.add(path, arcname=arc_path)
+                add_file_to_backup_tar(tar, path, arc_path, manifest)
 
+        # The manifest lets the backup be checked with
+        # 'samba-tool domain backup verify'.
+        add_manifest_to_backup_tar(tar, manifest)
         tar.close()
         os.rename(temp_tar_name,
                   os.path.join(targetdir,
-                               'samba-backup-{0}.tar.bz2'.format(time_str)))
+                               'samba-backup-{0}{1}'.format(time_str,
+                                                            tar_ext)))
         os.rmdir(temp_tar_dir)
         logger.info('Backup succeeded.')
 
 
+class cmd_domain_backup_verify(samba.netcmd.Command):
+    '''Check an offline backup file against its manifest.
+
+    The offline backup records the size and checksum of every file it
+    contains. This reads through the backup file without extracting it and
+    checks that all the files are present and unchanged.'''
+
+    synopsis = "%prog --backup-file=<tar-file>"
+
+    takes_options = [
+        Option("--backup-file", help="Path to backup file", type=str),
+    ]
+
+    def run(self, backup_file=None):
+        if backup_file is None:
+            raise CommandError('Backup file not specified')
+        if not os.path.isfile(backup_file):
+            raise CommandError('Backup file %s not found' % backup_file)
+
+        try:
+            count, problems = verify_backup_file(backup_file)
+        except (tarfile.TarError, EOFError, OSError, ValueError) as e:
+            raise CommandError('Could not read %s: %s' % (backup_file, e))
+
+        for problem in problems:
+            self.errf.write(problem + '\n')
+        if problems:
+            raise CommandError('%s failed verification (%d problems)' %
+                               (backup_file, len(problems)))
+        self.outf.write('%s: all %d files verified\n' % (backup_file, count))
+
+
 class cmd_domain_backup(samba.netcmd.SuperCommand):
     '''Create or restore a backup of the domain.'''
     subcommands = {'offline': cmd_domain_backup_offline(),
                    'online': cmd_domain_backup_online(),
                    'rename': cmd_domain_backup_rename(),
-                   'restore': cmd_domain_backup_restore()}
+                   'restore': cmd_domain_backup_restore(),
+                   'verify': cmd_domain_backup_verify()}
@@ -24,6 +24,7 @@ import ldb
 import logging
 from . import common
 import json
+import time
 
 from samba.auth import system_session
 from samba.netcmd import (
@@ -41,10 +42,20 @@ from samba import colour
 
 from samba.uptodateness import (
     get_partition_maps,
-    get_utdv_edges,
     get_utdv_distances,
     get_utdv_summary,
     get_kcc_and_dsas,
+    UtdvCollector,
+    DEFAULT_JOBS,
+    DEFAULT_TIMEOUT,
+)
+from samba.repl_status import (
+    drs_errmsg,
+    drs_parse_ntds_dn,
+    get_dsa_guids,
+    get_neighbours,
+    is_failing,
+    ReplStatusCollector,
 )
 from samba.common import get_string
 from samba.samdb import get_default_backend_store
@@ -67,24 +78,6 @@ def samdb_connect(ctx):
         raise CommandError("LDAP connection to %s failed" % ctx.server, e)
 
 
-def drs_errmsg(werr):
-    '''return "was successful" or an error string'''
-    (ecode, estring) = werr
-    if ecode == 0:
-        return "was successful"
-    return "failed, result %u (%s)" % (ecode, estring)
-
-
-def drs_parse_ntds_dn(ntds_dn):
-    '''parse a NTDS DN returning a site and server'''
-    a = ntds_dn.split(',')
-    if a[0] != "CN=NTDS Settings" or a[2] != "CN=Servers" or a[4] != 'CN=Sites':
-        raise RuntimeError("bad NTDS DN %s" % ntds_dn)
-    server = a[1].split('=')[1]
-    site   = a[3].split('=')[1]
-    return (site, server)
-
-
 DEFAULT_SHOWREPL_FORMAT = 'classic'
 
 
@@ -119,41 +112,23 @@ class cmd_drs_showrepl(Command):
         Option("-v", "--verbose", help="Be verbose", action="store_true"),
         Option("--color", help="Use colour output (yes|no|auto)",
                default='no'),
+        Option("--all-dcs", action='store_true', dest='all_dcs',
+               help=("show the inbound and outbound neighbours of every DC "
+                     "in the forest, as found by the given DC")),
+        Option("--jobs", type=int, default=DEFAULT_JOBS,
+               help="With --all-dcs, query this many DCs at once "
+               "(default %d)" % DEFAULT_JOBS),
+        Option("--timeout", type=int, default=DEFAULT_TIMEOUT,
+               help="With --all-dcs, give up on a DC after this many "
+               "seconds (default %d)" % DEFAULT_TIMEOUT),
+        Option("--watch", type=int, metavar="SECONDS",
+               help=("With --all-dcs, keep the connections open and show "
+                     "fresh data every SECONDS (with --json, one snapshot "
+                     "per line)")),
     ]
 
     takes_args = ["DC?"]
 
-    def parse_neighbour(self, n):
-        """Convert an ldb neighbour object into a python dictionary"""
-        dsa_objectguid = str(n.source_dsa_obj_guid)
-        d = {
-            'NC dn': n.naming_context_dn,
-            "DSA objectGUID": dsa_objectguid,
-            "last attempt time": nttime2string(n.last_attempt),
-            "last attempt message": drs_errmsg(n.result_last_attempt),
-            "consecutive failures": n.consecutive_sync_failures,
-            "last success": nttime2string(n.last_success),
-            "NTDS DN": str(n.source_dsa_obj_dn),
-            'is deleted': False
-        }
-
-        try:
-            self.samdb.search(base="<GUID=%s>" % dsa_objectguid,
-                              scope=ldb.SCOPE_BASE,
-                              attrs=[])
-        except ldb.LdbError as e:
-            (errno, _) = e.args
-            if errno == ldb.ERR_NO_SUCH_OBJECT:
-                d['is deleted'] = True
-            else:
-                raise
-        try:
-            (site, server) = drs_parse_ntds_dn(n.source_dsa_obj_dn)
-            d["DSA"] = "%s\\%s" % (site, server)
-        except RuntimeError:
-            pass
-        return d
-
     def print_neighbour(self, d):
         '''print one set of neighbour information'''
         self.message("%s" % d['NC dn'])
@@ -170,21 +145,19 @@ class cmd_drs_showrepl(Command):
         self.message("")
 
     def get_neighbours(self, info_type):
-        req1 = drsuapi.DsReplicaGetInfoRequest1()
-        req1.info_type = info_type
+        if self.dsa_guids is None:
+            self.dsa_guids = get_dsa_guids(self.samdb)
         try:
-            (info_type, info) = self.drsuapi.DsReplicaGetInfo(
-                self.drsuapi_handle, 1, req1)
+            return get_neighbours(self.drsuapi, self.drsuapi_handle,
+                                  info_type, self.dsa_guids)
         except Exception as e:
             raise CommandError("DsReplicaGetInfo of type %u failed" % info_type, e)
 
-        reps = [self.parse_neighbour(n) for n in info.array]
-        return reps
-
     def run(self, DC=None, sambaopts=None,
             credopts=None, versionopts=None,
             format=DEFAULT_SHOWREPL_FORMAT,
-            verbose=False, color='no'):
+            verbose=False, color='no', all_dcs=False,
+            jobs=DEFAULT_JOBS, timeout=DEFAULT_TIMEOUT, watch=None):
         self.apply_colour_choice(color)
         self.lp = sambaopts.get_loadparm()
         if DC is None:
@@ -192,6 +165,12 @@ class cmd_drs_showrepl(Command):
         self.server = DC
         self.creds = credopts.get_credentials(self.lp, fallback_machine=True)
         self.verbose = verbose
+        self.dsa_guids = None
+
+        if all_dcs:
+            return self.forest_output(format, jobs, timeout, watch)
+        if watch is not None:
+            raise CommandError("--watch only works with --all-dcs")
 
         output_function = {
             'summary': self.summary_output,
@@ -205,33 +184,93 @@ class cmd_drs_showrepl(Command):
 
         return output_function()
 
+    def forest_output(self, format, jobs, timeout, watch):
+        """Show the replication status of every DC, found via the
+        configuration NC of the given one, optionally repeating every
+        `watch` seconds. The DCs are queried concurrently, and the
+        connections are kept open between rounds."""
+        if format not in ('json', 'classic', 'summary', 'pull_summary',
+                          'notify_summary'):
+            raise CommandError("unknown showrepl format %s" % format)
+        if watch is not None and watch < 1:
+            raise CommandError("--watch needs a positive number of seconds")
+
+        samdb_connect(self)
+        with ReplStatusCollector(self.samdb, self.lp, self.creds,
+                                 jobs=jobs, timeout=timeout) as collector:
+            while True:
+                start = time.time()
+                snapshot = collector.collect()
+                if format == 'json':
+                    if watch is None:
+                        json.dump(snapshot, self.outf, indent=2)
+                    else:
+                        # one snapshot per line
+                        json.dump(snapshot, self.outf)
+                        self.outf.write('\n')
+                    failures = 0
+                else:
+                    failures = self.forest_summary_output(snapshot, format)
+
+                if watch is None:
+                    return 1 if failures else None
+                self.outf.flush()
+                try:
+                    time.sleep(max(0, start + watch - time.time()))
+                except KeyboardInterrupt:
+                    return
+
+    def forest_summary_output(self, snapshot, typeof_output):
+        """Print a line for each DC, with the details of any links that
+        seem broken, returning the number of unhappy DCs."""
+        unhappy = 0
+        self.message("==== %s ====" % snapshot['time'])
+        for name, data in sorted(snapshot['servers'].items()):
+            if 'error' in data:
+                unhappy += 1
+                self.message(colour.c_RED("%s unreachable: %s" %
+                                          (name, data['error'])))
+                continue
+            failing_repsto, failing_repsfrom = \
+                self.failing_neighbours(data, typeof_output)
+            if not (failing_repsto or failing_repsfrom):
+                self.message("%s %s" % (name, colour.c_GREEN("[ALL GOOD]")))
+                continue
+            unhappy += 1
+            self.message("%s %s" % (name, colour.c_RED(
+                "There are failing connections")))
+            if failing_repsto:
+                self.message(colour.c_RED("Failing outbound connections:"))
+                for rep in failing_repsto:
+                    self.print_neighbour(rep)
+            if failing_repsfrom:
+                self.message(colour.c_RED("Failing inbound connection:"))
+                for rep in failing_repsfrom:
+                    self.print_neighbour(rep)
+        return unhappy
+
     def json_output(self):
         data = self.get_local_repl_data()
         del data['site']
         del data['server']
         json.dump(data, self.outf, indent=2)
 
-    def summary_output_handler(self, typeof_output):
-        """Print a short message if every seems fine, but print details of any
-        links that seem broken."""
+    def failing_neighbours(self, data, typeof_output):
         failing_repsto = []
         failing_repsfrom = []
-
-        local_data = self.get_local_repl_data()
-
         if typeof_output != "pull_summary":
-            for rep in local_data['repsTo']:
-                if rep['is deleted']:
-                    continue
-                if rep["consecutive failures"] != 0 or rep["last success"] == 0:
-                    failing_repsto.append(rep)
-
+            failing_repsto = [rep for rep in data['repsTo'] if is_failing(rep)]
         if typeof_output != "notify_summary":
-            for rep in local_data['repsFrom']:
-                if rep['is deleted']:
-                    continue
-                if rep["consecutive failures"] != 0 or rep["last success"] == 0:
-                    failing_repsfrom.append(rep)
+            failing_repsfrom = [rep for rep in data['repsFrom']
+                                if is_failing(rep)]
+        return failing_repsto, failing_repsfrom
+
+    def summary_output_handler(self, typeof_output):
+        """Print a short message if every seems fine, but print details of any
+        links that seem broken."""
+        local_data = self.get_local_repl_data()
+        failing_repsto, failing_repsfrom = \
+            self.failing_neighbours(local_data, typeof_output)
 
         if failing_repsto or failing_repsfrom:
             self.message(colour.c_RED("There are failing connections"))
@@ -806,6 +845,15 @@ class cmd_drs_uptodateness(Command):
                help="Print median out-of-date-ness only"),
         Option("--full", action='store_true',
                help="Print full out-of-date-ness data"),
+        Option("--jobs", type=int, default=DEFAULT_JOBS,
+               help="Query this many DCs at once (default %d)" %
+               DEFAULT_JOBS),
+        Option("--timeout", type=int, default=DEFAULT_TIMEOUT,
+               help="Give up on a DC after this many seconds "
+               "(default %d)" % DEFAULT_TIMEOUT),
+        Option("--watch", type=int, metavar="SECONDS",
+               help="Keep the connections open and print fresh data "
+               "every SECONDS"),
     ]
 
     def format_as_json(self, partitions_summaries):
@@ -821,6 +869,7 @@ class cmd_drs_uptodateness(Command):
 
     def run(self, H=None, partition=None,
             json=False, maximum=False, median=False, full=False,
+            jobs=DEFAULT_JOBS, timeout=DEFAULT_TIMEOUT, watch=None,
             sambaopts=None, credopts=None, versionopts=None,
             quiet=False, verbose=False):
 
@@ -837,31 +886,48 @@ class cmd_drs_uptodateness(Command):
             else:
                 raise CommandError("unknown partition %s" % partition)
 
+        if watch is not None and watch < 1:
+            raise CommandError("--watch needs a positive number of seconds")
+
         filters = []
         if maximum:
             filters.append('maximum')
         if median:
             filters.append('median')
 
-        partitions_distances = {}
-        partitions_summaries = {}
-        for part_name, part_dn in short_partitions.items():
-            utdv_edges = get_utdv_edges(local_kcc, dsas, part_dn, lp, creds)
-            distances = get_utdv_distances(utdv_edges, dsas)
-            summary = get_utdv_summary(distances, filters=filters)
-            partitions_distances[part_name] = distances
-            partitions_summaries[part_name] = summary
-
-        if full:
-            # always print json format
-            output = self.format_as_json(partitions_distances)
-        else:
-            if json:
-                output = self.format_as_json(partitions_summaries)
-            else:
-                output = self.format_as_text(partitions_summaries)
-
-        print(output, file=self.outf)
+        with UtdvCollector(local_kcc, dsas, lp, creds,
+                           jobs=jobs, timeout=timeout) as collector:
+            while True:
+                start = time.time()
+                all_edges = collector.collect(short_partitions.values())
+
+                partitions_distances = {}
+                partitions_summaries = {}
+                for part_name, part_dn in short_partitions.items():
+                    utdv_edges = all_edges[part_dn]
+                    distances = get_utdv_distances(utdv_edges, dsas)
+                    summary = get_utdv_summary(distances, filters=filters)
+                    partitions_distances[part_name] = distances
+                    partitions_summaries[part_name] = summary
+
+                if full:
+                    # always print json format
+                    output = self.format_as_json(partitions_distances)
+                else:
+                    if json:
+                        output = self.format_as_json(partitions_summaries)
+                    else:
+                        output = self.format_as_text(partitions_summaries)
+
+                print(output, file=self.outf)
+
+                if watch is None:
+                    break
+                self.outf.flush()
+                try:
+                    time.sleep(max(0, start + watch - time.time()))
+                except KeyboardInterrupt:
+                    break
 
 
 class cmd_drs(SuperCommand):
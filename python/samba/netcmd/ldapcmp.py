@@ -24,6 +24,8 @@
 import os
 import re
 import sys
+import hashlib
+import multiprocessing
 
 import samba
 import samba.getopt as options
@@ -39,6 +41,143 @@ from samba.netcmd import (
 
 RE_RANGED_RESULT = re.compile(r"^([^;]+);range=(\d+)-(\d+|\*)$")
 
+# One domain - two domain controllers
+#
+# Some attributes are defined as FLAG_ATTR_NOT_REPLICATED
+#
+# The following list was generated by
+# egrep '^systemFlags: |^ldapDisplayName: |^linkID: ' \
+#       source4/setup/ad-schema/MS-AD_Schema_2K8_R2_Attributes.txt | \
+#       grep -B1 FLAG_ATTR_NOT_REPLICATED | \
+#       grep ldapDisplayName | \
+#       cut -d ' ' -f2
+NON_REPLICATED_ATTRIBUTES = [
+    "badPasswordTime",
+    "badPwdCount",
+    "dSCorePropagationData",
+    "lastLogoff",
+    "lastLogon",
+    "logonCount",
+    "modifiedCount",
+    "msDS-Cached-Membership",
+    "msDS-Cached-Membership-Time-Stamp",
+    "msDS-EnabledFeatureBL",
+    "msDS-ExecuteScriptPassword",
+    "msDS-NcType",
+    "msDS-ReplicationEpoch",
+    "msDS-RetiredReplNCSignatures",
+    "msDS-USNLastSyncSuccess",
+    # "distinguishedName", # This is implicitly replicated
+    # "objectGUID", # This is implicitly replicated
+    "partialAttributeDeletionList",
+    "partialAttributeSet",
+    "pekList",
+    "prefixMap",
+    "replPropertyMetaData",
+    "replUpToDateVector",
+    "repsFrom",
+    "repsTo",
+    "rIDNextRID",
+    "rIDPreviousAllocationPool",
+    "schemaUpdate",
+    "serverState",
+    "subRefs",
+    "uSNChanged",
+    "uSNCreated",
+    "uSNLastObjRem",
+    "whenChanged",  # This is implicitly replicated, but may diverge on updates of non-replicated attributes
+]
+
+# Two domains - two domain controllers
+TWO_DOMAIN_IGNORED_ATTRIBUTES = [
+    "objectCategory", "objectGUID", "objectSid", "whenCreated",
+    "whenChanged", "pwdLastSet", "uSNCreated", "creationTime",
+    "modifiedCount", "priorSetTime", "rIDManagerReference",
+    "gPLink", "ipsecNFAReference", "fRSPrimaryMember",
+    "fSMORoleOwner", "masteredBy", "ipsecOwnersReference",
+    "wellKnownObjects", "otherWellKnownObjects", "badPwdCount",
+    "ipsecISAKMPReference", "ipsecFilterReference",
+    "msDs-masteredBy", "lastSetTime",
+    "ipsecNegotiationPolicyReference", "subRefs", "gPCFileSysPath",
+    "accountExpires", "invocationId", "operatingSystemVersion",
+    "oEMInformation", "schemaInfo",
+    # After Exchange preps
+    "targetAddress", "msExchMailboxGuid", "siteFolderGUID"]
+
+
+def get_ignored_attributes(two_domains, filter_list):
+    """The upper-cased set of attributes that are not compared."""
+    ignore_attributes = NON_REPLICATED_ATTRIBUTES + ["msExchServer1HighestUSN"]
+    if filter_list:
+        ignore_attributes += filter_list
+    if two_domains:
+        ignore_attributes += TWO_DOMAIN_IGNORED_ATTRIBUTES
+    return set([x.upper() for x in ignore_attributes])
+
+
+def search_paged(ldb, base, scope, attrs, page_size):
+    """Yield the results of a search one page at a time, so that the
+    whole result set is never in memory at once."""
+    cookie = ""
+    while True:
+        ctrl = "paged_results:1:%d" % page_size
+        if cookie:
+            ctrl += ":" + cookie
+        res = ldb.search(base=base, scope=scope, attrs=attrs,
+                         controls=[ctrl])
+        for msg in res:
+            yield msg
+
+        cookie = ""
+        for c in res.controls or []:
+            c = str(c)
+            if c.startswith("paged_results"):
+                spl = c.rsplit(':', 3)
+                if len(spl) == 3:
+                    cookie = spl[-1]
+        if not cookie:
+            break
+
+
+def object_digest(msg, ignore_attributes, extra=b""):
+    """A hash of the compared attributes of an object, or None if the
+    object can't be judged by its hash (it has ranged attributes that
+    need more searches to be complete).
+
+    Attribute names are upper-cased and both names and values are
+    sorted, so objects that LDAPObject.cmp_attrs() would consider
+    identical without any fixing up have the same digest.
+    """
+    h = hashlib.sha256(extra)
+    for key in sorted(msg.keys(), key=str.upper):
+        name = key.upper()
+        if name == "DN" or name in ignore_attributes:
+            continue
+        if RE_RANGED_RESULT.match(key):
+            return None
+        vals = sorted(msg[key])
+        h.update(b"%d:%s" % (len(vals), name.encode('utf8')))
+        for v in vals:
+            h.update(b"%d:" % len(v))
+            h.update(v)
+    return h.digest()[:16]
+
+
+# The bundles hashed by the worker processes. Set by
+# _hash_worker_init() in the forked children, as neither loadparm
+# nor credentials objects can be pickled.
+_worker_bundles = None
+
+
+def _hash_worker_init(bundles):
+    global _worker_bundles
+    _worker_bundles = bundles
+
+
+def _hash_bundle(i, page_size):
+    return _worker_bundles[i].get_digests(page_size)
+
+
 
 class LDAPBase(object):
 
@@ -58,6 +197,10 @@ class LDAPBase(object):
             ldb_options = ["modules:paged_searches"]
         self.outf = outf
         self.errf = errf
+        # kept so that worker processes can make their own connections
+        self.samdb_url = samdb_url
+        self.creds = creds
+        self.lp = lp
         self.ldb = Ldb(url=samdb_url,
                        credentials=creds,
                        lp=lp,
@@ -215,7 +358,7 @@ class LDAPBase(object):
 
     def get_descriptor_sddl(self, object_dn):
         res = self.ldb.search(base=object_dn, scope=SCOPE_BASE, attrs=["nTSecurityDescriptor"])
-        desc = res[0]["nTSecurityDescriptor"][0]
+        desc = res[0]["nTSecurityDescriptor"].view(0)
         desc = ndr_unpack(security.descriptor, desc)
         return desc.as_sddl(self.domain_sid)
 
@@ -390,56 +533,8 @@ class LDAPObject(object):
         for x in self.con.server_names:
             self.dn = self.dn.replace("CN=${SERVER_NAME}", "CN=%s" % x)
         self.attributes = self.con.get_attributes(self.dn)
-        # One domain - two domain controllers
-        #
-        # Some attributes are defined as FLAG_ATTR_NOT_REPLICATED
-        #
-        # The following list was generated by
-        # egrep '^systemFlags: |^ldapDisplayName: |^linkID: ' \
-        #       source4/setup/ad-schema/MS-AD_Schema_2K8_R2_Attributes.txt | \
-        #       grep -B1 FLAG_ATTR_NOT_REPLICATED | \
-        #       grep ldapDisplayName | \
-        #       cut -d ' ' -f2
-        self.non_replicated_attributes = [
-                "badPasswordTime",
-                "badPwdCount",
-                "dSCorePropagationData",
-                "lastLogoff",
-                "lastLogon",
-                "logonCount",
-                "modifiedCount",
-                "msDS-Cached-Membership",
-                "msDS-Cached-Membership-Time-Stamp",
-                "msDS-EnabledFeatureBL",
-                "msDS-ExecuteScriptPassword",
-                "msDS-NcType",
-                "msDS-ReplicationEpoch",
-                "msDS-RetiredReplNCSignatures",
-                "msDS-USNLastSyncSuccess",
-                # "distinguishedName", # This is implicitly replicated
-                # "objectGUID", # This is implicitly replicated
-                "partialAttributeDeletionList",
-                "partialAttributeSet",
-                "pekList",
-                "prefixMap",
-                "replPropertyMetaData",
-                "replUpToDateVector",
-                "repsFrom",
-                "repsTo",
-                "rIDNextRID",
-                "rIDPreviousAllocationPool",
-                "schemaUpdate",
-                "serverState",
-                "subRefs",
-                "uSNChanged",
-                "uSNCreated",
-                "uSNLastObjRem",
-                "whenChanged",  # This is implicitly replicated, but may diverge on updates of non-replicated attributes
-        ]
-        self.ignore_attributes = self.non_replicated_attributes
-        self.ignore_attributes += ["msExchServer1HighestUSN"]
-        if filter_list:
-            self.ignore_attributes += filter_list
+        self.ignore_attributes = get_ignored_attributes(self.two_domains,
+                                                        filter_list)
 
         self.dn_attributes = []
         self.domain_attributes = []
@@ -449,20 +544,6 @@ class LDAPObject(object):
         # Two domains - two domain controllers
 
         if self.two_domains:
-            self.ignore_attributes += [
-                "objectCategory", "objectGUID", "objectSid", "whenCreated",
-                "whenChanged", "pwdLastSet", "uSNCreated", "creationTime",
-                "modifiedCount", "priorSetTime", "rIDManagerReference",
-                "gPLink", "ipsecNFAReference", "fRSPrimaryMember",
-                "fSMORoleOwner", "masteredBy", "ipsecOwnersReference",
-                "wellKnownObjects", "otherWellKnownObjects", "badPwdCount",
-                "ipsecISAKMPReference", "ipsecFilterReference",
-                "msDs-masteredBy", "lastSetTime",
-                "ipsecNegotiationPolicyReference", "subRefs", "gPCFileSysPath",
-                "accountExpires", "invocationId", "operatingSystemVersion",
-                "oEMInformation", "schemaInfo",
-                # After Exchange preps
-                "targetAddress", "msExchMailboxGuid", "siteFolderGUID"]
             #
             # Attributes that contain the unique DN tail part e.g. 'DC=samba,DC=org'
             self.dn_attributes = [
@@ -501,8 +582,6 @@ class LDAPObject(object):
             #
             self.other_attributes = ["name", "DC", ]
             self.other_attributes = [x.upper() for x in self.other_attributes]
-        #
-        self.ignore_attributes = set([x.upper() for x in self.ignore_attributes])
 
     def log(self, msg):
         """
@@ -674,7 +753,7 @@ class LDAPObject(object):
 class LDAPBundle(object):
 
     def __init__(self, connection, context, dn_list=None, filter_list=None,
-                 outf=sys.stdout, errf=sys.stderr):
+                 outf=sys.stdout, errf=sys.stderr, fast=False):
         self.outf = outf
         self.errf = errf
         self.con = connection
@@ -694,24 +773,31 @@ class LDAPBundle(object):
             self.dn_list = dn_list
         elif context.upper() in ["DOMAIN", "CONFIGURATION", "SCHEMA", "DNSDOMAIN", "DNSFOREST"]:
             self.context = context.upper()
-            self.dn_list = self.get_dn_list(context)
+            if fast:
+                # the DNs come with the hashes in get_digests()
+                self.set_search_base(context)
+                self.dn_list = []
+            else:
+                self.dn_list = self.get_dn_list(context)
         else:
             raise Exception("Unknown initialization data for LDAPBundle().")
-        counter = 0
-        while counter < len(self.dn_list) and self.two_domains:
-            # Use alias reference
-            tmp = self.dn_list[counter]
-            tmp = tmp[:len(tmp) - len(self.con.base_dn)] + "${DOMAIN_DN}"
-            tmp = tmp.replace("CN=%s" % self.con.domain_netbios, "CN=${DOMAIN_NETBIOS}")
-            if len(self.con.server_names) == 1:
-                for x in self.con.server_names:
-                    tmp = tmp.replace("CN=%s" % x, "CN=${SERVER_NAME}")
-            self.dn_list[counter] = tmp
-            counter += 1
+        self.dn_list = [self.alias_dn(dn) for dn in self.dn_list]
         self.dn_list = list(set(self.dn_list))
         self.dn_list = sorted(self.dn_list)
         self.size = len(self.dn_list)
 
+    def alias_dn(self, dn):
+        """Use alias references for the parts of the DN that differ
+        between two domains."""
+        if not self.two_domains:
+            return dn
+        tmp = dn[:len(dn) - len(self.con.base_dn)] + "${DOMAIN_DN}"
+        tmp = tmp.replace("CN=%s" % self.con.domain_netbios, "CN=${DOMAIN_NETBIOS}")
+        if len(self.con.server_names) == 1:
+            for x in self.con.server_names:
+                tmp = tmp.replace("CN=%s" % x, "CN=${SERVER_NAME}")
+        return tmp
+
     def log(self, msg):
         """
         Log on the screen if there is no --quiet option set
@@ -724,6 +810,83 @@ class LDAPBundle(object):
         self.dn_list = sorted(self.dn_list)
 
     def diff(self, other):
+        res, common_dns = self.diff_dn_lists(other)
+        if not self.diff_objects(other, common_dns):
+            res = False
+        return res
+
+    def diff_fast(self, other, page_size=1000):
+        """Compare the bundles by first hashing every object on both
+        sides, then only doing the full comparison of the objects
+        whose hashes differ.
+
+        The objects are fetched in pages with all the compared
+        attributes, rather than with a search per object, and the two
+        servers are read concurrently in separate processes (pyldb
+        holds the GIL, so threads would not help).
+        """
+        ctx = multiprocessing.get_context('fork')
+        pool = ctx.Pool(2, initializer=_hash_worker_init,
+                        initargs=((self, other),))
+        try:
+            r1 = pool.apply_async(_hash_bundle, (0, page_size))
+            r2 = pool.apply_async(_hash_bundle, (1, page_size))
+            digests1 = r1.get()
+            digests2 = r2.get()
+        finally:
+            pool.terminate()
+            pool.join()
+
+        self.dn_list = list(digests1.keys())
+        self.update_size()
+        other.dn_list = list(digests2.keys())
+        other.update_size()
+
+        res, common_dns = self.diff_dn_lists(other)
+
+        changed_dns = []
+        for dn in sorted(common_dns):
+            d1 = digests1[dn]
+            if d1 is None or d1 != digests2[dn]:
+                changed_dns.append(dn)
+
+        self.log("\n* Objects with identical hashes: %d" %
+                 (len(common_dns) - len(changed_dns)))
+        if not self.diff_objects(other, changed_dns):
+            res = False
+        return res
+
+    def get_digests(self, page_size):
+        """Return a dictionary mapping the upper-cased (and perhaps
+        aliased) DN of each object to object_digest() of its compared
+        attributes.
+
+        This makes a new connection, as it is run in a worker process.
+        """
+        con = self.con
+        ldb = Ldb(url=con.samdb_url, credentials=con.creds, lp=con.lp)
+        extra = b""
+        if con.descriptor:
+            attrs = ["nTSecurityDescriptor"]
+            ignore = set()
+            if self.two_domains:
+                # the SDDL depends on which SIDs are the domain's own
+                extra = str(con.domain_sid).encode('utf8')
+        else:
+            attrs = ["*"]
+            ignore = get_ignored_attributes(self.two_domains,
+                                            self.filter_list)
+
+        digests = {}
+        for msg in search_paged(ldb, self.search_base, self.search_scope,
+                                attrs, page_size):
+            dn = self.alias_dn(msg.dn.get_linearized()).upper()
+            digests[dn] = object_digest(msg, ignore, extra)
+        return digests
+
+    def diff_dn_lists(self, other):
+        """Compare the DN lists, returning a (success, common DNs)
+        tuple."""
         res = True
         if self.size != other.size:
             self.log("\n* DN lists have different size: %s != %s" % (self.size, other.size))
@@ -755,8 +918,13 @@ class LDAPBundle(object):
 
         common_dns = self_dns & other_dns
         self.log("\n* Objects to be compared: %d" % len(common_dns))
+        return res, common_dns
 
-        for dn in common_dns:
+    def diff_objects(self, other, dns):
+        """Compare the objects with the given DNs in detail, in DN order
+        so the report doesn't depend on how the DNs were collected."""
+        res = True
+        for dn in sorted(dns):
 
             try:
                 object1 = LDAPObject(connection=self.con,
@@ -796,9 +964,9 @@ class LDAPBundle(object):
 
         return res
 
-    def get_dn_list(self, context):
-        """ Query LDAP server about the DNs of certain naming self.con.ext Domain (or Default), Configuration, Schema.
-            Parse all DNs and filter those that are 'strange' or abnormal.
+    def set_search_base(self, context):
+        """Work out the search base and scope for a naming context:
+        Domain (or Default), Configuration, Schema, DNS zones.
         """
         if context.upper() == "DOMAIN":
             search_base = self.con.base_dn
@@ -811,7 +979,6 @@ class LDAPBundle(object):
         elif context.upper() == "DNSFOREST":
             search_base = "DC=ForestDnsZones,%s" % self.con.root_dn
 
-        dn_list = []
         if not self.search_base:
             self.search_base = search_base
         self.search_scope = self.search_scope.upper()
@@ -823,6 +990,13 @@ class LDAPBundle(object):
             self.search_scope = SCOPE_ONELEVEL
         else:
             raise ValueError("Wrong 'scope' given. Choose from: SUB, ONE, BASE")
+
+    def get_dn_list(self, context):
+        """ Query LDAP server about the DNs of certain naming self.con.ext Domain (or Default), Configuration, Schema.
+            Parse all DNs and filter those that are 'strange' or abnormal.
+        """
+        self.set_search_base(context)
+        dn_list = []
         try:
             res = self.con.ldb.search(base=self.search_base, scope=self.search_scope, attrs=["dn"])
         except LdbError as e3:
@@ -882,13 +1056,18 @@ class cmd_ldapcmp(Command):
                help="List of comma separated attributes to ignore in the comparision"),
         Option("--skip-missing-dn", dest="skip_missing_dn", action="store_true", default=False,
                help="Skip report and failure due to missing DNs in one server or another"),
+        Option("--fast", dest="fast", action="store_true", default=False,
+               help="Fetch both servers concurrently in pages and only fully compare objects whose hashes differ"),
+        Option("--page-size", dest="page_size", type=int, default=1000,
+               help="Number of objects to fetch per search with --fast (default 1000)"),
     ]
 
     def run(self, URL1, URL2,
             context1=None, context2=None, context3=None, context4=None, context5=None,
             two=False, quiet=False, verbose=False, descriptor=False, sort_aces=False,
             view="section", base="", base2="", scope="SUB", filter="",
-            credopts=None, sambaopts=None, versionopts=None, skip_missing_dn=False):
+            credopts=None, sambaopts=None, versionopts=None, skip_missing_dn=False,
+            fast=False, page_size=1000):
 
         lp = sambaopts.get_loadparm()
 
@@ -950,11 +1129,15 @@ class cmd_ldapcmp(Command):
                 self.outf.write("\n* Comparing [%s] context...\n" % context)
 
             b1 = LDAPBundle(con1, context=context, filter_list=filter_list,
-                            outf=self.outf, errf=self.errf)
+                            outf=self.outf, errf=self.errf, fast=fast)
             b2 = LDAPBundle(con2, context=context, filter_list=filter_list,
-                            outf=self.outf, errf=self.errf)
+                            outf=self.outf, errf=self.errf, fast=fast)
 
-            if b1.diff(b2):
+            if fast:
+                ok = b1.diff_fast(b2, page_size=page_size)
+            else:
+                ok = b1.diff(b2)
+            if ok:
                 if not quiet:
                     self.outf.write("\n* Result for [%s]: SUCCESS\n" %
                                     context)
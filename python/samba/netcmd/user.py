@@ -30,7 +30,7 @@ import errno
 import time
 import base64
 import binascii
-from subprocess import Popen, PIPE, STDOUT, check_call, CalledProcessError
+from subprocess import Popen, PIPE, STDOUT, check_call, CalledProcessError, TimeoutExpired
 from getpass import getpass
 from samba.auth import system_session
 from samba.samdb import SamDB, SamDBError, SamDBNotFoundError
@@ -1139,17 +1139,31 @@ class GetPasswordCommand(Command):
 
         return samdb
 
-    def get_account_attributes(self, samdb, username, basedn, filter, scope,
-                               attrs, decrypt, support_pw_attrs=True):
+    # the formats for the ";format=" option of virtual attributes
+    virtual_formats = [
+            "GeneralizedTime",
+            "UnixTime",
+            "TimeSpec",
+    ]
 
-        def get_option(opts, name):
-            if not opts:
-                return None
-            for o in opts:
-                if o.lower().startswith("%s=" % name.lower()):
-                    (key, _, val) = o.partition('=')
-                    return val
+    @staticmethod
+    def get_attr_option(opts, name):
+        if not opts:
             return None
+        for o in opts:
+            if o.lower().startswith("%s=" % name.lower()):
+                (key, _, val) = o.partition('=')
+                return val
+        return None
+
+    def parse_account_attributes(self, attrs, support_pw_attrs=True):
+        """Work out what to search for to calculate the (possibly
+        virtual) attributes in attrs.
+
+        :return: a (requested_attrs, implicit_attrs, search_attrs) tuple.
+        """
+        get_option = self.get_attr_option
+        formats = self.virtual_formats
 
         def get_virtual_attr_definition(attr):
             for van in sorted(virtual_attributes.keys()):
@@ -1158,12 +1172,6 @@ class GetPasswordCommand(Command):
                 return virtual_attributes[van]
             return None
 
-        formats = [
-                "GeneralizedTime",
-                "UnixTime",
-                "TimeSpec",
-        ]
-
         def get_virtual_format_definition(opts):
             formatname = get_option(opts, "format")
             if formatname is None:
@@ -1191,7 +1199,6 @@ class GetPasswordCommand(Command):
 
         raw_attrs = attrs[:]
         has_wildcard_attr = "*" in raw_attrs
-        has_virtual_attrs = False
         requested_attrs = []
         implicit_attrs = []
 
@@ -1240,6 +1247,10 @@ class GetPasswordCommand(Command):
                 continue
             search_attrs.append(a["attr"])
 
+        return requested_attrs, implicit_attrs, search_attrs
+
+    def search_account(self, samdb, username, basedn, filter, scope,
+                       search_attrs):
         if scope == ldb.SCOPE_BASE:
             search_controls = ["show_deleted:1", "show_recycled:1"]
         else:
@@ -1255,7 +1266,28 @@ class GetPasswordCommand(Command):
         except Exception as msg:
             # FIXME: catch more specific exception
             raise CommandError("Failed to get password for user '%s': %s" % (username or filter, msg))
-        obj = res[0]
+        return res[0]
+
+    def get_account_attributes(self, samdb, username, basedn, filter, scope,
+                               attrs, decrypt, support_pw_attrs=True,
+                               obj=None):
+        """Get the (possibly virtual) attributes of one account.
+
+        If obj is given, it is used instead of searching for the
+        account; it must have been fetched with the search_attrs
+        from parse_account_attributes().
+        """
+        get_option = self.get_attr_option
+        formats = self.virtual_formats
+        has_wildcard_attr = "*" in attrs
+        (requested_attrs,
+         implicit_attrs,
+         search_attrs) = self.parse_account_attributes(attrs,
+                                                       support_pw_attrs)
+
+        if obj is None:
+            obj = self.search_account(samdb, username, basedn, filter,
+                                      scope, search_attrs)
 
         sc = None
         unicodePwd = None
@@ -1938,8 +1970,8 @@ The first time, this command needs to be called with
 '--cache-ldb-initialize' in order to initialize its cache.
 
 The cache initialization requires '--attributes' and allows the following
-optional options: '--decrypt-samba-gpg', '--script', '--filter' or
-'-H/--URL'.
+optional options: '--decrypt-samba-gpg', '--script', '--batch-size',
+'--filter' or '-H/--URL'.
 
 The '--attributes' parameter takes a comma separated list of attributes,
 which will be printed or given to the script specified by '--script'. If a
@@ -2035,6 +2067,19 @@ userPrincipalName, userAccountControl, pwdLastSet and msDS-KeyVersionNumber.
 Depending on the object, some attributes may not be present/available,
 but you always get the current state (and not a diff).
 
+If the cache was initialized with '--batch-size', the script is instead
+started only once, with the single argument '--batch', and kept running.
+It gets a stream of LDIF records on STDIN, one per changed object and
+each terminated by an empty line. After every batch of at most
+'--batch-size' records a line 'BATCH-END: <count>' follows. Once the
+script has processed all the records of the batch it has to respond
+with a single line starting with 'DONE-BATCH: <count>' followed by an
+optional message. The dirsync state in the cache is only updated for
+acknowledged batches, so nothing is lost if the script fails. When
+STDIN is closed the script should exit. Anything the script writes to
+STDERR goes to the logfile. The password attributes of each batch are
+also fetched with a single search, rather than one per object.
+
 If no '--script' option is specified, the LDIF will be printed on STDOUT or
 into the logfile.
 
@@ -2130,6 +2175,9 @@ samba-tool user syncpasswords --terminate \\
                action="store_true", default=False, dest="decrypt_samba_gpg"),
         Option("--script", help="Script that is called for each password change", type=str,
                metavar="/path/to/syncpasswords.script", dest="script"),
+        Option("--batch-size", type=int,
+               help="Handle changes in batches of this size, with one long running script",
+               metavar="SIZE", dest="batch_size"),
         Option("--no-wait", help="Don't block waiting for changes",
                action="store_true", default=False, dest="nowait"),
         Option("--logfile", type=str,
@@ -2145,7 +2193,8 @@ samba-tool user syncpasswords --terminate \\
     def run(self, cache_ldb_initialize=False, cache_ldb=None,
             H=None, filter=None,
             attributes=None, decrypt_samba_gpg=None,
-            script=None, nowait=None, logfile=None, daemon=None, terminate=None,
+            script=None, batch_size=None,
+            nowait=None, logfile=None, daemon=None, terminate=None,
             sambaopts=None, versionopts=None):
 
         self.lp = sambaopts.get_loadparm()
@@ -2153,6 +2202,7 @@ samba-tool user syncpasswords --terminate \\
         self.samdb_url = None
         self.samdb = None
         self.cache = None
+        self.sync_process = None
 
         if not cache_ldb_initialize:
             if attributes is not None:
@@ -2161,6 +2211,8 @@ samba-tool user syncpasswords --terminate \\
                 raise CommandError("--decrypt-samba-gpg is only allowed together with --cache-ldb-initialize")
             if script is not None:
                 raise CommandError("--script is only allowed together with --cache-ldb-initialize")
+            if batch_size is not None:
+                raise CommandError("--batch-size is only allowed together with --cache-ldb-initialize")
             if filter is not None:
                 raise CommandError("--filter is only allowed together with --cache-ldb-initialize")
             if H is not None:
@@ -2184,6 +2236,9 @@ samba-tool user syncpasswords --terminate \\
         if terminate is True and daemon is True:
             raise CommandError("--terminate is not allowed together with --daemon")
 
+        if batch_size is not None and batch_size < 1:
+            raise CommandError("--batch-size must be at least 1")
+
         if daemon is True and logfile is None:
             raise CommandError("--daemon is only allowed together with --logfile")
 
@@ -2285,6 +2340,7 @@ samba-tool user syncpasswords --terminate \\
                 "passwordAttribute",
                 "decryptSambaGPG",
                 "syncCommand",
+                "batchSize",
                 "currentPid",
             ]
 
@@ -2313,6 +2369,7 @@ samba-tool user syncpasswords --terminate \\
                 self.password_attrs = password_attrs
                 self.decrypt_samba_gpg = decrypt_samba_gpg
                 self.sync_command = sync_command
+                self.batch_size = batch_size
                 add_ldif = "dn: %s\n" % self.cache_dn +\
                            "objectClass: userSyncPasswords\n" +\
                            "samdbUrl:: %s\n" % base64.b64encode(get_bytes(self.samdb_url)).decode('utf8') +\
@@ -2326,6 +2383,8 @@ samba-tool user syncpasswords --terminate \\
                     add_ldif += "decryptSambaGPG: FALSE\n"
                 if self.sync_command is not None:
                     add_ldif += "syncCommand: %s\n" % self.sync_command
+                if self.batch_size is not None:
+                    add_ldif += "batchSize: %d\n" % self.batch_size
                 add_ldif += "currentTime: %s\n" % ldb.timestring(int(time.time()))
                 self.cache.add_ldif(add_ldif)
                 self.current_pid = None
@@ -2353,6 +2412,10 @@ samba-tool user syncpasswords --terminate \\
                     self.sync_command = str(res[0]["syncCommand"][0])
                 else:
                     self.sync_command = None
+                if "batchSize" in res[0]:
+                    self.batch_size = int(res[0]["batchSize"][0])
+                else:
+                    self.batch_size = None
                 if "currentPid" in res[0]:
                     self.current_pid = int(res[0]["currentPid"][0])
                 else:
@@ -2386,7 +2449,54 @@ samba-tool user syncpasswords --terminate \\
             log_msg("RESULT: %s\n" % (res))
             raise Exception("ERROR: %s - %s\n" % (res, reply))
 
-        def handle_object(idx, dirsync_obj):
+        def start_sync_process():
+            log_msg("Call Popen[%s --batch]\n" % (self.sync_command))
+            self.sync_process = Popen([self.sync_command, "--batch"],
+                                      stdin=PIPE,
+                                      stdout=PIPE,
+                                      universal_newlines=True,
+                                      encoding='utf-8')
+
+        def stop_sync_process():
+            p = self.sync_process
+            if p is None:
+                return None
+            self.sync_process = None
+            try:
+                p.stdin.close()
+            except (IOError, OSError):
+                pass
+            try:
+                return p.wait(timeout=10)
+            except TimeoutExpired:
+                p.terminate()
+                return p.wait()
+
+        def run_sync_batch(ldifs):
+            if self.sync_process is None:
+                start_sync_process()
+
+            count = len(ldifs)
+            try:
+                for ldif in ldifs:
+                    if not ldif.endswith("\n\n"):
+                        ldif += "\n"
+                    self.sync_process.stdin.write(ldif)
+                self.sync_process.stdin.write("BATCH-END: %d\n" % count)
+                self.sync_process.stdin.flush()
+                reply = self.sync_process.stdout.readline()
+            except (IOError, OSError) as e:
+                reply = "%s" % e
+            log_msg("%s\n" % (reply.rstrip("\n")))
+
+            if reply.startswith("DONE-BATCH: %d" % count):
+                return
+
+            res = stop_sync_process()
+            log_msg("RESULT: %s\n" % (res))
+            raise Exception("ERROR: %s - %s\n" % (res, reply))
+
+        def handle_dirsync_object(idx, dirsync_obj):
             binary_guid = dirsync_obj.dn.get_extended_component("GUID")
             guid = ndr_unpack(misc.GUID, binary_guid)
             binary_sid = dirsync_obj.dn.get_extended_component("SID")
@@ -2394,7 +2504,7 @@ samba-tool user syncpasswords --terminate \\
             domain_sid, rid = sid.split()
             if rid == security.DOMAIN_RID_KRBTGT:
                 log_msg("# Dirsync[%d] SKIP: DOMAIN_RID_KRBTGT\n\n" % (idx))
-                return
+                return None
             for a in list(dirsync_obj.keys()):
                 for h in dirsync_secret_attrs:
                     if a.lower() == h.lower():
@@ -2402,20 +2512,67 @@ samba-tool user syncpasswords --terminate \\
                         dirsync_obj["# %s::" % a] = ["REDACTED SECRET ATTRIBUTE"]
             dirsync_ldif = self.samdb.write_ldif(dirsync_obj, ldb.CHANGETYPE_NONE)
             log_msg("# Dirsync[%d] %s %s\n%s" % (idx, guid, sid, dirsync_ldif))
-            obj = self.get_account_attributes(self.samdb,
-                                              username="%s" % sid,
-                                              basedn="<GUID=%s>" % guid,
-                                              filter="(objectClass=user)",
-                                              scope=ldb.SCOPE_BASE,
-                                              attrs=self.password_attrs,
-                                              decrypt=self.decrypt_samba_gpg)
-            ldif = self.samdb.write_ldif(obj, ldb.CHANGETYPE_NONE)
-            log_msg("# Passwords[%d] %s %s\n" % (idx, guid, sid))
-            if self.sync_command is None:
-                self.outf.write("%s" % (ldif))
+            return (idx, guid, sid)
+
+        def get_password_objects(accounts):
+            """Get the password attributes of all the accounts, using a
+            single search if there is more than one."""
+            prefetched = {}
+            if len(accounts) > 1:
+                search_attrs = self.parse_account_attributes(self.password_attrs)[2]
+                expression = "(&(objectClass=user)(|%s))" % "".join(
+                    "(objectGUID=%s)" % guid for (idx, guid, sid) in accounts)
+                res = self.samdb.search(base=self.samdb.domain_dn(),
+                                        scope=ldb.SCOPE_SUBTREE,
+                                        expression=expression,
+                                        attrs=search_attrs,
+                                        controls=["show_deleted:1",
+                                                  "show_recycled:1"])
+                for msg in res:
+                    if "objectGUID" not in msg:
+                        continue
+                    guid = ndr_unpack(misc.GUID, msg["objectGUID"][0])
+                    prefetched[str(guid)] = msg
+
+            objs = []
+            for (idx, guid, sid) in accounts:
+                # anything we didn't find is looked for again on its own,
+                # so it is reported in the same way as before.
+                obj = self.get_account_attributes(self.samdb,
+                                                  username="%s" % sid,
+                                                  basedn="<GUID=%s>" % guid,
+                                                  filter="(objectClass=user)",
+                                                  scope=ldb.SCOPE_BASE,
+                                                  attrs=self.password_attrs,
+                                                  decrypt=self.decrypt_samba_gpg,
+                                                  obj=prefetched.get(str(guid)))
+                log_msg("# Passwords[%d] %s %s\n" % (idx, guid, sid))
+                objs.append(obj)
+            return objs
+
+        def handle_objects(dirsync_objs):
+            accounts = []
+            for idx, dirsync_obj in dirsync_objs:
+                account = handle_dirsync_object(idx, dirsync_obj)
+                if account is not None:
+                    accounts.append(account)
+            if len(accounts) == 0:
                 return
-            self.outf.write("# attrs=%s\n" % (sorted(obj.keys())))
-            run_sync_command(obj.dn, ldif)
+
+            ldifs = []
+            for obj in get_password_objects(accounts):
+                ldif = self.samdb.write_ldif(obj, ldb.CHANGETYPE_NONE)
+                if self.sync_command is None:
+                    self.outf.write("%s" % (ldif))
+                    continue
+                self.outf.write("# attrs=%s\n" % (sorted(obj.keys())))
+                if self.batch_size is None:
+                    run_sync_command(obj.dn, ldif)
+                else:
+                    ldifs.append(ldif)
+
+            if ldifs:
+                run_sync_batch(ldifs)
 
         def check_current_pid_conflict(terminate):
             flags = os.O_RDWR
@@ -2602,13 +2759,21 @@ samba-tool user syncpasswords --terminate \\
                                         attrs=self.dirsync_attrs,
                                         controls=self.dirsync_controls)
                 log_msg("dirsync_loop(): results %d\n" % len(res))
+                batch_size = self.batch_size or 1
+                batch = []
                 ri = 0
                 for r in res:
                     done = check_object(r, res.controls)
                     if not done:
-                        handle_object(ri, r)
-                        update_object(r, res.controls)
+                        batch.append((ri, r))
                     ri += 1
+                    if len(batch) == batch_size or ri == len(res):
+                        handle_objects(batch)
+                        # Only remember objects once they are
+                        # acknowledged by the script.
+                        for bi, b in batch:
+                            update_object(b, res.controls)
+                        batch = []
                 update_cache(res.controls)
                 if len(res) == 0:
                     break
@@ -2746,6 +2911,9 @@ samba-tool user syncpasswords --terminate \\
                 self.samdb = None
                 log_msg("ldb.LdbError(%d) => (%s)\n" % (enum, estr))
 
+        res = stop_sync_process()
+        if res is not None:
+            log_msg("Script exited with %d\n" % res)
         update_pid(None)
         return
 
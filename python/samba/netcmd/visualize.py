@@ -19,19 +19,24 @@
 
 import os
 import sys
+import shutil
+import multiprocessing
 from collections import defaultdict
+from itertools import chain, count
 import subprocess
 
 import tempfile
+import ldb
 import samba.getopt as options
 from samba import dsdb
 from samba import nttime2unix
 from samba.netcmd import Command, SuperCommand, CommandError, Option
 from samba.samdb import SamDB
+from samba.auth import system_session
 from samba.graph import dot_graph
-from samba.graph import distance_matrix, COLOUR_SETS
-from samba.graph import full_matrix
-from ldb import SCOPE_BASE, SCOPE_SUBTREE, LdbError
+from samba.graph import distance_matrix_lines, COLOUR_SETS
+from samba.graph import full_matrix_lines
+from ldb import SCOPE_BASE, SCOPE_SUBTREE, LdbError, ERR_NO_SUCH_OBJECT
 import time
 import re
 from samba.kcc import KCC, ldif_import_export
@@ -41,10 +46,13 @@ from samba.uptodateness import (
     get_partition,
     get_own_cursor,
     get_utdv,
-    get_utdv_edges,
     get_utdv_distances,
     get_utdv_max_distance,
     get_kcc_and_dsas,
+    get_dsa_urls,
+    UtdvCollector,
+    DEFAULT_JOBS,
+    DEFAULT_TIMEOUT,
 )
 
 COMMON_OPTIONS = [
@@ -102,17 +110,24 @@ class GraphCommand(Command):
         """Decide whether we're dealing with a filename, a tempfile, or
         stdout, and write accordingly.
 
-        :param s: the string to write
+        :param s: the string to write, or an iterable of lines
         :param fn: a destination
         :param suffix: suffix, if destination is a tempfile
 
         If fn is None or "-", write to stdout.
         If fn is visualize.TEMP_FILE, write to a temporary file
         Otherwise fn should be a filename to write to.
+
+        Lines are written as they arrive, which means big matrices
+        don't need to be held in memory as a single string.
         """
+        if isinstance(s, str):
+            s = [s]
+
         if fn is None or fn == '-':
             # we're just using stdout (a.k.a self.outf)
-            print(s, file=self.outf)
+            for line in s:
+                print(line, file=self.outf)
             return
 
         if fn is TEMP_FILE:
@@ -123,7 +138,11 @@ class GraphCommand(Command):
         else:
             f = open(fn, 'w')
 
-        f.write(s)
+        sep = ''
+        for line in s:
+            f.write(sep)
+            f.write(line)
+            sep = '\n'
         f.close()
         return fn
 
@@ -201,19 +220,147 @@ def colour_hash(x):
     return '#%06x' % c
 
 
+# Per worker process state for cmd_reps, set up by _reps_worker_init()
+# in the forked child.
+_reps_worker = {}
+
+
+def _reps_worker_init(snapshot, lp, creds, unix_now, nc_dns, timeout):
+    lp.set("ldap connection timeout", str(timeout))
+    lp.set("ldap timeout", str(timeout))
+    _reps_worker['snapshot'] = snapshot
+    _reps_worker['lp'] = lp
+    _reps_worker['creds'] = creds
+    _reps_worker['unix_now'] = unix_now
+    _reps_worker['nc_dns'] = nc_dns
+    _reps_worker['count'] = count()
+
+
+def _open_snapshot_copy():
+    """Open a private copy of the configuration snapshot database.
+
+    Each KCC run needs a fresh SamDB, because the connection caches the
+    NTDS settings GUID, and forcing a different local DSA doesn't reset
+    it. Copying the file is much cheaper than importing the LDIF again,
+    and the copy can be changed without upsetting other runs.
+    """
+    w = _reps_worker
+    fn = '%s.%d.%d' % (w['snapshot'], os.getpid(), next(w['count']))
+    shutil.copyfile(w['snapshot'], fn)
+    try:
+        samdb = SamDB(url=fn, session_info=system_session(), lp=w['lp'])
+    finally:
+        # the open database stays usable
+        os.unlink(fn)
+    return samdb
+
+
+def _fetch_remote_reps(url):
+    """Fetch the repsFrom and repsTo of each NC head from a remote DC.
+    These are not replicated, so are all that differs between the DCs'
+    views of the topology."""
+    w = _reps_worker
+    remote = SamDB(url=url, credentials=w['creds'], lp=w['lp'])
+    reps = {}
+    for nc_dn in w['nc_dns']:
+        try:
+            res = remote.search(nc_dn, scope=SCOPE_BASE,
+                                attrs=['repsFrom', 'repsTo'])
+        except LdbError as e:
+            if e.args[0] == ERR_NO_SUCH_OBJECT:
+                continue
+            raise
+        reps[nc_dn] = (list(res[0].get('repsFrom', [])),
+                       list(res[0].get('repsTo', [])))
+    return reps
+
+
+def _set_local_reps(samdb, nc_dns, reps):
+    """Make the worker's snapshot look like the remote DC's database."""
+    for nc_dn in nc_dns:
+        repsfrom, repsto = reps.get(nc_dn, ([], []))
+        m = ldb.Message()
+        m.dn = ldb.Dn(samdb, nc_dn)
+        m['repsFrom'] = ldb.MessageElement(repsfrom, ldb.FLAG_MOD_REPLACE,
+                                           'repsFrom')
+        m['repsTo'] = ldb.MessageElement(repsto, ldb.FLAG_MOD_REPLACE,
+                                         'repsTo')
+        try:
+            samdb.modify(m)
+        except LdbError as e:
+            if e.args[0] != ERR_NO_SUCH_OBJECT:
+                raise
+            if nc_dn not in reps:
+                continue
+            # an NC our snapshot's DC doesn't hold
+            samdb.add({'dn': nc_dn,
+                       'objectClass': 'top',
+                       'repsFrom': repsfrom,
+                       'repsTo': repsto})
+
+
+def _reps_for_dsa(dsa_dn, url, mode):
+    """Runs in a worker process: run the KCC from the point of view of
+    one DSA, returning a (dsa_dn, tables, error) tuple, where tables is
+    a list of ('current' | 'needed', partition, repsFrom source GUIDs,
+    repsTo source GUIDs) tuples."""
+    w = _reps_worker
+    samdb = _open_snapshot_copy()
+    if url is not None:
+        try:
+            reps = _fetch_remote_reps(url)
+        except LdbError as e:
+            return dsa_dn, None, str(e)
+        _set_local_reps(samdb, w['nc_dns'], reps)
+
+    # A new KCC each time, because after kcc.run the kcc ends up in a
+    # messy state. The snapshot is local, so loading it is cheap.
+    kcc = KCC(w['unix_now'], readonly=True)
+    kcc.samdb = samdb
+    kcc.run(None, w['lp'], w['creds'], forced_local_dsa=dsa_dn)
+
+    tables = []
+    for site in kcc.site_table.values():
+        for remote_dsa in site.dsa_table.values():
+            remote_dn = remote_dsa.dsa_dnstr.replace('CN=NTDS Settings,',
+                                                     '', 1)
+            if mode == 'others' and remote_dn == dsa_dn:
+                continue
+            elif mode == 'self' and remote_dn != dsa_dn:
+                continue
+
+            kcc.translate_ntdsconn(remote_dsa)
+            # get_reps_tables() returns two dictionaries mapping
+            # dns to NCReplica objects
+            c, n = remote_dsa.get_rep_tables()
+            for state, table in (('current', c), ('needed', n)):
+                for part, rep in table.items():
+                    tables.append((state, part,
+                                   [str(r.source_dsa_obj_guid)
+                                    for r in rep.rep_repsFrom],
+                                   [str(r.source_dsa_obj_guid)
+                                    for r in rep.rep_repsTo]))
+    return dsa_dn, tables, None
+
+
 class cmd_reps(GraphCommand):
     "repsFrom/repsTo from every DSA"
 
     takes_options = COMMON_OPTIONS + DOT_OPTIONS + [
         Option("-p", "--partition", help="restrict to this partition",
                default=None),
+        Option("--jobs", type=int, default=DEFAULT_JOBS,
+               help="work on this many DSAs at once"),
+        Option("--timeout", type=int, default=DEFAULT_TIMEOUT,
+               help="with -r, give up on a DC after this many seconds"),
     ]
 
     def run(self, H=None, output=None, shorten_names=False,
             key=True, talk_to_remote=False,
             sambaopts=None, credopts=None, versionopts=None,
             mode='self', partition=None, color=None, color_scheme=None,
-            utf8=None, format=None, xdot=False):
+            utf8=None, format=None, xdot=False,
+            jobs=DEFAULT_JOBS, timeout=DEFAULT_TIMEOUT):
         # We use the KCC libraries in readonly mode to get the
         # replication graph.
         lp = sambaopts.get_loadparm()
@@ -225,64 +372,71 @@ class cmd_reps(GraphCommand):
 
         # nc_reps is an autovivifying dictionary of dictionaries of lists.
         # nc_reps[partition]['current' | 'needed'] is a list of
-        # (dsa dn string, repsFromTo object) pairs.
+        # (dsa dn string, repsFrom GUIDs, repsTo GUIDs) tuples.
         nc_reps = defaultdict(lambda: defaultdict(list))
 
         guid_to_dnstr = {}
+        for site in local_kcc.site_table.values():
+            for dsa in site.dsa_table.values():
+                remote_dn = dsa.dsa_dnstr.replace('CN=NTDS Settings,', '', 1)
+                guid_to_dnstr[str(dsa.dsa_guid)] = remote_dn
+        nc_dns = sorted(set(part.nc_dnstr
+                            for part in local_kcc.part_table.values()))
 
-        # We run a new KCC for each DSA even if we aren't talking to
-        # the remote, because after kcc.run (or kcc.list_dsas) the kcc
-        # ends up in a messy state.
-        for dsa_dn in dsas:
-            kcc = KCC(unix_now, readonly=True)
-            if talk_to_remote:
-                res = local_kcc.samdb.search(dsa_dn,
-                                             scope=SCOPE_BASE,
-                                             attrs=["dNSHostName"])
-                dns_name = str(res[0]["dNSHostName"][0])
-                print("Attempting to contact ldap://%s (%s)" %
-                      (dns_name, dsa_dn),
-                      file=sys.stderr)
-                try:
-                    kcc.load_samdb("ldap://%s" % dns_name, lp, creds)
-                except KCCError as e:
-                    print("Could not contact ldap://%s (%s)" % (dns_name, e),
+        if talk_to_remote:
+            urls = get_dsa_urls(local_kcc.samdb, dsas)
+        else:
+            urls = dict((dsa_dn, None) for dsa_dn in dsas)
+
+        # The configuration NC is the same for every DSA, so we fetch
+        # it once, as a KCC LDIF snapshot, and run the KCC for each DSA
+        # against local copies of that in a pool of worker processes.
+        # From the remote DCs we only need their repsFrom and repsTo.
+        tmpdir = tempfile.mkdtemp(prefix='samba-tool-visualise')
+        pool = None
+        try:
+            ldif = os.path.join(tmpdir, 'config.ldif')
+            snapshot = os.path.join(tmpdir, 'config.ldb')
+            try:
+                ldif_import_export.samdb_to_ldif_file(local_kcc.samdb, H,
+                                                      lp, creds, ldif)
+                # this is closed again straight away, as the workers
+                # open copies of it.
+                ldif_import_export.ldif_to_samdb(snapshot, lp, ldif)
+            except ldif_import_export.LdifError as e:
+                raise CommandError("Could not snapshot the configuration",
+                                   e)
+
+            ctx = multiprocessing.get_context('fork')
+            pool = ctx.Pool(max(1, min(jobs, len(dsas))),
+                            initializer=_reps_worker_init,
+                            initargs=(snapshot, lp, creds, unix_now,
+                                      nc_dns, timeout))
+            pending = []
+            for dsa_dn in sorted(dsas):
+                if talk_to_remote:
+                    print("Attempting to contact %s (%s)" %
+                          (urls[dsa_dn], dsa_dn),
+                          file=sys.stderr)
+                r = pool.apply_async(_reps_for_dsa,
+                                     (dsa_dn, urls[dsa_dn], mode))
+                pending.append((dsa_dn, r))
+
+            for dsa_dn, r in pending:
+                dn, tables, error = r.get()
+                if error is not None:
+                    print("Could not contact %s (%s)" % (urls[dsa_dn], error),
                           file=sys.stderr)
                     continue
-
-                kcc.run(H, lp, creds)
-            else:
-                kcc.load_samdb(H, lp, creds)
-                kcc.run(H, lp, creds, forced_local_dsa=dsa_dn)
-
-            dsas_from_here = set(kcc.list_dsas())
-            if dsas != dsas_from_here:
-                print("found extra DSAs:", file=sys.stderr)
-                for dsa in (dsas_from_here - dsas):
-                    print("   %s" % dsa, file=sys.stderr)
-                print("missing DSAs (known locally, not by %s):" % dsa_dn,
-                      file=sys.stderr)
-                for dsa in (dsas - dsas_from_here):
-                    print("   %s" % dsa, file=sys.stderr)
-
-            for remote_dn in dsas_from_here:
-                if mode == 'others' and remote_dn == dsa_dn:
-                    continue
-                elif mode == 'self' and remote_dn != dsa_dn:
-                    continue
-
-                remote_dsa = kcc.get_dsa('CN=NTDS Settings,' + remote_dn)
-                kcc.translate_ntdsconn(remote_dsa)
-                guid_to_dnstr[str(remote_dsa.dsa_guid)] = remote_dn
-                # get_reps_tables() returns two dictionaries mapping
-                # dns to NCReplica objects
-                c, n = remote_dsa.get_rep_tables()
-                for part, rep in c.items():
+                for state, part, repsfrom, repsto in tables:
                     if partition is None or part == partition:
-                        nc_reps[part]['current'].append((dsa_dn, rep))
-                for part, rep in n.items():
-                    if partition is None or part == partition:
-                        nc_reps[part]['needed'].append((dsa_dn, rep))
+                        nc_reps[part][state].append((dsa_dn, repsfrom,
+                                                     repsto))
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            shutil.rmtree(tmpdir)
 
         all_edges = {'needed': {'to': [], 'from': []},
                      'current': {'to': [], 'from': []}}
@@ -291,16 +445,16 @@ class cmd_reps(GraphCommand):
 
         for partname, part in nc_reps.items():
             for state, edgelists in all_edges.items():
-                for dsa_dn, rep in part[state]:
+                for dsa_dn, repsfrom, repsto in part[state]:
                     short_name = long_partitions.get(partname, partname)
-                    for r in rep.rep_repsFrom:
+                    for guid in repsfrom:
                         edgelists['from'].append(
                             (dsa_dn,
-                             guid_to_dnstr[str(r.source_dsa_obj_guid)],
+                             guid_to_dnstr[guid],
                              short_name))
-                    for r in rep.rep_repsTo:
+                    for guid in repsto:
                         edgelists['to'].append(
-                            (guid_to_dnstr[str(r.source_dsa_obj_guid)],
+                            (guid_to_dnstr[guid],
                              dsa_dn,
                              short_name))
 
@@ -321,15 +475,16 @@ class cmd_reps(GraphCommand):
                     for src, dest, part in items:
                         part_edges[part].append((src, dest))
                     for part, edges in part_edges.items():
-                        s = distance_matrix(None, edges,
-                                            utf8=utf8,
-                                            colour=color_scheme,
-                                            shorten_names=shorten_names,
-                                            generate_key=key,
-                                            grouping_function=get_dnstr_site)
-
-                        s = "\n%s\n%s" % (header_strings[direction] % part, s)
-                        self.write(s, output)
+                        lines = distance_matrix_lines(
+                            None, edges,
+                            utf8=utf8,
+                            colour=color_scheme,
+                            shorten_names=shorten_names,
+                            generate_key=key,
+                            grouping_function=get_dnstr_site)
+
+                        header = ['', header_strings[direction] % part]
+                        self.write(chain(header, lines), output)
             return
 
         edge_colours = []
@@ -558,13 +713,13 @@ class cmd_ntdsconn(GraphCommand):
                     for e in source_denies:
                         epilog.append('  %s -> %s\n' % e)
 
-            s = distance_matrix(vertices, graph_edges,
-                                utf8=utf8,
-                                colour=color_scheme,
-                                shorten_names=shorten_names,
-                                generate_key=key,
-                                grouping_function=get_dnstrlist_site,
-                                row_comments=rodc_status)
+            lines = distance_matrix_lines(vertices, graph_edges,
+                                          utf8=utf8,
+                                          colour=color_scheme,
+                                          shorten_names=shorten_names,
+                                          generate_key=key,
+                                          grouping_function=get_dnstrlist_site,
+                                          row_comments=rodc_status)
 
             epilog = ''.join(epilog)
             if epilog:
@@ -572,9 +727,7 @@ class cmd_ntdsconn(GraphCommand):
                                               c_reset,
                                               epilog)
 
-            self.write('\n%s\n\n%s\n%s' % (title,
-                                           s,
-                                           epilog), output)
+            self.write(chain(['', title, ''], lines, [epilog]), output)
             return
 
         dot_edges = []
@@ -646,6 +799,12 @@ class cmd_uptodateness(GraphCommand):
                default=None),
         Option("--max-digits", default=3, type=int,
                help="display this many digits of out-of-date-ness"),
+        Option("--jobs", type=int, default=DEFAULT_JOBS,
+               help="query this many DCs at once"),
+        Option("--timeout", type=int, default=DEFAULT_TIMEOUT,
+               help="give up on a DC after this many seconds"),
+        Option("--watch", type=int, metavar="SECONDS",
+               help="redraw the matrix every SECONDS, reusing connections"),
     ]
 
     def run(self, H=None, output=None, shorten_names=False,
@@ -653,12 +812,16 @@ class cmd_uptodateness(GraphCommand):
             sambaopts=None, credopts=None, versionopts=None,
             color=None, color_scheme=None,
             utf8=False, format=None, importldif=None,
-            xdot=False, partition=None, max_digits=3):
+            xdot=False, partition=None, max_digits=3,
+            jobs=DEFAULT_JOBS, timeout=DEFAULT_TIMEOUT, watch=None):
         if not talk_to_remote:
             print("this won't work without talking to the remote servers "
                   "(use -r)", file=self.outf)
             return
 
+        if watch is not None and watch < 1:
+            raise CommandError("--watch needs a positive number of seconds")
+
         # We use the KCC libraries in readonly mode to get the
         # replication graph.
         lp = sambaopts.get_loadparm()
@@ -672,33 +835,50 @@ class cmd_uptodateness(GraphCommand):
                                                        color_scheme,
                                                        output)
 
+        parts = {}
         for part_name, part_dn in short_partitions.items():
             if partition not in (part_dn, None):
                 continue  # we aren't doing this partition
-
-            utdv_edges = get_utdv_edges(local_kcc, dsas, part_dn, lp, creds)
-
-            distances = get_utdv_distances(utdv_edges, dsas)
-
-            max_distance = get_utdv_max_distance(distances)
-
-            digits = min(max_digits, len(str(max_distance)))
-            if digits < 1:
-                digits = 1
-            c_scale = 10 ** digits
-
-            s = full_matrix(distances,
-                            utf8=utf8,
-                            colour=color_scheme,
-                            shorten_names=shorten_names,
-                            generate_key=key,
-                            grouping_function=get_dnstr_site,
-                            colour_scale=c_scale,
-                            digits=digits,
-                            ylabel='DC',
-                            xlabel='out-of-date-ness')
-
-            self.write('\n%s\n\n%s' % (part_name, s), output)
+            parts[part_name] = part_dn
+
+        with UtdvCollector(local_kcc, dsas, lp, creds,
+                           jobs=jobs, timeout=timeout) as collector:
+            while True:
+                start = time.time()
+                all_edges = collector.collect(parts.values())
+
+                for part_name, part_dn in parts.items():
+                    utdv_edges = all_edges[part_dn]
+
+                    distances = get_utdv_distances(utdv_edges, dsas)
+
+                    max_distance = get_utdv_max_distance(distances)
+
+                    digits = min(max_digits, len(str(max_distance)))
+                    if digits < 1:
+                        digits = 1
+                    c_scale = 10 ** digits
+
+                    lines = full_matrix_lines(distances,
+                                              utf8=utf8,
+                                              colour=color_scheme,
+                                              shorten_names=shorten_names,
+                                              generate_key=key,
+                                              grouping_function=get_dnstr_site,
+                                              colour_scale=c_scale,
+                                              digits=digits,
+                                              ylabel='DC',
+                                              xlabel='out-of-date-ness')
+
+                    self.write(chain(['', part_name, ''], lines), output)
+
+                if watch is None:
+                    break
+                self.outf.flush()
+                try:
+                    time.sleep(max(0, start + watch - time.time()))
+                except KeyboardInterrupt:
+                    break
 
 
 class cmd_visualize(SuperCommand):
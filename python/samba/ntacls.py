@@ -18,10 +18,16 @@
 """NT Acls."""
 
 
+import io
+import multiprocessing
 import os
 import tarfile
 import tempfile
 import shutil
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import samba.xattr_native
 import samba.xattr_tdb
@@ -47,6 +53,20 @@ SECURITY_SECINFO_FLAGS = security.SECINFO_OWNER | \
                          security.SECINFO_DACL  | \
                          security.SECINFO_SACL
 
+# SMB connections used by backup_online() when it can make more than one
+DEFAULT_BACKUP_JOBS = 4
+
+# how many files each connection may have queued in backup_online()
+BACKUP_READ_AHEAD = 4
+
+# worker processes setting ntacls in backup_restore()
+DEFAULT_RESTORE_JOBS = 4
+
+# seconds between progress messages in backup_restore()
+RESTORE_PROGRESS_INTERVAL = 10
+
+RESTORE_CHUNK_SIZE = 1024 * 1024
+
 class XattrBackendError(Exception):
     """A generic xattr backend error."""
 
@@ -161,7 +181,6 @@ def setntacl(lp, file, sddl, domsid, session_info,
         sd = security.descriptor.from_sddl(sddl, sid)
     elif isinstance(sddl, security.descriptor):
         sd = sddl
-        sddl = sd.as_sddl(sid)
 
     if not use_ntvfs and skip_invalid_chown:
         # Check if the owner can be resolved as a UID
@@ -489,15 +508,94 @@ def _read_ntacl_file(src):
         return f.read()
 
 
-def backup_online(smb_conn, dest_tarfile_path, dom_sid):
+def _walk_smb_tree(smb_helper):
+    """
+    Yield (smb path, tar path, list entry) for every file and dir in the
+    share, with each dir before its contents.
+
+    The dirs are listed as the walk goes, so the listing overlaps with
+    whatever is done with the entries.
+    """
+    dirs = [('', '')]
+    while dirs:
+        r_dir, t_dir = dirs.pop()
+        for e in smb_helper.list(smb_path=r_dir):
+            r_name = smb_helper.join(r_dir, e['name'])
+            t_name = t_dir + '/' + e['name'] if t_dir else e['name']
+            if smb_helper.is_dir(e['attrib']):
+                dirs.append((r_name, t_name))
+            yield r_name, t_name, e
+
+
+def _fetch_smb_entry(smb_helper, r_name, is_dir):
+    """
+    Read a file (or not, for a dir) and its ntacl, returning
+    (data, sddl, error message).
+    """
+    data = None
+    if not is_dir:
+        data = smb_helper.loadfile(r_name)
+    try:
+        return data, smb_helper.get_acl(r_name, as_sddl=True), None
+    except NTSTATUSError as e:
+        return data, None, e.args[1]
+
+
+def _read_ahead(executor, fn, items, depth):
+    """
+    Yield (item, fn(*item)) for each item, in order, while up to depth
+    more calls run in the executor.
+    """
+    pending = deque()
+    try:
+        for item in items:
+            pending.append((item, executor.submit(fn, *item)))
+            if len(pending) > depth:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+    finally:
+        for item, future in pending:
+            future.cancel()
+
+
+def _tar_add_bytes(tar, name, data, mtime):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = mtime
+    info.mode = 0o644
+    info.uid = os.geteuid()
+    info.gid = os.getegid()
+    tar.addfile(info, io.BytesIO(data))
+
+
+def _tar_add_dir(tar, name, mtime):
+    info = tarfile.TarInfo(name)
+    info.type = tarfile.DIRTYPE
+    info.mtime = mtime
+    info.mode = 0o755
+    info.uid = os.geteuid()
+    info.gid = os.getegid()
+    tar.addfile(info)
+
+
+def backup_online(smb_conn, dest_tarfile_path, dom_sid,
+                  connect=None, jobs=DEFAULT_BACKUP_JOBS):
     """
     Backup all files and dirs with ntacl for the serive behind smb_conn.
 
-    1. Create a temp dir as container dir
-    2. Backup all files with dir structure into container dir
-    3. Generate file.NTACL files for each file and dir in contianer dir
-    4. Create a tar file from container dir(without top level folder)
-    5. Delete contianer dir
+    The tar file is written as the share is read, with a file.NTACL
+    member holding the ntacl of each file and dir, so nothing is
+    written to local disk but the tar file.
+
+    smb_conn is used to list the dirs. If connect is given, it is
+    called (in another thread) to make each of jobs more connections,
+    which are used to read the files and ntacls several at a time while
+    this thread compresses. The connections should be multi_threaded,
+    so they release the GIL while they wait. Without connect, all the
+    reads are done over smb_conn, one at a time.
     """
 
     logger = get_samba_logger()
@@ -507,46 +605,48 @@ def backup_online(smb_conn, dest_tarfile_path, dom_sid):
 
     smb_helper = SMBHelper(smb_conn, dom_sid)
 
-    remotedir = ''  # root dir
-
-    localdir = tempfile.mkdtemp()
-
-    r_dirs = [remotedir]
-    l_dirs = [localdir]
-
-    while r_dirs:
-        r_dir = r_dirs.pop()
-        l_dir = l_dirs.pop()
-
-        for e in smb_helper.list(smb_path=r_dir):
-            r_name = smb_helper.join(r_dir, e['name'])
-            l_name = os.path.join(l_dir, e['name'])
+    executor = None
+    if connect is None:
+        entries = ((item, _fetch_smb_entry(smb_helper, item[0],
+                                           smb_helper.is_dir(item[2]['attrib'])))
+                   for item in _walk_smb_tree(smb_helper))
+    else:
+        local = threading.local()
 
-            if smb_helper.is_dir(e['attrib']):
-                r_dirs.append(r_name)
-                l_dirs.append(l_name)
-                os.mkdir(l_name)
-            else:
-                data = smb_helper.loadfile(r_name)
-                with open(l_name, 'wb') as f:
-                    f.write(data)
+        def fetch(r_name, t_name, e):
+            helper = getattr(local, 'smb_helper', None)
+            if helper is None:
+                helper = SMBHelper(connect(), dom_sid)
+                local.smb_helper = helper
+            return _fetch_smb_entry(helper, r_name,
+                                    helper.is_dir(e['attrib']))
 
-            # get ntacl for this entry and save alongside
-            try:
-                ntacl_sddl_str = smb_helper.get_acl(r_name, as_sddl=True)
-                _create_ntacl_file(l_name, ntacl_sddl_str)
-            except NTSTATUSError as e:
-                logger.error('Failed to get the ntacl for %s: %s' % \
-                             (r_name, e.args[1]))
-                logger.warning('The permissions for %s may not be' % r_name +
-                               ' restored correctly')
+        executor = ThreadPoolExecutor(max_workers=jobs)
+        entries = _read_ahead(executor, fetch, _walk_smb_tree(smb_helper),
+                              jobs * BACKUP_READ_AHEAD)
 
-    with tarfile.open(name=dest_tarfile_path, mode='w:gz') as tar:
-        for name in os.listdir(localdir):
-            path = os.path.join(localdir, name)
-            tar.add(path, arcname=name)
+    try:
+        with tarfile.open(name=dest_tarfile_path, mode='w:gz') as tar:
+            for (r_name, t_name, e), (data, sddl, error) in entries:
+                mtime = e.get('mtime', 0)
+                if data is None:
+                    _tar_add_dir(tar, t_name, mtime)
+                else:
+                    _tar_add_bytes(tar, t_name, data, mtime)
 
-    shutil.rmtree(localdir)
+                # save the ntacl for this entry alongside
+                if error is None:
+                    _tar_add_bytes(tar, t_name + '.NTACL',
+                                   sddl.encode('utf-8'), mtime)
+                else:
+                    logger.error('Failed to get the ntacl for %s: %s' % \
+                                 (r_name, error))
+                    logger.warning('The permissions for %s may not be' % r_name +
+                                   ' restored correctly')
+    finally:
+        entries.close()
+        if executor is not None:
+            executor.shutdown(wait=True)
 
 
 def backup_offline(src_service_path, dest_tarfile_path, smb_conf_path, dom_sid):
@@ -597,13 +697,68 @@ def backup_offline(src_service_path, dest_tarfile_path, smb_conf_path, dom_sid):
     shutil.rmtree(tempdir)
 
 
-def backup_restore(src_tarfile_path, dst_service_path, samdb_conn, smb_conf_path):
+_restore_state = None
+
+
+def _restore_worker_init(ntacls_helper, session_info):
+    global _restore_state
+    # the parsed descriptors, by SDDL: most files share a few SDs
+    _restore_state = (ntacls_helper, session_info, {})
+
+
+def _restore_ntacls(ntacls):
+    """Set the ntacls of a list of (path, sddl), in a restore worker."""
+    ntacls_helper, session_info, descriptors = _restore_state
+    for path, sddl in ntacls:
+        sd = descriptors.get(sddl)
+        if sd is None:
+            sd = security.descriptor.from_sddl(sddl, ntacls_helper.dom_sid)
+            descriptors[sddl] = sd
+        ntacls_helper.setntacl(path, sd, session_info)
+    return len(ntacls)
+
+
+class _RestoreProgress:
+    """Log how far a restore has got every so often."""
+
+    def __init__(self, logger, what, interval=RESTORE_PROGRESS_INTERVAL):
+        self.logger = logger
+        self.what = what
+        self.interval = interval
+        self.start = time.time()
+        self.last = self.start
+        self.count = 0
+        self.nbytes = 0
+
+    def update(self, count, nbytes=0, final=False):
+        self.count += count
+        self.nbytes += nbytes
+        now = time.time()
+        if not final and now - self.last < self.interval:
+            return
+        self.last = now
+        elapsed = max(now - self.start, 1e-6)
+        if self.nbytes:
+            self.logger.info('%s: %d (%d bytes, %.1f MB/s)' %
+                             (self.what, self.count, self.nbytes,
+                              self.nbytes / elapsed / 1e6))
+        else:
+            self.logger.info('%s: %d (%.1f per second)' %
+                             (self.what, self.count, self.count / elapsed))
+
+
+def backup_restore(src_tarfile_path, dst_service_path, samdb_conn,
+                   smb_conf_path, jobs=DEFAULT_RESTORE_JOBS):
     """
     Restore files and ntacls from a tarfile to a service
+
+    The tar file is read as a stream, with the files and dirs written
+    straight into dst_service_path and the .NTACL members kept until the
+    end, when the ntacls are set a dir at a time by jobs worker
+    processes.
     """
     logger = get_samba_logger()
     service = dst_service_path.rstrip('/').rsplit('/', 1)[-1]
-    tempdir = tempfile.mkdtemp()  # src files
 
     dom_sid_str = samdb_conn.get_domain_sid()
     dom_sid = security.dom_sid(dom_sid_str)
@@ -611,50 +766,88 @@ def backup_restore(src_tarfile_path, dst_service_path, samdb_conn, smb_conf_path
     ntacls_helper = NtaclsHelper(service, smb_conf_path, dom_sid)
     session_info = system_session_unix()
 
-    with tarfile.open(src_tarfile_path) as f:
-        f.extractall(path=tempdir)
-        # e.g.: /tmp/tmpRNystY/{dir1,dir1.NTACL,...file1,file1.NTACL}
-
-    for dirpath, dirnames, filenames in os.walk(tempdir):
-        rel_dirpath = os.path.relpath(dirpath, start=tempdir)
-        dst_dirpath = os.path.normpath(
-            os.path.join(dst_service_path, rel_dirpath))
+    # The workers are forked before smbd opens any databases, so they
+    # don't share them with us.
+    pool = None
+    if jobs > 1:
+        ctx = multiprocessing.get_context('fork')
+        pool = ctx.Pool(jobs, initializer=_restore_worker_init,
+                        initargs=(ntacls_helper, session_info))
+    else:
+        _restore_worker_init(ntacls_helper, session_info)
 
-        for dirname in dirnames:
-            if not dirname.endswith('.NTACL'):
-                src = os.path.join(dirpath, dirname)
-                dst = os.path.join(dst_dirpath, dirname)
-                if not os.path.isdir(dst):
-                    # dst must be absolute path for smbd API
-                    smbd.mkdir(dst, session_info, service)
-
-                ntacl_sddl_str = _read_ntacl_file(src)
-                if ntacl_sddl_str:
-                    ntacls_helper.setntacl(dst, ntacl_sddl_str, session_info)
+    try:
+        sddls = {}  # each distinct SDDL string, so there is only one copy
+        ntacls = {}  # path in the tar file: SDDL
+        restored = []  # (path in the tar file, is_dir)
+        progress = _RestoreProgress(logger, 'Restored files')
+
+        # e.g.: {dir1,dir1.NTACL,...file1,file1.NTACL}
+        with tarfile.open(src_tarfile_path, mode='r|*') as tar:
+            for member in tar:
+                name = os.path.normpath(member.name)
+                if os.path.isabs(name) or name.split(os.sep)[0] == '..':
+                    logger.warning('Not restoring %s, which is outside %s' %
+                                   (member.name, dst_service_path))
+                    continue
+
+                if name.endswith('.NTACL'):
+                    if member.isfile():
+                        sddl = tar.extractfile(member).read().decode('utf-8')
+                        ntacls[name[:-len('.NTACL')]] = sddls.setdefault(sddl,
+                                                                         sddl)
+                    continue
+
+                # dst must be absolute path for smbd API
+                dst = os.path.normpath(os.path.join(dst_service_path, name))
+                if member.isdir():
+                    if not os.path.isdir(dst):
+                        smbd.mkdir(dst, session_info, service)
+                    restored.append((name, True))
+                elif member.isfile():
+                    if not os.path.isfile(dst):
+                        smbd.create_file(dst, session_info, service)
+
+                    # now put data in
+                    src_file = tar.extractfile(member)
+                    with open(dst, 'wb') as dst_file:
+                        shutil.copyfileobj(src_file, dst_file,
+                                           RESTORE_CHUNK_SIZE)
+                    restored.append((name, False))
+                    progress.update(1, member.size)
                 else:
+                    logger.warning('Not restoring %s, which is not a file '
+                                   'or directory' % member.name)
+        progress.update(0, final=True)
+
+        # set the ntacls a dir at a time
+        by_dir = {}
+        for name, is_dir in restored:
+            dst = os.path.normpath(os.path.join(dst_service_path, name))
+            sddl = ntacls.get(name)
+            if sddl is None:
+                if is_dir:
                     logger.warning(
                         'Failed to restore ntacl for directory %s.' % dst
                         + ' Please check the permissions are correct')
-
-        for filename in filenames:
-            if not filename.endswith('.NTACL'):
-                src = os.path.join(dirpath, filename)
-                dst = os.path.join(dst_dirpath, filename)
-                if not os.path.isfile(dst):
-                    # dst must be absolute path for smbd API
-                    smbd.create_file(dst, session_info, service)
-
-                ntacl_sddl_str = _read_ntacl_file(src)
-                if ntacl_sddl_str:
-                    ntacls_helper.setntacl(dst, ntacl_sddl_str, session_info)
                 else:
                     logger.warning('Failed to restore ntacl for file %s.' % dst
                                  + ' Please check the permissions are correct')
-
-                # now put data in
-                with open(src, 'rb') as src_file:
-                    data = src_file.read()
-                    with open(dst, 'wb') as dst_file:
-                        dst_file.write(data)
-
-    shutil.rmtree(tempdir)
+                continue
+            by_dir.setdefault(os.path.dirname(name), []).append((dst, sddl))
+
+        logger.info('Restoring %d ntacls (%d distinct) in %d directories' %
+                    (sum(len(v) for v in by_dir.values()), len(sddls),
+                     len(by_dir)))
+        progress = _RestoreProgress(logger, 'Restored ntacls')
+        if pool is None:
+            for batch in by_dir.values():
+                progress.update(_restore_ntacls(batch))
+        else:
+            for n in pool.imap_unordered(_restore_ntacls, by_dir.values()):
+                progress.update(n)
+        progress.update(0, final=True)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
@@ -37,6 +37,7 @@ import logging
 import time
 import uuid
 import socket
+import shutil
 import tempfile
 import samba.dsdb
 
@@ -122,6 +123,18 @@ from samba.samdb import SamDB
 from samba.dbchecker import dbcheck
 from samba.provision.kerberos import create_kdc_conf
 from samba.samdb import get_default_backend_store
+from samba.provision.template import (
+    TEMPLATE_DOMAIN,
+    TEMPLATE_DOMAIN_SID,
+    TEMPLATE_HOSTNAME,
+    TEMPLATE_INVOCATION_ID,
+    TEMPLATE_NETBIOSNAME,
+    TEMPLATE_REALM,
+    ProvisionTemplate,
+    TemplateRenamer,
+    is_template_sid,
+    template_key,
+)
 
 DEFAULT_POLICY_GUID = "31B2F340-016D-11D2-945F-00C04FB984F9"
 DEFAULT_DC_POLICY_GUID = "6AC1786C-016F-11D2-945F-00C04FB984F9"
@@ -1204,16 +1217,21 @@ def setup_self_join(samdb, admin_session_info, names, fill, machinepass,
     samdb.set_session_info(admin_session_info)
 
     if dns_backend != "SAMBA_INTERNAL":
-        # This is Samba4 specific and should be replaced by the correct
-        # DNS AD-style setup
-        setup_add_ldif(samdb, setup_path("provision_dns_add_samba.ldif"), {
-              "DNSDOMAIN": names.dnsdomain,
-              "DOMAINDN": names.domaindn,
-              "DNSPASS_B64": b64encode(dnspass.encode('utf-16-le')).decode('utf8'),
-              "HOSTNAME": names.hostname,
-              "DNSNAME": '%s.%s' % (
-                  names.netbiosname.lower(), names.dnsdomain.lower())
-              })
+        setup_dns_account(samdb, names, dnspass)
+
+
+def setup_dns_account(samdb, names, dnspass):
+    """Add the account bind uses to update the DNS records."""
+    # This is Samba4 specific and should be replaced by the correct
+    # DNS AD-style setup
+    setup_add_ldif(samdb, setup_path("provision_dns_add_samba.ldif"), {
+          "DNSDOMAIN": names.dnsdomain,
+          "DOMAINDN": names.domaindn,
+          "DNSPASS_B64": b64encode(dnspass.encode('utf-16-le')).decode('utf8'),
+          "HOSTNAME": names.hostname,
+          "DNSNAME": '%s.%s' % (
+              names.netbiosname.lower(), names.dnsdomain.lower())
+          })
 
 
 def getpolicypath(sysvolpath, dnsdomain, guid):
@@ -1594,6 +1612,189 @@ def fill_samdb(samdb, lp, names, logger, policyguid,
     return samdb
 
 
+def build_provision_template(logger, session_info, template, sitename,
+                             next_rid, dc_rid, dom_for_fun_level,
+                             base_schema, policyguid, policyguid_dc,
+                             backend_store, backend_store_size,
+                             plaintext_secrets):
+    """Provision a domain with the template names in a scratch directory
+    as far as fill_samdb(), and keep its SAM database as a template."""
+    logger.info("Building provision template %s", template.path)
+    scratch = tempfile.mkdtemp(dir=template.template_dir, prefix=".build-")
+    try:
+        serverrole = "active directory domain controller"
+        smbconf = os.path.join(scratch, "etc", "smb.conf")
+        os.makedirs(os.path.dirname(smbconf))
+        make_smbconf(smbconf, TEMPLATE_HOSTNAME, TEMPLATE_DOMAIN,
+                     TEMPLATE_REALM, scratch, serverrole=serverrole,
+                     global_param={"netbios name": [TEMPLATE_NETBIOSNAME]})
+        lp = samba.param.LoadParm()
+        lp.load(smbconf)
+
+        names = guess_names(lp=lp, hostname=TEMPLATE_HOSTNAME,
+                            domain=TEMPLATE_DOMAIN, dnsdomain=TEMPLATE_REALM,
+                            serverrole=serverrole, sitename=sitename)
+        names.domainguid = None
+        names.domainsid = security.dom_sid(TEMPLATE_DOMAIN_SID)
+        names.forestsid = names.domainsid
+        paths = provision_paths_from_lp(lp, names.dnsdomain)
+
+        directory_create_or_exists(paths.private_dir, 0o700)
+        if not plaintext_secrets:
+            setup_encrypted_secrets_key(paths.encrypted_secrets_key_path)
+
+        schema = Schema(names.domainsid, invocationid=TEMPLATE_INVOCATION_ID,
+                        schemadn=names.schemadn, base_schema=base_schema)
+
+        provision_backend = LDBBackend(paths=paths, lp=lp, names=names,
+                                       logger=logger)
+        provision_backend.init()
+        provision_backend.start()
+
+        samdb = setup_samdb(paths.samdb, session_info, provision_backend,
+                            lp, names, logger=logger, fill=FILL_FULL,
+                            serverrole=serverrole, schema=schema,
+                            plaintext_secrets=plaintext_secrets,
+                            backend_store=backend_store,
+                            backend_store_size=backend_store_size)
+
+        # The passwords are replaced in every domain cloned from the
+        # template. The DNS account is added there too if the DNS
+        # backend needs it, so we pretend to use the internal one.
+        samdb.transaction_start()
+        try:
+            fill_samdb(samdb, lp, names, logger=logger, schema=schema,
+                       policyguid=policyguid, policyguid_dc=policyguid_dc,
+                       fill=FILL_FULL,
+                       adminpass=samba.generate_random_password(12, 32),
+                       krbtgtpass=samba.generate_random_machine_password(128, 255),
+                       machinepass=samba.generate_random_machine_password(120, 120),
+                       dns_backend="SAMBA_INTERNAL", dnspass=None,
+                       invocationid=TEMPLATE_INVOCATION_ID, ntdsguid=None,
+                       serverrole=serverrole,
+                       dom_for_fun_level=dom_for_fun_level,
+                       next_rid=next_rid, dc_rid=dc_rid,
+                       backend_store=backend_store,
+                       backend_store_size=backend_store_size)
+        except:
+            samdb.transaction_cancel()
+            raise
+        else:
+            samdb.transaction_commit()
+
+        provision_backend.post_setup()
+        provision_backend.shutdown()
+        samdb = None
+
+        template.install(paths.private_dir)
+    finally:
+        shutil.rmtree(scratch, True)
+
+
+def get_provision_template(logger, session_info, template_dir, sitename,
+                           next_rid, dc_rid, dom_for_fun_level, base_schema,
+                           policyguid, policyguid_dc, backend_store,
+                           backend_store_size, plaintext_secrets):
+    """Find the template for a provision with these settings in the
+    template directory, building it first if there isn't one yet."""
+    if next_rid is None:
+        next_rid = 1000
+    if dom_for_fun_level is None:
+        dom_for_fun_level = DS_DOMAIN_FUNCTION_2008_R2
+    if policyguid is None:
+        policyguid = DEFAULT_POLICY_GUID
+    if policyguid_dc is None:
+        policyguid_dc = DEFAULT_DC_POLICY_GUID
+    policyguid = policyguid.upper()
+    policyguid_dc = policyguid_dc.upper()
+
+    key = template_key(sitename=sitename, next_rid=next_rid, dc_rid=dc_rid,
+                       dom_for_fun_level=dom_for_fun_level,
+                       base_schema=base_schema, policyguid=policyguid,
+                       policyguid_dc=policyguid_dc,
+                       backend_store=backend_store,
+                       plaintext_secrets=plaintext_secrets)
+
+    directory_create_or_exists(template_dir, 0o700)
+    template = ProvisionTemplate(template_dir, key)
+    if not template.exists():
+        build_provision_template(logger, session_info, template, sitename,
+                                 next_rid, dc_rid, dom_for_fun_level,
+                                 base_schema, policyguid, policyguid_dc,
+                                 backend_store, backend_store_size,
+                                 plaintext_secrets)
+    return template
+
+
+def setup_samdb_from_template(template, paths, names, session_info, lp,
+                              logger, invocationid, backend_store_size=None):
+    """Set up the SAM database as a copy of a template, renamed for the
+    new domain, in place of setup_samdb() and fill_samdb().
+
+    The accounts of the copy have no passwords until
+    reset_template_secrets() has been run.
+    """
+    logger.info("Cloning the SAM database from template %s", template.path)
+    renamer = TemplateRenamer(names, names.domainsid, invocationid)
+    template.clone(paths.private_dir, renamer)
+
+    options = []
+    if backend_store_size:
+        options.append("lmdb_env_size:" + str(backend_store_size))
+    samdb = SamDB(url=paths.samdb, session_info=session_info, lp=lp,
+                  flags=ldb.FLG_DONT_CREATE_DB, options=options)
+
+    logger.info("Re-indexing the cloned SAM database")
+    chk = dbcheck(samdb, verbose=False, quiet=True)
+    if not chk.reindex_database():
+        raise ProvisioningError("Failed to re-index the SAM database "
+                                "cloned from %s" % template.path)
+
+    ntds_dn = "CN=NTDS Settings,%s" % names.serverdn
+    names.ntdsguid = samdb.searchone(basedn=ntds_dn, attribute="objectGUID",
+                                     expression="",
+                                     scope=ldb.SCOPE_BASE).decode('utf8')
+    return samdb
+
+
+def reset_template_secrets(samdb, names, adminpass, krbtgtpass,
+                           machinepass, dns_backend, dnspass):
+    """Set the passwords of the accounts in a SAM database cloned from a
+    template, and add the DNS account if the DNS backend needs one.
+
+    The secret attributes of the template were dropped by the clone, so
+    no clone ends up with the template's passwords in its history, and
+    none of them is encrypted with another key than the clone's own.
+
+    :return: the key version number of the machine account
+    """
+    domainsid = str(names.domainsid)
+    accounts = [
+        ("(objectSid=%s-%d)" % (domainsid, security.DOMAIN_RID_ADMINISTRATOR),
+         adminpass),
+        ("(objectSid=%s-%d)" % (domainsid, security.DOMAIN_RID_KRBTGT),
+         krbtgtpass),
+        ("(sAMAccountName=%s$)" % names.netbiosname, machinepass),
+    ]
+    for expression, password in accounts:
+        res = samdb.search(base=names.domaindn, scope=ldb.SCOPE_SUBTREE,
+                           expression=expression, attrs=[])
+        assert len(res) == 1
+        msg = ldb.Message(res[0].dn)
+        msg["clearTextPassword"] = ldb.MessageElement(
+            password.encode('utf-16-le'), ldb.FLAG_MOD_REPLACE,
+            "clearTextPassword")
+        samdb.modify(msg)
+
+    if dns_backend != "SAMBA_INTERNAL":
+        setup_dns_account(samdb, names, dnspass)
+
+    res = samdb.search(base=names.domaindn, scope=ldb.SCOPE_SUBTREE,
+                       expression="(sAMAccountName=%s$)" % names.netbiosname,
+                       attrs=["msDS-KeyVersionNumber"])
+    return int(res[0]["msDS-KeyVersionNumber"][0])
+
+
 SYSVOL_ACL = "O:LAG:BAD:P(A;OICI;0x001f01ff;;;BA)(A;OICI;0x001200a9;;;SO)(A;OICI;0x001f01ff;;;SY)(A;OICI;0x001200a9;;;AU)"
 POLICIES_ACL = "O:LAG:BAD:P(A;OICI;0x001f01ff;;;BA)(A;OICI;0x001200a9;;;SO)(A;OICI;0x001f01ff;;;SY)(A;OICI;0x001200a9;;;AU)(A;OICI;0x001301bf;;;PA)"
 SYSVOL_SERVICE = "sysvol"
@@ -1908,7 +2109,7 @@ def provision_fill(samdb, secrets_ldb, logger, names, paths,
                    serverrole=None, dom_for_fun_level=None,
                    am_rodc=False, lp=None, use_ntvfs=False,
                    skip_sysvolacl=False, backend_store=None,
-                   backend_store_size=None):
+                   backend_store_size=None, from_template=False):
     # create/adapt the group policy GUIDs
     # Default GUID for default policy are described at
     # "How Core Group Policy Works"
@@ -1930,19 +2131,29 @@ def provision_fill(samdb, secrets_ldb, logger, names, paths,
     if dnspass is None:
         dnspass = samba.generate_random_password(128, 255)
 
+    machine_kvno = 1
+
     samdb.transaction_start()
     try:
-        samdb = fill_samdb(samdb, lp, names, logger=logger,
-                           schema=schema,
-                           policyguid=policyguid, policyguid_dc=policyguid_dc,
-                           fill=samdb_fill, adminpass=adminpass, krbtgtpass=krbtgtpass,
-                           invocationid=invocationid, machinepass=machinepass,
-                           dns_backend=dns_backend, dnspass=dnspass,
-                           ntdsguid=ntdsguid, serverrole=serverrole,
-                           dom_for_fun_level=dom_for_fun_level, am_rodc=am_rodc,
-                           next_rid=next_rid, dc_rid=dc_rid,
-                           backend_store=backend_store,
-                           backend_store_size=backend_store_size)
+        if from_template:
+            machine_kvno = reset_template_secrets(samdb, names,
+                                                  adminpass=adminpass,
+                                                  krbtgtpass=krbtgtpass,
+                                                  machinepass=machinepass,
+                                                  dns_backend=dns_backend,
+                                                  dnspass=dnspass)
+        else:
+            samdb = fill_samdb(samdb, lp, names, logger=logger,
+                               schema=schema,
+                               policyguid=policyguid, policyguid_dc=policyguid_dc,
+                               fill=samdb_fill, adminpass=adminpass, krbtgtpass=krbtgtpass,
+                               invocationid=invocationid, machinepass=machinepass,
+                               dns_backend=dns_backend, dnspass=dnspass,
+                               ntdsguid=ntdsguid, serverrole=serverrole,
+                               dom_for_fun_level=dom_for_fun_level, am_rodc=am_rodc,
+                               next_rid=next_rid, dc_rid=dc_rid,
+                               backend_store=backend_store,
+                               backend_store_size=backend_store_size)
 
         # Set up group policies (domain policy and domain controller
         # policy)
@@ -1968,7 +2179,9 @@ def provision_fill(samdb, secrets_ldb, logger, names, paths,
         secretsdb_self_join(secrets_ldb, domain=names.domain,
                             realm=names.realm, dnsdomain=names.dnsdomain,
                             netbiosname=names.netbiosname, domainsid=names.domainsid,
-                            machinepass=machinepass, secure_channel_type=SEC_CHAN_BDC)
+                            machinepass=machinepass,
+                            key_version_number=machine_kvno,
+                            secure_channel_type=SEC_CHAN_BDC)
 
         # Now set up the right msDS-SupportedEncryptionTypes into the DB
         # In future, this might be determined from some configuration
@@ -2145,9 +2358,12 @@ def provision(logger, session_info, smbconf=None,
               use_rfc2307=False, maxuid=None, maxgid=None, skip_sysvolacl=True,
               base_schema="2012_R2",
               plaintext_secrets=False, backend_store=None,
-              backend_store_size=None, batch_mode=False):
+              backend_store_size=None, batch_mode=False, template_dir=None):
     """Provision samba4
 
+    :param template_dir: Directory of provision templates. If set, the
+        SAM database is cloned from a template (built there by the
+        first such provision) rather than filled from scratch.
     :note: caution, this wipes all existing data!
     """
 
@@ -2246,6 +2462,38 @@ def provision(logger, session_info, smbconf=None,
     if serverrole is None:
         serverrole = lp.get("server role")
 
+    template = None
+    if template_dir is not None:
+        unsupported = []
+        if serverrole != "active directory domain controller":
+            unsupported.append("the server role %s" % serverrole)
+        if samdb_fill != FILL_FULL or am_rodc:
+            unsupported.append("a partial database")
+        if any(dn is not None for dn in (rootdn, domaindn, configdn,
+                                         schemadn, serverdn)):
+            unsupported.append("custom partition DNs")
+        if domainguid is not None or ntdsguid is not None:
+            unsupported.append("fixed objectGUIDs")
+        if not is_template_sid(domainsid):
+            unsupported.append("the domain SID %s" % domainsid)
+        if unsupported:
+            logger.warning("Not using a provision template, as they "
+                           "don't support %s", ", ".join(unsupported))
+        else:
+            template = get_provision_template(logger, session_info,
+                                              template_dir, names.sitename,
+                                              next_rid=next_rid,
+                                              dc_rid=dc_rid,
+                                              dom_for_fun_level=dom_for_fun_level,
+                                              base_schema=base_schema,
+                                              policyguid=policyguid,
+                                              policyguid_dc=policyguid_dc,
+                                              backend_store=backend_store,
+                                              backend_store_size=backend_store_size,
+                                              plaintext_secrets=plaintext_secrets)
+            if invocationid is None:
+                invocationid = str(uuid.uuid4())
+
     directory_create_or_exists(paths.private_dir, 0o700)
     directory_create_or_exists(paths.binddns_dir, 0o770)
     directory_create_or_exists(os.path.join(paths.private_dir, "tls"))
@@ -2256,8 +2504,10 @@ def provision(logger, session_info, smbconf=None,
     if paths.sysvol and not os.path.exists(paths.sysvol):
         os.makedirs(paths.sysvol, 0o775)
 
-    schema = Schema(domainsid, invocationid=invocationid,
-                    schemadn=names.schemadn, base_schema=base_schema)
+    schema = None
+    if template is None:
+        schema = Schema(domainsid, invocationid=invocationid,
+                        schemadn=names.schemadn, base_schema=base_schema)
 
     provision_backend = LDBBackend(paths=paths,
                                    lp=lp,
@@ -2291,14 +2541,20 @@ def provision(logger, session_info, smbconf=None,
                             users_gid=users_gid, root_gid=root_gid)
 
         logger.info("Setting up SAM db")
-        samdb = setup_samdb(paths.samdb, session_info,
-                            provision_backend, lp, names, logger=logger,
-                            serverrole=serverrole,
-                            schema=schema, fill=samdb_fill, am_rodc=am_rodc,
-                            plaintext_secrets=plaintext_secrets,
-                            backend_store=backend_store,
-                            backend_store_size=backend_store_size,
-                            batch_mode=batch_mode)
+        if template is not None:
+            samdb = setup_samdb_from_template(template, paths, names,
+                                              session_info, lp, logger,
+                                              invocationid=invocationid,
+                                              backend_store_size=backend_store_size)
+        else:
+            samdb = setup_samdb(paths.samdb, session_info,
+                                provision_backend, lp, names, logger=logger,
+                                serverrole=serverrole,
+                                schema=schema, fill=samdb_fill, am_rodc=am_rodc,
+                                plaintext_secrets=plaintext_secrets,
+                                backend_store=backend_store,
+                                backend_store_size=backend_store_size,
+                                batch_mode=batch_mode)
 
         if serverrole == "active directory domain controller":
             if paths.netlogon is None:
@@ -2332,7 +2588,8 @@ def provision(logger, session_info, smbconf=None,
                            lp=lp, use_ntvfs=use_ntvfs,
                            skip_sysvolacl=skip_sysvolacl,
                            backend_store=backend_store,
-                           backend_store_size=backend_store_size)
+                           backend_store_size=backend_store_size,
+                           from_template=template is not None)
 
         if not is_heimdal_built():
             create_kdc_conf(paths.kdcconf, realm, domain, os.path.dirname(lp.get("log file")))
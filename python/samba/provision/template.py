@@ -0,0 +1,337 @@
+# Unix SMB/CIFS implementation
+#
+# Provision new domains by cloning a prebuilt template database
+#
+# Copyright (C) Catalyst IT Ltd. 2026
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Provision templates.
+
+A template is the SAM database left by fill_samdb() for a domain with
+placeholder names, domain SID and invocationId. It is built once per
+combination of the settings that change the database contents in other
+ways (the schema, function level, next RID and so on) and kept in a
+template directory.
+
+A new domain is provisioned by copying the template and, with all the
+Samba modules unloaded, substituting the new domain's names, SID and
+invocationId for the placeholders in every DN and value. The rest of
+the provision then runs on the copy as usual, once it is reindexed.
+
+Every object of the copy gets a new objectGUID, which is substituted
+in the extended DNs of the links to it too, and the secret attributes
+are dropped: the copy gets its own secrets key, and its passwords are
+set again by the provision.
+"""
+
+import errno
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import uuid
+
+import ldb
+import samba
+from samba.dcerpc import security, misc
+from samba.ndr import ndr_pack, ndr_unpack
+
+TEMPLATE_REALM = "SAMBATMPLREALM.INVALID"
+TEMPLATE_DNSDOMAIN = TEMPLATE_REALM.lower()
+TEMPLATE_DOMAINDN = "DC=sambatmplrealm,DC=invalid"
+TEMPLATE_DOMAIN = "SAMBATMPLDOM"
+TEMPLATE_HOSTNAME = "sambatmplhost"
+TEMPLATE_NETBIOSNAME = "SAMBATMPLNB"
+TEMPLATE_DOMAIN_SID = "S-1-5-21-2975519186-3340375227-1316411297"
+TEMPLATE_INVOCATION_ID = "6b1a4ef3-5c1d-4d0e-9a39-2f7c0f1d8e42"
+
+# What a template keeps of the private directory it was provisioned in
+TEMPLATE_FILES = ["sam.ldb", "sam.ldb.d"]
+
+# The attributes encrypted with the secrets key (DSDB_SECRET_ATTRIBUTES)
+SECRET_ATTRIBUTES = frozenset(a.lower() for a in [
+    "pekList", "msDS-ExecuteScriptPassword", "currentValue", "dBCSPwd",
+    "initialAuthIncoming", "initialAuthOutgoing", "lmPwdHistory",
+    "ntPwdHistory", "priorValue", "supplementalCredentials",
+    "trustAuthIncoming", "trustAuthOutgoing", "unicodePwd",
+    "clearTextPassword"])
+
+TEMPLATE_SID_RE = re.compile(r'^S-1-5-21-\d+-\d+-\d+$')
+GUID_RE = re.compile(b'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-'
+                     b'[0-9a-f]{12}', re.IGNORECASE)
+
+
+def is_template_sid(sid):
+    """Whether a domain SID can replace the one in a template, which has
+    to have the same binary length."""
+    return TEMPLATE_SID_RE.match(str(sid)) is not None
+
+
+def template_key(**settings):
+    """A name for the template built with these settings (and this
+    version of Samba)."""
+    settings["version"] = samba.version
+    data = json.dumps(settings, sort_keys=True).encode('utf8')
+    return hashlib.sha1(data).hexdigest()[:16]
+
+
+class TemplateRenamer(object):
+    """Rewrites values from a template database for a new domain.
+
+    The template names are replaced wherever they occur: as they were
+    given to the provision with the new names as they were given, or
+    upper or lower case with the new names in the same case. The domain
+    SID and invocationId are replaced in string and in binary form, and
+    the objectGUIDs given to renew_guids() in string form (as in the
+    extended DNs of links) and in objectGUID itself.
+    """
+
+    def __init__(self, names, domainsid, invocationid):
+        mapping = [
+            (TEMPLATE_DOMAINDN, names.domaindn),
+            (TEMPLATE_DNSDOMAIN, names.dnsdomain),
+            # the dc and name attributes of the domain object
+            (TEMPLATE_DNSDOMAIN.split('.')[0], names.dnsdomain.split('.')[0]),
+            (TEMPLATE_HOSTNAME, names.hostname),
+            (TEMPLATE_NETBIOSNAME, names.netbiosname),
+            (TEMPLATE_DOMAIN, names.domain),
+            (TEMPLATE_DOMAIN_SID, str(domainsid)),
+            (TEMPLATE_INVOCATION_ID, str(invocationid)),
+        ]
+        self.exact = {}
+        self.folded = {}
+        for old, new in mapping:
+            old = old.encode('utf8')
+            new = new.encode('utf8')
+            self.exact[old] = new
+            self.folded[old.lower()] = new
+
+        # the longest first, so the realm wins over its first label
+        tokens = sorted(self.exact, key=len, reverse=True)
+        self.regex = re.compile(b'(?:%s)(?![0-9])' %
+                                b'|'.join(re.escape(t) for t in tokens),
+                                re.IGNORECASE)
+
+        old_sid = ndr_pack(security.dom_sid(TEMPLATE_DOMAIN_SID))
+        new_sid = ndr_pack(security.dom_sid(str(domainsid)))
+        if len(old_sid) != len(new_sid):
+            raise ValueError("The domain SID %s can't replace the template's"
+                             " %s" % (domainsid, TEMPLATE_DOMAIN_SID))
+        # skip the revision and sub-authority count, so the SIDs of
+        # accounts in the domain are rewritten too
+        self.binary = [
+            (old_sid[2:], new_sid[2:]),
+            (ndr_pack(misc.GUID(TEMPLATE_INVOCATION_ID)),
+             ndr_pack(misc.GUID(str(invocationid)))),
+        ]
+        self.guids = {}
+        self.guid_strs = {}
+
+    def renew_guids(self, guids):
+        """Give each of these objectGUIDs (in binary form) a new random
+        one."""
+        for guid in guids:
+            new = misc.GUID(str(uuid.uuid4()))
+            self.guids[guid] = ndr_pack(new)
+            old = str(ndr_unpack(misc.GUID, guid)).encode('utf8')
+            self.guid_strs[old.lower()] = str(new).encode('utf8')
+
+    def _substitute_guid(self, match):
+        old = match.group(0)
+        new = self.guid_strs.get(old.lower(), old)
+        if old.isupper():
+            return new.upper()
+        return new
+
+    def _substitute(self, match):
+        old = match.group(0)
+        new = self.exact.get(old)
+        if new is not None:
+            return new
+        new = self.folded[old.lower()]
+        if old.isupper():
+            return new.upper()
+        if old.islower():
+            return new.lower()
+        return new
+
+    def rename(self, value):
+        """Rewrite one (bytes) value."""
+        value = self.regex.sub(self._substitute, value)
+        for old, new in self.binary:
+            value = value.replace(old, new)
+        if self.guid_strs:
+            value = GUID_RE.sub(self._substitute_guid, value)
+        return value
+
+    def rename_str(self, value):
+        return self.rename(value.encode('utf8')).decode('utf8')
+
+    def rename_guid(self, value):
+        """The new objectGUID for an (old, binary) objectGUID."""
+        return self.guids.get(value, value)
+
+
+def rename_records(url, renamer, special_dns=None):
+    """Rewrite every record of one ldb file with the renamer, dropping
+    the secret attributes.
+
+    The file is opened without any modules, so the Samba modules don't
+    object to changes of objectSid, or of the names of the partitions.
+    The indexes of the changed values are left inconsistent, and the
+    database must be reindexed with all the modules loaded.
+
+    The backend refuses to modify objectGUID, as the records are keyed
+    on it, so a record with a new objectGUID is deleted and added again.
+
+    :param special_dns: special records (like @PARTITION) to rewrite
+        too; the others, and the index records, are left alone.
+    """
+    if special_dns is None:
+        special_dns = []
+
+    db = ldb.Ldb(url=url, options=["modules:"], flags=ldb.FLG_DONT_CREATE_DB)
+    db.transaction_start()
+    try:
+        res = db.search(scope=ldb.SCOPE_SUBTREE, expression="(objectClass=*)")
+        records = [msg for msg in res if not str(msg.dn).startswith("@")]
+        for dn in special_dns:
+            records.extend(db.search(base=dn, scope=ldb.SCOPE_BASE))
+
+        for msg in records:
+            dn = str(msg.dn)
+            new_dn = renamer.rename_str(dn)
+            new_msg = ldb.Message(ldb.Dn(db, new_dn))
+            m = ldb.Message(ldb.Dn(db, new_dn))
+            changed = False
+            new_guid = False
+            for attr in msg.keys():
+                if attr.lower() == "dn":
+                    continue
+                if attr.lower() in SECRET_ATTRIBUTES:
+                    m[attr] = ldb.MessageElement([], ldb.FLAG_MOD_REPLACE,
+                                                 attr)
+                    changed = True
+                    continue
+                values = [bytes(v) for v in msg[attr]]
+                if attr.lower() == "objectguid":
+                    new_values = [renamer.rename_guid(v) for v in values]
+                    new_guid = new_values != values
+                else:
+                    new_values = [renamer.rename(v) for v in values]
+                new_msg[attr] = ldb.MessageElement(new_values, 0, attr)
+                if new_values != values:
+                    m[attr] = ldb.MessageElement(new_values,
+                                                 ldb.FLAG_MOD_REPLACE, attr)
+                    changed = True
+
+            if new_guid:
+                db.delete(msg.dn)
+                db.add(new_msg)
+                continue
+            if new_dn != dn:
+                db.rename(msg.dn, ldb.Dn(db, new_dn))
+            if changed:
+                db.modify(m)
+    except:
+        db.transaction_cancel()
+        raise
+    else:
+        db.transaction_commit()
+
+
+def search_guids(url):
+    """The objectGUIDs (in binary form) of the records in an ldb file."""
+    db = ldb.Ldb(url=url, options=["modules:"], flags=ldb.FLG_DONT_CREATE_DB)
+    res = db.search(scope=ldb.SCOPE_SUBTREE, expression="(objectGUID=*)",
+                    attrs=["objectGUID"])
+    return [bytes(msg["objectGUID"][0]) for msg in res]
+
+
+class ProvisionTemplate(object):
+    """A template database in a template directory."""
+
+    def __init__(self, template_dir, key):
+        self.template_dir = template_dir
+        self.path = os.path.join(template_dir, key)
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.path, "sam.ldb"))
+
+    def install(self, private_dir):
+        """Move the SAM database files of a freshly provisioned
+        template domain into the template directory.
+
+        Several provisions may build the same template at once, so the
+        files are gathered in a staging directory that is renamed into
+        place; if another provision got there first, ours are dropped.
+        """
+        staging = tempfile.mkdtemp(dir=self.template_dir,
+                                   prefix=".staging-")
+        for name in TEMPLATE_FILES:
+            src = os.path.join(private_dir, name)
+            if os.path.exists(src):
+                shutil.move(src, os.path.join(staging, name))
+        try:
+            os.rename(staging, self.path)
+        except OSError as e:
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+            shutil.rmtree(staging, True)
+
+    def clone(self, private_dir, renamer):
+        """Copy the template into a private directory, rewriting the
+        names, domain SID, invocationId and objectGUIDs with the renamer.
+
+        The secret attributes are dropped, as the provision sets up a new
+        secrets key for the copy before it is made.
+
+        :return: the path of the new sam.ldb
+        """
+        samdb_path = os.path.join(private_dir, "sam.ldb")
+        shutil.copy(os.path.join(self.path, "sam.ldb"), samdb_path)
+
+        # the partition files are named after the partition DNs
+        src_dir = os.path.join(self.path, "sam.ldb.d")
+        dest_dir = samdb_path + ".d"
+        os.makedirs(dest_dir, exist_ok=True)
+        for name in os.listdir(src_dir):
+            shutil.copy(os.path.join(src_dir, name),
+                        os.path.join(dest_dir, renamer.rename_str(name)))
+
+        samdb = ldb.Ldb(url=samdb_path, options=["modules:"],
+                        flags=ldb.FLG_DONT_CREATE_DB)
+        res = samdb.search(base="@PARTITION", scope=ldb.SCOPE_BASE,
+                           attrs=["partition"])
+        partitions = [renamer.rename_str(str(p).split(":", 1)[1])
+                      for p in res[0]["partition"]]
+        samdb = None
+        urls = ["ldb://" + os.path.join(private_dir, partition)
+                for partition in partitions]
+
+        # the links between partitions refer to the objectGUIDs, so they
+        # are all gathered before any partition is rewritten
+        for url in urls:
+            renamer.renew_guids(search_guids(url))
+
+        rename_records(samdb_path, renamer,
+                       special_dns=["@ROOTDSE", "@PARTITION"])
+        for url in urls:
+            rename_records(url, renamer)
+
+        return samdb_path
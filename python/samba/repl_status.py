@@ -0,0 +1,303 @@
+# Replication status of one or many DCs
+#
+# Copyright Andrew Tridgell 2010
+# Copyright Andrew Bartlett 2017
+# Copyright (C) Catalyst IT Ltd. 2026
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Fetch the repsFrom and repsTo of DCs with DsReplicaGetInfo, as shown
+by samba-tool drs showrepl."""
+
+import sys
+import time
+import multiprocessing
+
+import ldb
+from samba import drs_utils, nttime2string
+from samba.dcerpc import drsuapi
+from samba.common import get_string
+from samba.uptodateness import DEFAULT_JOBS, DEFAULT_TIMEOUT
+
+
+def drs_errmsg(werr):
+    '''return "was successful" or an error string'''
+    (ecode, estring) = werr
+    if ecode == 0:
+        return "was successful"
+    return "failed, result %u (%s)" % (ecode, estring)
+
+
+def drs_parse_ntds_dn(ntds_dn):
+    '''parse a NTDS DN returning a site and server'''
+    a = ntds_dn.split(',')
+    if a[0] != "CN=NTDS Settings" or a[2] != "CN=Servers" or a[4] != 'CN=Sites':
+        raise RuntimeError("bad NTDS DN %s" % ntds_dn)
+    server = a[1].split('=')[1]
+    site   = a[3].split('=')[1]
+    return (site, server)
+
+
+def parse_neighbour(n, dsa_guids):
+    """Convert a DsReplicaNeighbour into a python dictionary.
+
+    :param dsa_guids: the objectGUIDs of all the (undeleted) nTDSDSA
+    objects, as strings, from get_dsa_guids().
+    """
+    dsa_objectguid = str(n.source_dsa_obj_guid)
+    d = {
+        'NC dn': n.naming_context_dn,
+        "DSA objectGUID": dsa_objectguid,
+        "last attempt time": nttime2string(n.last_attempt),
+        "last attempt message": drs_errmsg(n.result_last_attempt),
+        "consecutive failures": n.consecutive_sync_failures,
+        "last success": nttime2string(n.last_success),
+        "NTDS DN": str(n.source_dsa_obj_dn),
+        'is deleted': dsa_objectguid not in dsa_guids
+    }
+    try:
+        (site, server) = drs_parse_ntds_dn(n.source_dsa_obj_dn)
+        d["DSA"] = "%s\\%s" % (site, server)
+    except RuntimeError:
+        pass
+    return d
+
+
+def get_neighbours(drs, drs_handle, info_type, dsa_guids):
+    """Fetch and parse the repsFrom (DRSUAPI_DS_REPLICA_INFO_NEIGHBORS)
+    or repsTo (DRSUAPI_DS_REPLICA_INFO_REPSTO) of a DC."""
+    req1 = drsuapi.DsReplicaGetInfoRequest1()
+    req1.info_type = info_type
+    (info_type, info) = drs.DsReplicaGetInfo(drs_handle, 1, req1)
+    return [parse_neighbour(n, dsa_guids) for n in info.array]
+
+
+def is_failing(rep):
+    return (not rep['is deleted'] and
+            (rep["consecutive failures"] != 0 or rep["last success"] == 0))
+
+
+def get_dsa_guids(samdb):
+    """The objectGUIDs of all the nTDSDSA objects, in one search of the
+    configuration NC, rather than a <GUID=> search per neighbour."""
+    res = samdb.search(samdb.get_config_basedn(),
+                       scope=ldb.SCOPE_SUBTREE,
+                       expression="(objectClass=nTDSDSA)",
+                       attrs=["objectGUID"])
+    return set(get_string(samdb.schema_format_value("objectGUID",
+                                                     msg["objectGUID"][0]))
+               for msg in res)
+
+
+class DsaDirectory(object):
+    """Everything we need to know about the DSAs in the forest, from a
+    single search of the configuration NC: their GUIDs, options, and the
+    DNS names of their servers."""
+
+    def __init__(self, samdb):
+        self.samdb = samdb
+        self.load()
+
+    def _guid(self, msg, attr):
+        if attr not in msg:
+            return None
+        return get_string(self.samdb.schema_format_value("objectGUID",
+                                                          msg[attr][0]))
+
+    def load(self):
+        res = self.samdb.search(self.samdb.get_config_basedn(),
+                                scope=ldb.SCOPE_SUBTREE,
+                                expression=("(|(objectClass=nTDSDSA)"
+                                            "(objectClass=server))"),
+                                attrs=["objectClass", "objectGUID",
+                                       "invocationId", "options",
+                                       "dNSHostName"])
+        hosts = {}
+        dsas = {}
+        for msg in res:
+            classes = [str(x).lower() for x in msg["objectClass"]]
+            if 'ntdsdsa' in classes:
+                dsas[str(msg.dn)] = {
+                    "options": int(msg.get("options", [0])[0]),
+                    "objectGUID": self._guid(msg, "objectGUID"),
+                    "invocationId": self._guid(msg, "invocationId"),
+                }
+            elif "dNSHostName" in msg:
+                hosts[str(msg.dn).lower()] = str(msg["dNSHostName"][0])
+
+        self.guids = set(d["objectGUID"] for d in dsas.values())
+        self.hosts = {}
+        self.dsas = {}
+        for dsa_dn, details in dsas.items():
+            server_dn = dsa_dn.split(',', 1)[1]
+            host = hosts.get(server_dn.lower())
+            if host is not None:
+                self.dsas[dsa_dn] = details
+                self.hosts[dsa_dn] = host
+
+
+# Per worker process state, set up by _repl_worker_init() in the
+# forked child.
+_worker_lp = None
+_worker_creds = None
+_worker_binds = {}
+
+
+def _repl_worker_init(lp, creds):
+    global _worker_lp, _worker_creds
+    _worker_lp = lp
+    _worker_creds = creds
+
+
+def _collect_neighbours(dsa_dn, host, dsa_guids):
+    """Runs in a worker process, fetching the repsFrom and repsTo of one
+    DC. The drsuapi binds are kept between calls, so repeated
+    collections don't reconnect.
+
+    :return: a (dsa_dn, repsFrom, repsTo, error string) tuple.
+    """
+    bind = _worker_binds.get(host)
+    try:
+        if bind is None:
+            drs, drs_handle, _ = drs_utils.drsuapi_connect(host, _worker_lp,
+                                                           _worker_creds)
+            bind = (drs, drs_handle)
+            _worker_binds[host] = bind
+        drs, drs_handle = bind
+        repsfrom = get_neighbours(drs, drs_handle,
+                                  drsuapi.DRSUAPI_DS_REPLICA_INFO_NEIGHBORS,
+                                  dsa_guids)
+        repsto = get_neighbours(drs, drs_handle,
+                                drsuapi.DRSUAPI_DS_REPLICA_INFO_REPSTO,
+                                dsa_guids)
+    except Exception as e:
+        # the bind may be broken; try again from scratch next time
+        _worker_binds.pop(host, None)
+        return dsa_dn, None, None, str(e)
+    return dsa_dn, repsfrom, repsto, None
+
+
+class ReplStatusCollector(object):
+    """Collects the replication status of every DC in the forest.
+
+    The DCs are queried concurrently in a pool of worker processes,
+    each of which keeps its drsuapi binds open, so collect() can be
+    called at intervals without reconnecting. The DSAs, their GUIDs and
+    their DNS names come from one search of the configuration NC of the
+    given samdb, which is repeated only if a DC reports a neighbour we
+    haven't seen.
+    """
+
+    def __init__(self, samdb, lp, creds,
+                 jobs=DEFAULT_JOBS, timeout=DEFAULT_TIMEOUT):
+        self.lp = lp
+        self.creds = creds
+        self.directory = DsaDirectory(samdb)
+        self.jobs = max(1, min(jobs, len(self.directory.dsas)))
+        self.timeout = timeout
+        self.pool = None
+
+    def _start_pool(self):
+        ctx = multiprocessing.get_context('fork')
+        self.pool = ctx.Pool(self.jobs,
+                             initializer=_repl_worker_init,
+                             initargs=(self.lp, self.creds))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _name(self, dsa_dn):
+        try:
+            return "%s\\%s" % drs_parse_ntds_dn(dsa_dn)
+        except RuntimeError:
+            return dsa_dn
+
+    def collect(self):
+        """Fetch the repsFrom and repsTo of every DC.
+
+        :return: a dictionary with the 'time' of the collection and
+        'servers', mapping each DC's site\\server name to a dictionary
+        of 'dsa' details and its 'repsFrom' and 'repsTo' neighbours (as
+        in showrepl --json), or to a dictionary with only an 'error'.
+        """
+        if self.pool is None:
+            self._start_pool()
+
+        directory = self.directory
+        dsa_dns = sorted(directory.dsas)
+        start = time.time()
+        pending = []
+        for dsa_dn in dsa_dns:
+            r = self.pool.apply_async(_collect_neighbours,
+                                      (dsa_dn, directory.hosts[dsa_dn],
+                                       directory.guids))
+            pending.append((dsa_dn, r))
+
+        # Each worker deals with its DCs in sequence, so in the worst
+        # case the last result comes after a timeout for each of them.
+        rounds = (len(pending) + self.jobs - 1) // self.jobs
+        deadline = start + self.timeout * (rounds + 1)
+
+        servers = {}
+        stuck = False
+        unknown = False
+        for dsa_dn, r in pending:
+            name = self._name(dsa_dn)
+            try:
+                dn, repsfrom, repsto, error = r.get(max(0,
+                                                        deadline - time.time()))
+            except multiprocessing.TimeoutError:
+                stuck = True
+                error = "timed out after %ss" % self.timeout
+            if error is not None:
+                print("Could not contact %s (%s)" %
+                      (directory.hosts[dsa_dn], error), file=sys.stderr)
+                servers[name] = {'error': error}
+                continue
+            for rep in repsfrom + repsto:
+                if rep['is deleted']:
+                    unknown = True
+            servers[name] = {
+                'dsa': dict(directory.dsas[dsa_dn],
+                            **{'dns name': directory.hosts[dsa_dn]}),
+                'repsFrom': repsfrom,
+                'repsTo': repsto,
+            }
+
+        if stuck:
+            # A worker is wedged; don't let it hold up the next round.
+            self.close()
+
+        if unknown:
+            # A neighbour might be a new DC rather than a deleted one.
+            directory.load()
+            for data in servers.values():
+                for rep in data.get('repsFrom', []) + data.get('repsTo', []):
+                    if rep['is deleted']:
+                        guid = rep["DSA objectGUID"]
+                        rep['is deleted'] = guid not in directory.guids
+
+        return {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(start)),
+            'servers': servers,
+        }
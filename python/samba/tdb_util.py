@@ -20,7 +20,14 @@
 
 import samba
 import subprocess
+import errno
 import os
+import multiprocessing
+import tdb
+
+# The hash chains are split into this many chunks per worker, so that a
+# worker with long chains doesn't leave the others idle at the end.
+TRAVERSE_CHUNKS_PER_JOB = 4
 
 
 def tdb_copy(file1, file2, readonly=False):
@@ -40,3 +47,168 @@ def tdb_copy(file1, file2, readonly=False):
     status = subprocess.check_call(tdbbackup_cmd, close_fds=True, shell=False)
 
     os.rename("%s.copy.tdb" % file1, file2)
+
+
+def tdb_backup(file1, file2, readonly=False):
+    """Copy a tdb file in this process, as tdbbackup does.
+
+    The records are copied into a new file under a lock on the old
+    one, so the copy is consistent, and then renamed to file2. With
+    readonly, the old file is only read locked (which lets it be
+    backed up while another process has a transaction open on it);
+    otherwise a transaction is held on it during the copy.
+
+    tdb refuses to open a file twice in one process, so this can't be
+    used on a file this process (or its parent, before a fork) has
+    open: use tdb_copy() for that.
+
+    :return: the number of records copied
+    """
+    st = os.stat(file1)
+    tmp_name = file2 + ".tmp"
+
+    src = tdb.Tdb(file1, 0, tdb.DEFAULT, os.O_RDWR)
+    try:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+        dst = tdb.Tdb(tmp_name, src.hash_size, tdb.DEFAULT,
+                      os.O_RDWR | os.O_CREAT | os.O_EXCL,
+                      st.st_mode & 0o777)
+        try:
+            if readonly:
+                src.read_lock_all()
+            else:
+                src.transaction_start()
+            try:
+                dst.lock_all()
+
+                def copy_record(key, value):
+                    dst.store(key, value, tdb.INSERT)
+
+                count = src.traverse(copy_record, read_only=readonly)
+                dst.unlock_all()
+            finally:
+                if readonly:
+                    src.read_unlock_all()
+                else:
+                    src.transaction_cancel()
+        finally:
+            dst.close()
+    except:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+        raise
+    finally:
+        src.close()
+
+    fd = os.open(tmp_name, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    # check the copy is readable and complete before replacing file2
+    check = tdb.Tdb(tmp_name, 0, tdb.DEFAULT, os.O_RDONLY)
+    try:
+        count2 = check.traverse(lambda key, value: None, read_only=True)
+    finally:
+        check.close()
+    if count2 != count:
+        os.unlink(tmp_name)
+        raise RuntimeError("backup of %s has %d records, not %d" %
+                           (file1, count2, count))
+
+    os.rename(tmp_name, file2)
+    return count
+
+
+_traverse_state = None
+
+
+def _traverse_worker_init(path, fn):
+    global _traverse_state
+    db = tdb.Tdb(path, 0, tdb.DEFAULT, os.O_RDONLY)
+    _traverse_state = (db, fn)
+
+
+def _traverse_chunk(chunk):
+    db, fn = _traverse_state
+    start, stop = chunk
+    results = []
+
+    def collect(key, value):
+        r = fn(key, value)
+        if r is not None:
+            results.append(r)
+
+    db.traverse_chains(collect, start, stop)
+    return results
+
+
+def tdb_parallel_traverse(path, fn, jobs=None):
+    """Call fn(key, value) for each record in a TDB file, splitting the
+    hash chains between several worker processes.
+
+    The file is opened read-only in each worker, and each chain is read
+    locked while it is walked, so writers are only held up one chain at
+    a time. As with tdb.Tdb.traverse_chains(), records stored or moved
+    during the traverse may be missed.
+
+    fn runs in the workers, so it can't change anything in this process;
+    its results other than None are yielded here, grouped by chain (the
+    order is the same as a traverse, but the records are not).
+
+    tdb refuses to open a file twice in one process, and the workers
+    inherit this process's open files, so a file this process already
+    has open can't be split between workers. Pass the open tdb.Tdb
+    instead of its path, and it is traversed here, in one read-only
+    pass; passing the path raises OSError(EBUSY).
+
+    :param path: the TDB file, or an open tdb.Tdb
+    :param fn: function of (key, value) returning a picklable result
+    :param jobs: number of worker processes (default: the CPU count)
+    """
+    if isinstance(path, tdb.Tdb):
+        results = []
+
+        def collect(key, value):
+            r = fn(key, value)
+            if r is not None:
+                results.append(r)
+
+        path.traverse(collect, read_only=True)
+        for r in results:
+            yield r
+        return
+
+    try:
+        db = tdb.Tdb(path, 0, tdb.DEFAULT, os.O_RDONLY)
+    except OSError as e:
+        if e.errno != errno.EBUSY:
+            raise
+        raise OSError(errno.EBUSY,
+                      "%s is already open in this process, pass the open "
+                      "tdb.Tdb instead of its path" % path)
+    hash_size = db.hash_size
+    db.close()
+
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    jobs = max(1, min(jobs, hash_size))
+
+    n_chunks = min(hash_size, jobs * TRAVERSE_CHUNKS_PER_JOB)
+    bounds = [hash_size * i // n_chunks for i in range(n_chunks + 1)]
+    chunks = list(zip(bounds[:-1], bounds[1:]))
+
+    # the state is inherited by the workers when they fork, so fn
+    # needn't be picklable.
+    ctx = multiprocessing.get_context('fork')
+    pool = ctx.Pool(jobs, initializer=_traverse_worker_init,
+                    initargs=(path, fn))
+    try:
+        for results in pool.imap(_traverse_chunk, chunks):
+            for r in results:
+                yield r
+    finally:
+        pool.terminate()
+        pool.join()
@@ -81,3 +81,39 @@ class LdbExtensionTests(TestCaseInTempDir):
         finally:
             del l
             os.unlink(path)
+
+    def test_load_ldif_file_add(self):
+        path = self.tempdir + "/ldif.ldb"
+        ldif_path = self.tempdir + "/import.ldif"
+        with open(ldif_path, 'w') as f:
+            for i in range(25):
+                f.write("# record %d\n" % i)
+                f.write("dn: cn=%d,dc=foo\ncn: %d\n" % (i, i))
+                f.write("description: a long description\n  continued\n\n")
+            f.write("# the end\n\n")
+
+        progress = []
+
+        def record_progress(count, seconds):
+            progress.append(count)
+
+        l = samba.Ldb(path)
+        try:
+            n = l.load_ldif_file_add(ldif_path, batch_size=10,
+                                     progress=record_progress)
+            self.assertEqual(n, 25)
+            self.assertEqual(progress, [10, 20, 25])
+
+            with open(ldif_path) as f:
+                records = list(l.parse_ldif_file(f, chunk_size=100))
+            self.assertEqual(len(records), 25)
+
+            res = l.search(expression="(cn=*)")
+            self.assertEqual(len(res), 25)
+            self.assertEqual(b"a long description continued",
+                             l.searchone(basedn=ldb.Dn(l, "cn=7,dc=foo"),
+                                         attribute="description"))
+        finally:
+            del l
+            os.unlink(path)
+            os.unlink(ldif_path)
@@ -140,6 +140,29 @@ class DomainBackupOfflineCmp(BlackboxTestCase):
         args = ["--two", filter_arg]
         self.ldapcmp(self.prov_dir, self.extract_dir, args)
 
+    def test_domain_backup_offline_verify_tdb(self):
+        self.verify_testcase('tdb')
+
+    def test_domain_backup_offline_verify_mdb(self):
+        self.verify_testcase('mdb')
+
+    def verify_testcase(self, backend):
+        self.prov_dir = self.provision(backend)
+        self.extract_dir = None
+        backup_file = self.backup(self.prov_dir, "--no-compress --jobs=2",
+                                  ".tar")
+
+        cmd = ("samba-tool domain backup verify "
+               "--backup-file={f}").format(f=backup_file)
+        self.check_output(cmd)
+
+        # an uncompressed backup is still a usable backup
+        self.extract_dir = tempfile.mkdtemp(dir=self.tempdir)
+        tf = tarfile.open(backup_file)
+        tf.extractall(self.extract_dir)
+
+        self.ldapcmp(self.prov_dir, self.extract_dir)
+
     def untar_testcase(self, backend):
         self.prov_dir = self.provision(backend)
         self.extract_dir = None
@@ -218,15 +241,16 @@ class DomainBackupOfflineCmp(BlackboxTestCase):
 
         return target
 
-    def backup(self, prov_dir):
+    def backup(self, prov_dir, args="", ext=".tar.bz2"):
         # Run the backup and check we got one backup tar file
         cmd = ("samba-tool domain backup offline --targetdir={prov_dir} "
-               "--configfile={prov_dir}/etc/smb.conf").format(prov_dir=prov_dir)
+               "--configfile={prov_dir}/etc/smb.conf {args}").format(
+                   prov_dir=prov_dir, args=args)
         self.check_output(cmd)
 
         tar_files = [fn for fn in os.listdir(prov_dir)
                      if fn.startswith("samba-backup-") and
-                     fn.endswith(".tar.bz2")]
+                     fn.endswith(ext)]
         if len(tar_files) != 1:
             raise CommandError("expected domain backup to create one tar" +
                                " file but got {0}".format(len(tar_files)))
@@ -24,6 +24,7 @@ import samba
 import samba.tests
 from samba import graph
 
+import random
 import re
 import itertools
 
@@ -530,3 +531,37 @@ source ||||,- eel
                                           colour=colour)
                 self.assertStringsEqual(s, expected[k], strip=True,
                                         msg='Wrong output: %s\n\n%s' % (k, s))
+
+    def test_transitive_distance(self):
+        """find_transitive_distance() agrees with a naive relaxation on
+        random graphs, including edges to unlisted vertices."""
+        def naive_distance(vertices, edges):
+            all_vertices = (set(vertices) |
+                            set(e[0] for e in edges) |
+                            set(e[1] for e in edges))
+            d = dict((v, {v: 0}) for v in all_vertices)
+            changed = True
+            while changed:
+                changed = False
+                for src, dest in edges:
+                    for v in all_vertices:
+                        if src in d[v]:
+                            cost = d[v][src] + 1
+                            if cost < d[v].get(dest, cost + 1):
+                                d[v][dest] = cost
+                                changed = True
+            return dict((v, dict((v2, d[v][v2]) for v2 in vertices
+                                 if v2 in d[v]))
+                        for v in vertices)
+
+        rng = random.Random(2)
+        for i in range(50):
+            n = rng.randint(1, 20)
+            vertices = ['v%d' % j for j in range(n)]
+            edges = [(rng.choice(vertices), rng.choice(vertices))
+                     for j in range(rng.randint(0, n * 2))]
+            if i % 2:
+                # only the named vertices are in the answer
+                vertices = rng.sample(vertices, rng.randint(1, n))
+            self.assertEqual(graph.find_transitive_distance(vertices, edges),
+                             naive_distance(vertices, edges))
@@ -86,6 +86,19 @@ class UndirectedGraphTests(samba.tests.TestCase):
 
         self.unconnected_graph = ((), vertices, ())
 
+        # two rings sharing the vertex 'd'
+        bowtie_vertices = tuple('abcdefg')
+        self.bowtie = [[('a', 'b'), ('b', 'c'), ('c', 'd'), ('d', 'a'),
+                        ('d', 'e'), ('e', 'f'), ('f', 'g'), ('g', 'd')],
+                       bowtie_vertices, bowtie_vertices]
+
+        # a ring too deep for a recursive search
+        big_vertices = tuple('v%d' % i for i in range(5000))
+        big_ring_edges = list(zip(big_vertices[1:], big_vertices[:-1]))
+        big_ring_edges.append((big_vertices[0], big_vertices[-1]))
+        self.big_ring = [big_ring_edges, big_vertices, big_vertices]
+        self.big_line = [big_ring_edges[:-1], big_vertices, big_vertices]
+
     def assertGraphError(self, fn, *args):
         return self.assertRaises(GraphError, fn, *args)
 
@@ -134,19 +147,39 @@ class UndirectedGraphTests(samba.tests.TestCase):
 
         self.assertIsNone(fn(*self.ring))
         self.assertIsNone(fn(*self.complete_graph))
+        self.assertIsNone(fn(*self.bowtie))
+
+        self.assertIsNone(fn(*self.big_ring))
+        self.assertGraphError(fn, *self.big_line)
+
+    def test_graph_connected_under_edge_failures_message(self):
+        fn = verify_graph_connected_under_edge_failures
+        # the last edge that would split the graph is reported
+        edges = [('a', 'b'), ('b', 'c'), ('c', 'a'), ('c', 'd'),
+                 ('d', 'e'), ('e', 'f'), ('f', 'd')]
+        with self.assertRaises(GraphError) as cm:
+            fn(edges, tuple('abcdef'), tuple('abcdef'))
+        self.assertIn('from c to d fails', str(cm.exception))
+
+        # a doubled edge is not a single point of failure
+        edges.append(('c', 'd'))
+        self.assertIsNone(fn(edges, tuple('abcdef'), tuple('abcdef')))
 
     def test_graph_connected_under_vertex_failures(self):
-        # XXX no tests to distinguish this from the edge_failures case
         fn = verify_graph_connected_under_vertex_failures
 
         self.assertGraphError(fn, *self.line)
         self.assertGraphError(fn, *self.tree)
         self.assertGraphError(fn, *self.forest)
         self.assertGraphError(fn, *self.disconnected_clusters)
+        self.assertGraphError(fn, *self.bowtie)
 
         self.assertIsNone(fn(*self.ring))
         self.assertIsNone(fn(*self.complete_graph))
 
+        self.assertIsNone(fn(*self.big_ring))
+        self.assertGraphError(fn, *self.big_line)
+
     def test_graph_multi_edge_forest(self):
         pass
 
@@ -26,6 +26,7 @@ import subprocess
 import logging
 import samba.tests
 from samba.kcc import ldif_import_export, KCC
+from samba.kcc.synthetic_forest import write_forest_ldif
 from samba import ldb
 from samba.dcerpc import misc
 
@@ -238,3 +239,57 @@ class KCCMultisiteLdifTests(samba.tests.TestCaseInTempDir):
                 files.append(ffn)
 
         self.remove_files(*files)
+
+
+class KCCSyntheticForestTests(samba.tests.TestCaseInTempDir):
+    def setUp(self):
+        super(KCCSyntheticForestTests, self).setUp()
+        self.lp = LoadParm()
+        self.creds = Credentials()
+        self.creds.guess(self.lp)
+
+    def remove_files(self, *files):
+        for f in files:
+            assert(f.startswith(self.tempdir))
+            os.unlink(f)
+
+    def _import_forest(self, name, verify=False, **kwargs):
+        ldif_file = os.path.join(self.tempdir, name + '.ldif')
+        tmpdb = os.path.join(self.tempdir, name + '-tmpdb')
+        forest = write_forest_ldif(ldif_file, **kwargs)
+        my_kcc = KCC(unix_now, readonly=True, verify=verify)
+        my_kcc.import_ldif(tmpdb, self.lp, ldif_file)
+        self.remove_files(ldif_file)
+        return forest, my_kcc, tmpdb
+
+    def test_same_seed_same_forest(self):
+        a = os.path.join(self.tempdir, 'a.ldif')
+        b = os.path.join(self.tempdir, 'b.ldif')
+        write_forest_ldif(a, sites=20, domains=2, seed=7)
+        write_forest_ldif(b, sites=20, domains=2, seed=7)
+        with open(a) as fa, open(b) as fb:
+            self.assertEqual(fa.read(), fb.read())
+        self.remove_files(a, b)
+
+    def test_list_dsas(self):
+        forest, my_kcc, tmpdb = self._import_forest('list', sites=20,
+                                                    domains=2)
+        dsas = set(my_kcc.list_dsas())
+        self.assertEqual(dsas, set(dc['server_dn'] for dc in forest.dcs))
+        self.remove_files(tmpdb)
+
+    def test_verify(self):
+        """Check that the KCC can run on a synthetic forest, producing
+        graphs that pass its own verify option, and that it records the
+        cost of each phase.
+        """
+        forest, my_kcc, tmpdb = self._import_forest('verify', verify=True,
+                                                    sites=30, domains=2,
+                                                    seed=3)
+        my_kcc.run(None, self.lp, self.creds,
+                   attempt_live_connections=False)
+        phases = [x['phase'] for x in my_kcc.phase_stats]
+        for phase in ('load', 'intrasite', 'intersite',
+                      'translate_ntdsconn'):
+            self.assertIn(phase, phases)
+        self.remove_files(tmpdb)
@@ -41,6 +41,19 @@ class NdrTestCase(samba.tests.TestCase):
         self.assertEqual(x.type, y.type)
         self.assertEqual(x.name, y.name)
 
+    def test_unpack_buffers(self):
+        x = winbind.wbint_Principal()
+        x.sid = security.dom_sid(security.SID_NT_SCHANNEL_AUTHENTICATION)
+        x.type = lsa.SID_NAME_USER
+        x.name = "fred"
+        b = ndr.ndr_pack(x)
+
+        for data in (bytearray(b), memoryview(b),
+                     memoryview(b"xx" + b)[2:]):
+            y = ndr.ndr_unpack(winbind.wbint_Principal, data)
+            self.assertEqual(x.sid, y.sid)
+            self.assertEqual(x.name, y.name)
+
     def test_wbint_Principal_null_name(self):
         x = winbind.wbint_Principal()
 
@@ -18,6 +18,8 @@
 
 """Tests for samba ntacls backup"""
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from samba.samba3 import libsmb_samba_internal as libsmb
 from samba.samba3 import smbd
@@ -26,6 +28,7 @@ from samba import ntacls
 
 from samba.auth import system_session
 from samba.auth_util import system_session_unix
+from samba.netcmd.domain_backup import smb_sysvol_conn
 from samba.dcerpc import security
 from samba.tests import env_loadparm
 from samba.tests.smbd_base import SmbdBaseTests
@@ -178,6 +181,54 @@ class NtaclsBackupRestoreTests(SmbdBaseTests):
         self.assertDictEqual(
             self.original_ntacls, self.smb_helper.get_ntacls())
 
+    def test_backup_online_parallel(self):
+        """
+        Backup service online over several connections, delete files,
+        restore and check.
+        """
+        def connect():
+            return libsmb.Conn(self.server, self.service, lp=self.lp,
+                               creds=self.creds, multi_threaded=True)
+
+        ntacls.backup_online(
+            self.smb_conn, self.tarfile_path, self.dom_sid,
+            connect=connect, jobs=3)
+        self._check_tarfile()
+
+        self.smb_helper.delete_tree()
+        ntacls.backup_restore(
+            self.tarfile_path, self.service_root,
+            self.samdb_conn, self.smb_conf_path)
+        self._check_tree()
+
+        # compare ntacls after restored
+        self.assertDictEqual(
+            self.original_ntacls, self.smb_helper.get_ntacls())
+
+    def test_sysvol_conn_threads(self):
+        """
+        Open several sysvol connections at once with the same
+        credentials, as the parallel online backup does.
+        """
+        jobs = 8
+        signing = self.creds.get_smb_signing()
+        barrier = threading.Barrier(jobs)
+
+        def connect(i):
+            barrier.wait()
+            conn = smb_sysvol_conn(self.server, env_loadparm(), self.creds,
+                                   multi_threaded=True)
+            return sorted(f['name'] for f in conn.list(""))
+
+        with ThreadPoolExecutor(jobs) as pool:
+            listings = list(pool.map(connect, range(jobs)))
+
+        self.assertNotEqual([], listings[0])
+        for listing in listings:
+            self.assertEqual(listings[0], listing)
+        # the signing state was put back, not left at REQUIRED
+        self.assertEqual(signing, self.creds.get_smb_signing())
+
     def test_backup_offline(self):
         """
         Backup service offline, delete files, restore and check.
@@ -196,3 +247,23 @@ class NtaclsBackupRestoreTests(SmbdBaseTests):
         # compare ntacls after restored
         self.assertDictEqual(
             self.original_ntacls, self.smb_helper.get_ntacls())
+
+    def test_backup_restore_single_process(self):
+        """
+        Backup service offline, delete files, restore without worker
+        processes and check.
+        """
+        ntacls.backup_offline(
+            self.service_root, self.tarfile_path,
+            self.smb_conf_path, self.dom_sid)
+        self._check_tarfile()
+
+        self.smb_helper.delete_tree()
+        ntacls.backup_restore(
+            self.tarfile_path, self.service_root,
+            self.samdb_conn, self.smb_conf_path, jobs=1)
+        self._check_tree()
+
+        # compare ntacls after restored
+        self.assertDictEqual(
+            self.original_ntacls, self.smb_helper.get_ntacls())
@@ -0,0 +1,117 @@
+# Tests for the selftest performance benchmark runner
+#
+# Copyright (C) Catalyst IT Ltd. 2026
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Tests for selftest/perf_bench.py.
+
+This needs the selftest directory in PYTHONPATH.
+"""
+
+import json
+import os
+import sys
+
+from samba.tests import TestCaseInTempDir
+import perf_bench
+from perf_bench import (
+    HistoryError,
+    collate_runs,
+    compare,
+    summarise,
+)
+
+
+class PerfBenchTests(TestCaseInTempDir):
+
+    def test_summarise(self):
+        s = summarise([3.0, 1.0, 2.0, 10.0])
+        self.assertEqual(s['min'], 1.0)
+        self.assertEqual(s['max'], 10.0)
+        self.assertEqual(s['median'], 2.5)
+        self.assertEqual(s['spread'], 9.0)
+        self.assertEqual(s['samples'], [1.0, 2.0, 3.0, 10.0])
+        self.assertEqual(summarise([4, 1, 2])['median'], 2)
+
+    def test_compare(self):
+        base = collate_runs([
+            {'times': {'a': 1.0, 'b': 1.0, 'c': 1.0, 'gone': 1.0}},
+            {'times': {'a': 1.1, 'b': 1.3, 'c': 1.0, 'gone': 1.0}},
+        ])
+        current = collate_runs([
+            # a is clearly slower; b is slower but overlaps the noisy
+            # baseline; c is within the threshold.
+            {'times': {'a': 1.5, 'b': 1.2, 'c': 1.04, 'new': 1.0}},
+            {'times': {'a': 1.6, 'b': 1.2, 'c': 1.04, 'new': 1.0}},
+        ])
+        verdicts = dict((name, verdict) for name, b, c, verdict
+                        in compare(base, current, 0.05))
+        self.assertEqual(verdicts, {'a': 'regression',
+                                    'b': 'same',
+                                    'c': 'same',
+                                    'gone': 'missing',
+                                    'new': 'new'})
+
+        verdicts = dict((name, verdict) for name, b, c, verdict
+                        in compare(current, base, 0.05))
+        self.assertEqual(verdicts['a'], 'improvement')
+
+    def run_bench(self, *args):
+        argv = sys.argv
+        sys.argv = ['perf_bench.py',
+                    '--history', os.path.join(self.tempdir, 'history.json')]
+        sys.argv += list(args)
+        try:
+            with open(os.devnull, 'w') as devnull:
+                stdout = sys.stdout
+                sys.stdout = devnull
+                try:
+                    return perf_bench.main()
+                finally:
+                    sys.stdout = stdout
+        finally:
+            sys.argv = argv
+
+    def test_history(self):
+        summaries = []
+        for i, t in enumerate([1.0, 1.01, 2.0]):
+            fn = os.path.join(self.tempdir, 'summary-%d.json' % i)
+            with open(fn, 'w') as f:
+                json.dump({'samba4.perf.test_x': t}, f)
+            summaries.append(fn)
+
+        # nothing to compare to
+        self.assertEqual(self.run_bench('--label=one', summaries[0]), 0)
+        self.assertEqual(self.run_bench('--label=two', summaries[1]), 0)
+        # compared with 'two'
+        self.assertEqual(self.run_bench('--label=three', summaries[2]), 1)
+        # compared with 'one', without recording
+        self.assertEqual(self.run_bench('--baseline=one', '--no-record',
+                                        summaries[1]), 0)
+        self.assertEqual(self.run_bench('--baseline=nonexistent',
+                                        summaries[1]), 2)
+
+        history_fn = os.path.join(self.tempdir, 'history.json')
+        runs = perf_bench.load_history(history_fn)
+        self.assertEqual([r['label'] for r in runs], ['one', 'two', 'three'])
+        self.assertEqual(runs[2]['tests']['samba4.perf.test_x']['min'], 2.0)
+
+        with open(history_fn, 'w') as f:
+            json.dump({'version': 1000, 'runs': []}, f)
+        self.assertRaises(HistoryError, perf_bench.load_history, history_fn)
+
+        for fn in summaries + [history_fn]:
+            os.unlink(fn)
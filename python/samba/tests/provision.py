@@ -17,7 +17,10 @@
 
 """Tests for samba.provision."""
 
+import binascii
 import os
+import shutil
+import ldb
 from samba.provision import (
     ProvisionNames,
     ProvisionPaths,
@@ -27,8 +30,19 @@ from samba.provision import (
     setup_secretsdb,
     findnss,
 )
+from samba.provision.template import (
+    TEMPLATE_DOMAIN_SID,
+    TEMPLATE_INVOCATION_ID,
+    TemplateRenamer,
+    is_template_sid,
+)
+from samba.auth import system_session
+from samba.dcerpc import drsblobs, security, misc
+from samba.ndr import ndr_pack, ndr_unpack
+from samba.param import LoadParm
+from samba.samdb import SamDB
 import samba.tests
-from samba.tests import env_loadparm, TestCase
+from samba.tests import env_loadparm, BlackboxTestCase, TestCase
 
 
 def create_dummy_secretsdb(path, lp=None):
@@ -199,3 +213,171 @@ class DetermineNetbiosNameTests(TestCase):
 
     def test_strips_invalid(self):
         self.assertEqual("BLABLA", determine_netbios_name("bla/bla"))
+
+
+class TemplateRenamerTests(TestCase):
+
+    def setUp(self):
+        super(TemplateRenamerTests, self).setUp()
+        names = ProvisionNames()
+        names.domaindn = "DC=ad,DC=example,DC=com"
+        names.dnsdomain = "ad.example.com"
+        names.hostname = "dc1"
+        names.netbiosname = "DC1"
+        names.domain = "EXAMPLE"
+        self.sid = "S-1-5-21-1-2-3"
+        self.invocationid = "11111111-2222-3333-4444-555555555555"
+        self.names = names
+        self.renamer = TemplateRenamer(names, self.sid, self.invocationid)
+
+    def test_dn(self):
+        self.assertEqual(
+            b"<SID=S-1-5-21-1-2-3-500>;CN=Administrator,CN=Users,"
+            b"DC=ad,DC=example,DC=com",
+            self.renamer.rename(
+                b"<SID=%s-500>;CN=Administrator,CN=Users,"
+                b"DC=sambatmplrealm,DC=invalid" %
+                TEMPLATE_DOMAIN_SID.encode('utf8')))
+
+    def test_case(self):
+        self.assertEqual("CN=CONFIGURATION,DC=AD,DC=EXAMPLE,DC=COM.ldb",
+                         self.renamer.rename_str(
+                             "CN=CONFIGURATION,DC=SAMBATMPLREALM,"
+                             "DC=INVALID.ldb"))
+        self.assertEqual("dc1.ad.example.com",
+                         self.renamer.rename_str(
+                             "sambatmplhost.sambatmplrealm.invalid"))
+        self.assertEqual("DNS/dc1.ad.example.com",
+                         self.renamer.rename_str(
+                             "DNS/sambatmplnb.sambatmplrealm.invalid"))
+        self.assertEqual("DC1$", self.renamer.rename_str("SAMBATMPLNB$"))
+        self.assertEqual("EXAMPLE", self.renamer.rename_str("SAMBATMPLDOM"))
+
+    def test_first_label(self):
+        self.assertEqual("ad", self.renamer.rename_str("sambatmplrealm"))
+
+    def test_binary(self):
+        old_sid = ndr_pack(security.dom_sid(TEMPLATE_DOMAIN_SID + "-512"))
+        new_sid = ndr_pack(security.dom_sid(self.sid + "-512"))
+        self.assertEqual(b"x" + new_sid + b"y",
+                         self.renamer.rename(b"x" + old_sid + b"y"))
+
+        old_guid = ndr_pack(misc.GUID(TEMPLATE_INVOCATION_ID))
+        new_guid = ndr_pack(misc.GUID(self.invocationid))
+        self.assertEqual(new_guid, self.renamer.rename(old_guid))
+
+    def test_guids(self):
+        guid = "0f6b2a8e-1c3d-4e5f-8a9b-0c1d2e3f4a5b"
+        old_guid = ndr_pack(misc.GUID(guid))
+        self.renamer.renew_guids([old_guid])
+        new_guid = self.renamer.rename_guid(old_guid)
+        self.assertNotEqual(old_guid, new_guid)
+        new_str = str(ndr_unpack(misc.GUID, new_guid))
+
+        self.assertEqual(b"<GUID=%s>;CN=dc1,DC=ad,DC=example,DC=com" %
+                         new_str.encode('utf8'),
+                         self.renamer.rename(
+                             b"<GUID=%s>;CN=sambatmplhost,"
+                             b"DC=sambatmplrealm,DC=invalid" %
+                             guid.encode('utf8')))
+        self.assertEqual(new_str.upper(),
+                         self.renamer.rename_str(guid.upper()))
+        # other GUIDs are left alone
+        other = "3b6e1f0a-9c8d-4e7f-a6b5-c4d3e2f1a0b9"
+        self.assertEqual(other, self.renamer.rename_str(other))
+
+    def test_untouched(self):
+        self.assertEqual(b"operatingSystem: Samba",
+                         self.renamer.rename(b"operatingSystem: Samba"))
+
+    def test_sid_shape(self):
+        self.assertTrue(is_template_sid(self.sid))
+        self.assertFalse(is_template_sid("S-1-5-21-1-2"))
+        self.assertRaises(ValueError, TemplateRenamer,
+                          self.names, "S-1-5-21-1-2", self.invocationid)
+
+
+class ProvisionTemplateTests(BlackboxTestCase):
+    """Provisions cloned from a template should match a normal one."""
+
+    domain_sid = "S-1-5-21-2212615479-2695158682-2101375467"
+
+    def provision(self, name, template_dir=None):
+        targetdir = os.path.join(self.tempdir, name)
+        command = ("samba-tool domain provision "
+                   "--realm=SAMBA.EXAMPLE.COM --domain=SAMBA "
+                   "--host-name=dc1 --domain-sid=%s "
+                   "--adminpass=locDCpass1 --server-role=dc --use-ntvfs "
+                   "--targetdir=%s" % (self.domain_sid, targetdir))
+        if template_dir is not None:
+            command += " --template-dir=%s" % template_dir
+        self.addCleanup(shutil.rmtree, targetdir, True)
+        self.check_run(command, msg="provision of %s" % name)
+        return targetdir
+
+    def samdb(self, targetdir):
+        lp = LoadParm()
+        lp.load(os.path.join(targetdir, "etc", "smb.conf"))
+        return SamDB(url=os.path.join(targetdir, "private", "sam.ldb"),
+                     session_info=system_session(), lp=lp)
+
+    def old_secrets(self, targetdir):
+        """The number of old NT hashes and Kerberos keys kept for each
+        of the accounts a clone resets."""
+        samdb = self.samdb(targetdir)
+        counts = {}
+        for account in ["Administrator", "krbtgt", "DC1$"]:
+            res = samdb.search(base=samdb.domain_dn(),
+                               scope=ldb.SCOPE_SUBTREE,
+                               expression="(sAMAccountName=%s)" % account,
+                               attrs=["ntPwdHistory",
+                                      "supplementalCredentials"])
+            self.assertEqual(1, len(res))
+            history = res[0].get("ntPwdHistory", idx=0) or b""
+            old_keys = 0
+            blob = res[0].get("supplementalCredentials", idx=0)
+            if blob is not None:
+                sc = ndr_unpack(drsblobs.supplementalCredentialsBlob, blob)
+                for package in sc.sub.packages:
+                    if package.name != "Primary:Kerberos-Newer-Keys":
+                        continue
+                    keys = ndr_unpack(drsblobs.package_PrimaryKerberosBlob,
+                                      binascii.a2b_hex(package.data))
+                    old_keys = (keys.ctr.num_old_keys +
+                                keys.ctr.num_older_keys)
+            counts[account] = (len(history) // 16, old_keys)
+        return counts
+
+    def test_clones_match_normal_provision(self):
+        template_dir = os.path.join(self.tempdir, "templates")
+        self.addCleanup(shutil.rmtree, template_dir, True)
+
+        normal = self.provision("normal")
+        # the first one builds the template, the second only clones it
+        clones = [self.provision("clone1", template_dir),
+                  self.provision("clone2", template_dir)]
+
+        expected = self.old_secrets(normal)
+        for clone in clones:
+            sam = os.path.join(clone, "private", "sam.ldb")
+            self.check_run("samba-tool dbcheck --cross-ncs -H %s" % sam,
+                           msg="dbcheck of %s" % clone)
+            self.check_run("samba-tool ldapcmp tdb://%s tdb://%s --two" %
+                           (os.path.join(normal, "private", "sam.ldb"), sam),
+                           msg="ldapcmp of %s" % clone)
+            # no password of the template survives in the history
+            self.assertEqual(expected, self.old_secrets(clone))
+
+        # nor do the clones share a secrets key or objectGUIDs
+        keys = set()
+        guids = set()
+        for clone in clones:
+            with open(os.path.join(clone, "private",
+                                   "encrypted_secrets.key"), "rb") as f:
+                keys.add(f.read())
+            samdb = self.samdb(clone)
+            res = samdb.search(base=samdb.domain_dn(), scope=ldb.SCOPE_BASE,
+                               attrs=["objectGUID"])
+            guids.add(bytes(res[0]["objectGUID"][0]))
+        self.assertEqual(len(clones), len(keys))
+        self.assertEqual(len(clones), len(guids))
@@ -327,6 +327,48 @@ class UserCmdTestCase(SambaToolCmdTest):
             self.assertEqual(err, "", "setpassword with forced change")
             self.assertMatch(out, "Changed password OK", "setpassword with forced change")
 
+    def test_syncpasswords_batch(self):
+        script = os.path.join(self.tempdir, "syncpasswords-batch.py")
+        received = os.path.join(self.tempdir, "syncpasswords-batch.ldif")
+        with open(script, "w") as f:
+            f.write("""#!/usr/bin/env python3
+import sys
+assert sys.argv[1:] == ["--batch"]
+with open(%r, "a") as out:
+    for line in sys.stdin:
+        if line.startswith("BATCH-END: "):
+            out.flush()
+            count = line[len("BATCH-END: "):].strip()
+            sys.stdout.write("DONE-BATCH: %%s ok\\n" %% count)
+            sys.stdout.flush()
+        else:
+            out.write(line)
+""" % received)
+        os.chmod(script, 0o755)
+
+        (result, out, err) = self.runsubcmd("user", "syncpasswords",
+                                            "--cache-ldb-initialize",
+                                            "--attributes=sAMAccountName,unicodePwd",
+                                            "--script=%s" % script,
+                                            "--batch-size=2")
+        self.assertCmdSuccess(result, out, err,
+                              "Ensure syncpasswords --cache-ldb-initialize runs")
+        self.assertMatch(out, "batchSize: 2",
+                         "syncpasswords --batch-size: out[%s]" % out)
+
+        (result, out, err) = self.runsubcmd("user", "syncpasswords", "--no-wait")
+        self.assertCmdSuccess(result, out, err, "Ensure syncpasswords --no-wait runs")
+        self.assertMatch(out, "DONE-BATCH: ",
+                         "syncpasswords --no-wait: out[%s]" % out)
+
+        with open(received) as f:
+            ldif = f.read()
+        for user in self.users:
+            self.assertIn("sAMAccountName: %s\n" % user["name"], ldif)
+
+        os.remove(received)
+        os.remove(script)
+
     def test_setexpiry(self):
         for user in self.users:
             twodays = time.time() + (2 * 24 * 60 * 60)
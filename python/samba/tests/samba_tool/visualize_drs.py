@@ -227,6 +227,23 @@ class SambaToolVisualizeDrsTest(SambaToolCmdTest):
             line = lines[0]
             self.assertTrue(line.startswith('DOMAIN'))
 
+    def test_drs_uptodateness_jobs(self):
+        """
+        Test cmd `drs uptodateness --jobs 1` gives the same shape of
+        output as the default concurrent collection.
+        """
+        creds = "%s%%%s" % (os.environ["USERNAME"], os.environ["PASSWORD"])
+        dc1 = os.environ["SERVER"]
+        for jobs in ['1', '4']:
+            (result, out, err) = self.runsubcmd("drs", "uptodateness",
+                                                '-H', "ldap://%s" % dc1,
+                                                '-U', creds,
+                                                '--jobs', jobs,
+                                                '--timeout', '30')
+            self.assertCmdSuccess(result, out, err)
+            for part_name in PARTITION_NAMES:
+                self.assertIn(part_name, out, msg=out)
+
     def test_drs_uptodateness_json(self):
         """
         Test cmd `drs uptodateness --json`
@@ -0,0 +1,121 @@
+# Tests for the testenv snapshot cache of selftest
+#
+# Copyright (C) Catalyst IT Ltd. 2026
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Tests for the --env-cache snapshot key and expiry in
+selftest/target/Samba.pm and Samba4.pm."""
+
+import os
+import shutil
+import subprocess
+import time
+
+from samba import source_tree_topdir
+from samba.tests import TestCaseInTempDir
+
+# Prints the snapshot key of an ad_dc testenv, or nothing if there is
+# none
+SNAPSHOT_KEY = r'''
+use strict;
+use warnings;
+use target::Samba;
+
+my ($bindir, $srcdir, $cache_dir) = @ARGV;
+my $target = new Samba($bindir, $srcdir, 0, 0, 0);
+$target->set_env_cache($cache_dir, 7);
+print $target->{samba4}->env_snapshot_key("$cache_dir/ad_dc") // "";
+'''
+
+
+class EnvCacheTests(TestCaseInTempDir):
+
+    def setUp(self):
+        super(EnvCacheTests, self).setUp()
+        self.addCleanup(self.clean_tempdir)
+
+        self.srcdir = os.path.join(self.tempdir, "src")
+        os.mkdir(self.srcdir)
+        self.write(os.path.join(self.srcdir, "main.c"), "int main;\n")
+        git = ["git", "-C", self.srcdir, "-c", "user.name=selftest",
+               "-c", "user.email=selftest@samba.example.com"]
+        subprocess.check_call(git + ["init", "-q"])
+        subprocess.check_call(git + ["add", "main.c"])
+        subprocess.check_call(git + ["commit", "-q", "-m", "main"])
+
+        self.bindir = os.path.join(self.tempdir, "bin")
+        os.makedirs(os.path.join(self.bindir, "c4che"))
+        os.makedirs(os.path.join(self.bindir, "shared"))
+        self.write(os.path.join(self.bindir, "c4che", "default_cache.py"),
+                   "PREFIX = '/usr/local/samba'\n")
+        self.write(os.path.join(self.bindir, "shared", "libsamba.so"), "1")
+        self.write(os.path.join(self.bindir, "samba"), "#!/bin/sh\n")
+        os.chmod(os.path.join(self.bindir, "samba"), 0o755)
+
+        self.cache_dir = os.path.join(self.tempdir, "cache")
+        os.mkdir(self.cache_dir)
+
+    def clean_tempdir(self):
+        for name in os.listdir(self.tempdir):
+            shutil.rmtree(os.path.join(self.tempdir, name))
+
+    def write(self, path, data):
+        with open(path, "w") as f:
+            f.write(data)
+
+    def snapshot_key(self, bindir=None):
+        selftest = os.path.join(source_tree_topdir(), "selftest")
+        return subprocess.check_output(
+            ["perl", "-I", selftest, "-e", SNAPSHOT_KEY,
+             bindir or self.bindir, self.srcdir,
+             self.cache_dir]).decode('utf8')
+
+    def test_key_follows_the_build(self):
+        key = self.snapshot_key()
+        self.assertNotEqual("", key)
+        self.assertEqual(key, self.snapshot_key())
+
+        # a library is rebuilt
+        lib = os.path.join(self.bindir, "shared", "libsamba.so")
+        self.write(lib, "22")
+        rebuilt = self.snapshot_key()
+        self.assertNotEqual(key, rebuilt)
+
+        # the tree is configured with other options
+        self.write(os.path.join(self.bindir, "c4che", "default_cache.py"),
+                   "PREFIX = '/opt/samba'\n")
+        self.assertNotIn(self.snapshot_key(), [key, rebuilt])
+
+    def test_key_follows_the_source(self):
+        key = self.snapshot_key()
+        self.write(os.path.join(self.srcdir, "main.c"), "int main();\n")
+        self.assertNotEqual(key, self.snapshot_key())
+
+    def test_no_build(self):
+        os.mkdir(os.path.join(self.tempdir, "empty"))
+        self.assertEqual("", self.snapshot_key(
+            os.path.join(self.tempdir, "empty")))
+
+    def test_expiry(self):
+        old = os.path.join(self.cache_dir, "ad_dc-old.tar")
+        new = os.path.join(self.cache_dir, "ad_dc-new.tar")
+        self.write(old, "")
+        self.write(new, "")
+        eight_days_ago = time.time() - 8 * 24 * 3600
+        os.utime(old, (eight_days_ago, eight_days_ago))
+
+        self.snapshot_key()
+        self.assertEqual(["ad_dc-new.tar"], os.listdir(self.cache_dir))
@@ -0,0 +1,110 @@
+# Tests for the selftest knownfail/flapping regex matcher
+#
+# Copyright (C) Catalyst IT Ltd. 2026
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Tests for subunithelper.TestRegexes (selftest/subunithelper.py).
+
+This needs the selftest directory in PYTHONPATH.
+"""
+
+import os
+import re
+
+from samba.tests import TestCase
+import subunithelper
+from subunithelper import (
+    TestRegexes,
+    find_in_list,
+    read_test_regexes,
+    _regex_literal_prefix,
+)
+
+SELFTEST_DIR = os.path.dirname(os.path.abspath(subunithelper.__file__))
+
+
+def naive_find_in_list(regexes, fullname):
+    """The old find_in_list(), which the new one must agree with."""
+    for regex, reason in regexes.items():
+        if re.match(regex, fullname):
+            if reason is None:
+                return ""
+            return reason
+    return None
+
+
+def test_names(regexes):
+    """Make up names that might or might not match the regexes."""
+    names = ['', 'x', 'samba', 'samba4.', 'samba3.smb2.lock']
+    for regex in regexes:
+        prefix = _regex_literal_prefix(regex)
+        for suffix in ('', '.foo', '(ad_dc)', '.test_x(ad_dc_ntvfs)'):
+            names.append(prefix + suffix)
+            names.append(prefix[:-1] + suffix)
+    return names
+
+
+class TestRegexesTests(TestCase):
+
+    def test_literal_prefix(self):
+        for regex, prefix in [
+                (r'^samba4\.ldap\.foo', 'samba4.ldap.foo'),
+                (r'samba3.smb2', 'samba3'),
+                (r'^samba4\.rpc(\.x)?', 'samba4.rpc'),
+                (r'^samba4x?\.rpc', 'samba4'),
+                (r'^samba4\.a*', 'samba4.'),
+                (r'^samba4\.a{2}', 'samba4.'),
+                (r'^samba4\d', 'samba4'),
+                (r'samba3|samba4', ''),
+                (r'(?i)samba', ''),
+                (r'.*samba', ''),
+        ]:
+            self.assertEqual(_regex_literal_prefix(regex), prefix, regex)
+
+    def test_first_reason_wins(self):
+        regexes = TestRegexes()
+        regexes[r'^samba4\.ldap\.foo'] = 'first'
+        regexes[r'.*'] = 'catch all'
+        regexes[r'^samba4\.ldap\.foo\.bar'] = 'never'
+        regexes[r'^samba4\.ldap\.(\w+)\.\1'] = 'backref'
+        regexes[r'^samba4\.nothing'] = None
+
+        self.assertEqual(find_in_list(regexes, 'samba4.ldap.foo.bar'),
+                         'first')
+        self.assertEqual(find_in_list(regexes, 'samba4.ldap.x.x'),
+                         'catch all')
+        del regexes[r'.*']
+        self.assertEqual(find_in_list(regexes, 'samba4.ldap.x.x'),
+                         'backref')
+        self.assertEqual(find_in_list(regexes, 'samba4.nothing.at.all'),
+                         '')
+        self.assertIsNone(find_in_list(regexes, 'samba3.ldap.x.x'))
+
+    def test_selftest_files(self):
+        """The compiled matcher agrees with trying each regex in turn
+        for all the real knownfail, flapping and skip files."""
+        for name in ('knownfail', 'knownfail.d', 'flapping', 'flapping.d',
+                     'skip'):
+            path = os.path.join(SELFTEST_DIR, name)
+            if not os.path.exists(path):
+                continue
+            regexes = read_test_regexes(path)
+            self.assertIsInstance(regexes, TestRegexes)
+            plain = dict(regexes)
+            for fullname in test_names(regexes):
+                self.assertEqual(find_in_list(regexes, fullname),
+                                 naive_find_in_list(plain, fullname),
+                                 "%s in %s" % (fullname, name))
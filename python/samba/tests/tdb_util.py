@@ -17,8 +17,10 @@
 
 import samba.tests
 from samba import ldb, Ldb
-from samba.tdb_util import tdb_copy
+from samba.tdb_util import tdb_copy, tdb_backup, tdb_parallel_traverse
+import errno
 import os
+import tdb
 
 
 class TDBUtilTests(samba.tests.TestCaseInTempDir):
@@ -51,3 +53,66 @@ class TDBUtilTests(samba.tests.TestCaseInTempDir):
         del dst_ldb
         os.unlink(src_ldb_file)
         os.unlink(dst_ldb_file)
+
+    def test_tdb_backup(self):
+        src_file = os.path.join(self.tempdir, "source.tdb")
+        dst_file = os.path.join(self.tempdir, "destination.tdb")
+
+        db = tdb.Tdb(src_file, 0, tdb.DEFAULT, os.O_CREAT | os.O_RDWR, 0o640)
+        for i in range(100):
+            db[b"key%d" % i] = b"value%d" % i
+        db.close()
+
+        for readonly in (True, False):
+            self.assertEqual(100, tdb_backup(src_file, dst_file,
+                                             readonly=readonly))
+            copy = tdb.Tdb(dst_file, 0, tdb.DEFAULT, os.O_RDONLY)
+            self.assertEqual(sorted(copy.items()),
+                             [(b"key%d" % i, b"value%d" % i)
+                              for i in sorted(range(100), key=str)])
+            copy.close()
+            self.assertEqual(0o640, os.stat(dst_file).st_mode & 0o777)
+            self.assertFalse(os.path.exists(dst_file + ".tmp"))
+            os.unlink(dst_file)
+
+        # tdb won't open a file twice in the same process
+        db = tdb.Tdb(src_file, 0, tdb.DEFAULT, os.O_RDWR)
+        self.assertRaises(OSError, tdb_backup, src_file, dst_file)
+        self.assertFalse(os.path.exists(dst_file))
+        db.close()
+        os.unlink(src_file)
+
+    def test_tdb_parallel_traverse(self):
+        path = os.path.join(self.tempdir, "traverse.tdb")
+        db = tdb.Tdb(path, 0, tdb.DEFAULT, os.O_CREAT | os.O_RDWR)
+        expected = set()
+        for i in range(1000):
+            db[b"key%d" % i] = b"%d" % i
+            if i % 3 == 0:
+                expected.add((b"key%d" % i, i))
+        db.close()
+
+        def thirds(key, value):
+            i = int(value)
+            if i % 3 == 0:
+                return (key, i)
+            return None
+
+        for jobs in (1, 3):
+            results = list(tdb_parallel_traverse(path, thirds,
+                                                 jobs=jobs))
+            self.assertEqual(len(expected), len(results))
+            self.assertEqual(expected, set(results))
+
+        # a file this process has open is traversed through its handle
+        db = tdb.Tdb(path, 0, tdb.DEFAULT, os.O_RDWR)
+        try:
+            with self.assertRaises(OSError) as cm:
+                list(tdb_parallel_traverse(path, thirds))
+            self.assertEqual(errno.EBUSY, cm.exception.errno)
+            results = list(tdb_parallel_traverse(db, thirds))
+            self.assertEqual(len(expected), len(results))
+            self.assertEqual(expected, set(results))
+        finally:
+            db.close()
+        os.unlink(path)
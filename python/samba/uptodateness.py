@@ -19,8 +19,9 @@
 
 import sys
 import time
+import multiprocessing
 
-from ldb import SCOPE_BASE, LdbError
+from ldb import SCOPE_BASE, SCOPE_SUBTREE, LdbError
 
 from samba import nttime2unix, dsdb
 from samba.netcmd import CommandError
@@ -107,29 +108,172 @@ def get_own_cursor(samdb):
     return (usn, now)
 
 
-def get_utdv_edges(local_kcc, dsas, part_dn, lp, creds):
-    # we talk to each remote and make a matrix of the vectors
-    # for each partition
-    # normalise by oldest
-    utdv_edges = {}
-    for dsa_dn in dsas:
-        res = local_kcc.samdb.search(dsa_dn,
-                                     scope=SCOPE_BASE,
-                                     attrs=["dNSHostName"])
-        ldap_url = "ldap://%s" % res[0]["dNSHostName"][0]
-        try:
-            samdb = SamDB(url=ldap_url, credentials=creds, lp=lp)
+# How many DCs we talk to at once, and how long (in seconds) we give
+# each one before deciding it is unreachable.
+DEFAULT_JOBS = 8
+DEFAULT_TIMEOUT = 10
+
+# Per worker process state. These are set up by _utdv_worker_init()
+# in the forked child, so the loadparm and credentials objects never
+# need to be pickled.
+_worker_lp = None
+_worker_creds = None
+_worker_samdbs = {}
+
+
+def _utdv_worker_init(lp, creds, timeout):
+    global _worker_lp, _worker_creds
+    _worker_lp = lp
+    _worker_creds = creds
+    # These are enforced by the LDAP client library, which is the
+    # only way to bound a blocking connect in the middle of C code.
+    _worker_lp.set("ldap connection timeout", str(timeout))
+    _worker_lp.set("ldap timeout", str(timeout))
+
+
+def _collect_remote_utdv(dsa_dn, ldap_url, part_dns):
+    """Runs in a worker process, fetching the UTDV of each partition
+    from one remote DSA. Connections are cached between calls so that
+    repeated collections (as in --watch mode) don't reconnect.
+
+    :return: a (dsa_dn, {part_dn: remotes}, error string) tuple.
+    """
+    samdb = _worker_samdbs.get(ldap_url)
+    try:
+        if samdb is None:
+            samdb = SamDB(url=ldap_url, credentials=_worker_creds,
+                          lp=_worker_lp)
+            _worker_samdbs[ldap_url] = samdb
+        own_usn, own_time = get_own_cursor(samdb)
+        results = {}
+        for part_dn in part_dns:
             cursors = get_utdv(samdb, part_dn)
-            own_usn, own_time = get_own_cursor(samdb)
             remotes = {dsa_dn: own_usn}
             for dn, guid, usn, t in cursors:
                 remotes[dn] = usn
-        except LdbError as e:
-            print("Could not contact %s (%s)" % (ldap_url, e),
-                  file=sys.stderr)
-            continue
-        utdv_edges[dsa_dn] = remotes
-    return utdv_edges
+            results[part_dn] = remotes
+    except (LdbError, CommandError) as e:
+        # the connection may be broken; try again from scratch next time
+        _worker_samdbs.pop(ldap_url, None)
+        return dsa_dn, None, str(e)
+    return dsa_dn, results, None
+
+
+def get_dsa_urls(samdb, dsas):
+    """Map each DSA DN to an LDAP URL for its dNSHostName, using a
+    single search of the configuration NC rather than one per DSA."""
+    res = samdb.search(samdb.get_config_basedn(),
+                       scope=SCOPE_SUBTREE,
+                       expression="(&(objectClass=server)(dNSHostName=*))",
+                       attrs=["dNSHostName"])
+    hosts = {}
+    for msg in res:
+        hosts[str(msg.dn).lower()] = str(msg["dNSHostName"][0])
+
+    urls = {}
+    for dsa_dn in dsas:
+        host = hosts.get(str(dsa_dn).lower())
+        if host is None:
+            res = samdb.search(dsa_dn,
+                               scope=SCOPE_BASE,
+                               attrs=["dNSHostName"])
+            host = str(res[0]["dNSHostName"][0])
+        urls[dsa_dn] = "ldap://%s" % host
+    return urls
+
+
+class UtdvCollector(object):
+    """Collects uptodateness vectors from many DSAs concurrently.
+
+    Each DSA is queried in a pool of worker processes (pyldb holds the
+    GIL, so threads would not overlap the network waits). A DSA that
+    doesn't answer within the timeout is reported as unreachable and
+    left out of the edges, as before.
+
+    The pool and its LDAP connections persist until close() is called,
+    so collect() can be called repeatedly.
+    """
+
+    def __init__(self, local_kcc, dsas, lp, creds,
+                 jobs=DEFAULT_JOBS, timeout=DEFAULT_TIMEOUT):
+        self.dsas = sorted(dsas)
+        self.lp = lp
+        self.creds = creds
+        self.jobs = max(1, min(jobs, len(self.dsas)))
+        self.timeout = timeout
+        self.urls = get_dsa_urls(local_kcc.samdb, self.dsas)
+        self.pool = None
+
+    def _start_pool(self):
+        ctx = multiprocessing.get_context('fork')
+        self.pool = ctx.Pool(self.jobs,
+                             initializer=_utdv_worker_init,
+                             initargs=(self.lp, self.creds, self.timeout))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def collect(self, part_dns):
+        """Fetch the UTDVs for the given partitions from every DSA.
+
+        :return: a dict mapping each partition DN to its utdv_edges,
+        in the form returned by get_utdv_edges().
+        """
+        if self.pool is None:
+            self._start_pool()
+
+        pending = []
+        for dsa_dn in self.dsas:
+            r = self.pool.apply_async(_collect_remote_utdv,
+                                      (dsa_dn, self.urls[dsa_dn],
+                                       list(part_dns)))
+            pending.append((dsa_dn, r))
+
+        # Each worker deals with its DSAs in sequence, so in the worst
+        # case the last result comes after a timeout for each of them.
+        rounds = (len(pending) + self.jobs - 1) // self.jobs
+        deadline = time.time() + self.timeout * (rounds + 1)
+
+        all_edges = dict((part_dn, {}) for part_dn in part_dns)
+        stuck = False
+        for dsa_dn, r in pending:
+            ldap_url = self.urls[dsa_dn]
+            try:
+                dn, results, error = r.get(max(0, deadline - time.time()))
+            except multiprocessing.TimeoutError:
+                stuck = True
+                error = "timed out after %ss" % self.timeout
+            if error is not None:
+                print("Could not contact %s (%s)" % (ldap_url, error),
+                      file=sys.stderr)
+                continue
+            for part_dn, remotes in results.items():
+                all_edges[part_dn][dsa_dn] = remotes
+
+        if stuck:
+            # A worker is wedged; don't let it hold up the next round.
+            self.close()
+
+        return all_edges
+
+
+def get_utdv_edges(local_kcc, dsas, part_dn, lp, creds,
+                   jobs=DEFAULT_JOBS, timeout=DEFAULT_TIMEOUT):
+    # we talk to each remote and make a matrix of the vectors
+    # for each partition
+    # normalise by oldest
+    with UtdvCollector(local_kcc, dsas, lp, creds,
+                       jobs=jobs, timeout=timeout) as collector:
+        return collector.collect([part_dn])[part_dn]
 
 
 def get_utdv_distances(utdv_edges, dsas):
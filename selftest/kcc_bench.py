@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# Benchmark the KCC on synthetic forests of increasing size
+#
+# Copyright (C) Catalyst IT Ltd. 2026
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Time the KCC on synthetic forests and compare to a baseline.
+
+For each forest size (given as SITESxDCS_PER_SITE, optionally followed
+by xDOMAINS), samba.kcc.synthetic_forest writes an LDIF file, and
+samba_kcc --importldif --readonly runs on it --repeats times, writing
+the time, peak RSS, and connection count after each phase of the run
+with --stats-file.
+
+The results are kept in a history file in the same format as
+selftest/perf_bench.py, with one "test" per forest size and phase, and
+compared in the same way. The connection counts don't depend on the
+speed of the machine, so any change in them is reported too. If any
+phase has regressed, the exit status is 1.
+
+Examples:
+
+    selftest/kcc_bench.py --sizes=10x3,100x3,300x5x3 --label=before
+    (apply patches, rebuild)
+    selftest/kcc_bench.py --sizes=10x3,100x3,300x5x3 --label=after \\
+        --baseline=before
+"""
+
+import json
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, "bin/python")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from perf_bench import (HistoryError, collate_runs, load_history,
+                        save_history, find_baseline, report, get_revision)
+
+DEFAULT_HISTORY = 'kcc-bench-history.json'
+DEFAULT_SIZES = '10x3,100x3,300x5x3'
+DEFAULT_SAMBA_KCC = 'source4/scripting/bin/samba_kcc'
+DEFAULT_THRESHOLD = 0.1
+# a fixed time, so the schedules and failure timeouts don't change
+KCC_NOW = '20260101120000'
+
+
+def parse_size(size):
+    """'300x5x3' -> (300 sites, 5 DCs per site, 3 domains)"""
+    parts = [int(x) for x in size.split('x')]
+    if len(parts) == 2:
+        parts.append(1)
+    if len(parts) != 3 or min(parts) < 1:
+        raise ValueError("bad forest size %r, expected SITESxDCS[xDOMAINS]"
+                         % size)
+    return tuple(parts)
+
+
+def run_kcc(samba_kcc, ldif_file, local_dsa, workdir, seed):
+    """Run samba_kcc once on the LDIF, returning the phase statistics and
+    the resource usage of the process."""
+    tmpdb = os.path.join(workdir, 'tmpdb')
+    stats_file = os.path.join(workdir, 'stats.json')
+    for fn in (tmpdb, stats_file):
+        if os.path.exists(fn):
+            os.unlink(fn)
+
+    cmd = [sys.executable, samba_kcc,
+           '--importldif', ldif_file,
+           '--tmpdb', tmpdb,
+           '--forced-local-dsa', local_dsa,
+           '--readonly',
+           '--now', KCC_NOW,
+           '--seed', str(seed),
+           '--stats-file', stats_file]
+
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        p = subprocess.Popen(cmd, stdout=devnull)
+    pid, status, usage = os.wait4(p.pid, 0)
+    elapsed = time.time() - start
+    if os.WIFSIGNALED(status):
+        p.returncode = -os.WTERMSIG(status)
+    else:
+        p.returncode = os.WEXITSTATUS(status)
+    if p.returncode != 0:
+        raise HistoryError("%s failed with status %d" %
+                           (' '.join(cmd), p.returncode))
+
+    if not os.path.exists(stats_file):
+        raise HistoryError("%s failed without writing statistics" %
+                           ' '.join(cmd))
+    with open(stats_file) as f:
+        stats = json.load(f)
+
+    return stats['phases'], {
+        'cpu': usage.ru_utime + usage.ru_stime,
+        'max_rss': usage.ru_maxrss,
+        'elapsed': elapsed,
+    }
+
+
+def bench_size(size, samba_kcc, repeats, seed, workdir, runs, connections):
+    """Benchmark one forest size, adding the phase timings of each repeat
+    to runs, and the final connection count of each phase to
+    connections."""
+    from samba.kcc.synthetic_forest import write_forest_ldif
+
+    sites, dcs_per_site, domains = parse_size(size)
+    ldif_file = os.path.join(workdir, 'forest-%s.ldif' % size)
+    forest = write_forest_ldif(ldif_file, sites=sites,
+                               dcs_per_site=dcs_per_site,
+                               domains=domains, seed=seed)
+    print("kcc_bench: %s: %d sites, %d DCs, %d domains, %d site links" %
+          (size, len(forest.sites), len(forest.dcs), len(forest.domains),
+           len(forest.site_links)))
+    sys.stdout.flush()
+
+    for i in range(repeats):
+        phases, usage = run_kcc(samba_kcc, ldif_file,
+                                forest.local_dc['dsa_dn'], workdir, seed)
+        times = {}
+        for p in phases:
+            name = '%s: %s' % (size, p['phase'])
+            times[name] = p['seconds']
+            connections[name] = p['connections']
+        times['%s: total' % size] = usage['elapsed']
+        runs[i]['times'].update(times)
+        runs[i]['cpu'] = runs[i].get('cpu', 0) + usage['cpu']
+        runs[i]['elapsed'] = runs[i].get('elapsed', 0) + usage['elapsed']
+        # the peak of the largest size, not a sum of peaks
+        runs[i]['max_rss'] = max(runs[i].get('max_rss', 0), usage['max_rss'])
+
+
+def report_connections(base, entry, out=None):
+    """Connection counts should be the same on every machine; report the
+    phases where they changed."""
+    if out is None:
+        out = sys.stdout
+    old = base.get('connections', {})
+    new = entry.get('connections', {})
+    changed = 0
+    for name in sorted(set(old) & set(new)):
+        if old[name] != new[name]:
+            print("CONNECTIONS %s: %d -> %d" % (name, old[name], new[name]),
+                  file=out)
+            changed += 1
+    return changed
+
+
+def main():
+    parser = optparse.OptionParser("kcc_bench.py [options]",
+                                   description=__doc__.split('\n\n')[0])
+    parser.add_option("--sizes", default=DEFAULT_SIZES,
+                      help="comma separated forest sizes, as "
+                      "SITESxDCS_PER_SITE[xDOMAINS] [%default]")
+    parser.add_option("--repeats", type=int, default=3,
+                      help="run the KCC this many times per forest")
+    parser.add_option("--seed", type=int, default=1,
+                      help="random seed for the forests and the KCC")
+    parser.add_option("--samba-kcc", default=DEFAULT_SAMBA_KCC,
+                      help="the samba_kcc script [%default]")
+    parser.add_option("--history", default=DEFAULT_HISTORY,
+                      help="JSON file of previous results [%default]")
+    parser.add_option("--label",
+                      help="name for these results [git revision]")
+    parser.add_option("--baseline",
+                      help="compare to the run with this label "
+                      "[the previous run]")
+    parser.add_option("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                      help="ignore differences smaller than this fraction "
+                      "[%default]")
+    parser.add_option("--no-record", action="store_true",
+                      help="don't add these results to the history")
+    parser.add_option("--keep-dir",
+                      help="write the forests and databases here, and "
+                      "leave them behind")
+    opts, args = parser.parse_args()
+
+    if opts.repeats < 1:
+        parser.error("--repeats must be at least 1")
+
+    if opts.keep_dir:
+        os.makedirs(opts.keep_dir, exist_ok=True)
+        workdir = opts.keep_dir
+    else:
+        workdir = tempfile.mkdtemp(prefix='kcc_bench.')
+
+    runs = [{'times': {}} for i in range(opts.repeats)]
+    connections = {}
+    try:
+        history = load_history(opts.history)
+        base = find_baseline(history, opts.baseline)
+        for size in opts.sizes.split(','):
+            bench_size(size.strip(), opts.samba_kcc, opts.repeats,
+                       opts.seed, workdir, runs, connections)
+    except (HistoryError, OSError, ValueError) as e:
+        print("kcc_bench: %s" % e, file=sys.stderr)
+        return 2
+    finally:
+        if not opts.keep_dir:
+            shutil.rmtree(workdir)
+
+    entry = collate_runs(runs)
+    entry['label'] = opts.label or get_revision() or 'unknown'
+    entry['date'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    entry['sizes'] = opts.sizes
+    entry['seed'] = opts.seed
+    entry['connections'] = connections
+
+    if not opts.no_record:
+        history.append(entry)
+        save_history(opts.history, history)
+
+    if base is None:
+        print("kcc_bench: no baseline to compare against")
+        return 0
+
+    if base.get('sizes') != entry['sizes'] or base.get('seed') != opts.seed:
+        print("kcc_bench: warning: the baseline used sizes %s and seed %s" %
+              (base.get('sizes'), base.get('seed')))
+
+    report_connections(base, entry)
+    if report(base, entry, opts.threshold):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+# Repeatable performance benchmarks with a history and baselines
+#
+# Copyright (C) Catalyst IT Ltd. 2026
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Run the performance tests several times and compare them to a baseline.
+
+`make perftest` runs the tests in selftest/perf_tests.py once, and
+format-subunit-json writes the elapsed time of each test into
+st/summary.json. A single timing is too noisy to tell whether a change
+made things slower, so this runs the command --repeats times and keeps
+the minimum, median and spread (max - min) of each test, along with the
+CPU time and peak RSS of each whole run.
+
+The results are appended to a JSON history file, labelled with the git
+revision (or --label), and compared to an earlier entry in the history
+(by default, the previous one). A test has regressed if its minimum time
+is more than --threshold slower than the baseline minimum, and all the
+new samples are slower than all the baseline samples. If any test has
+regressed the exit status is 1.
+
+Existing summary.json files can be given as arguments instead of running
+the command, in which case CPU time and RSS are not known.
+
+Examples:
+
+    selftest/perf_bench.py --repeats=5 --label=before
+    (apply patches, rebuild)
+    selftest/perf_bench.py --repeats=5 --label=after --baseline=before
+"""
+
+import json
+import optparse
+import os
+import subprocess
+import sys
+import time
+
+HISTORY_VERSION = 1
+
+DEFAULT_HISTORY = 'perf-history.json'
+DEFAULT_SUMMARY = os.path.join('st', 'summary.json')
+DEFAULT_COMMAND = 'make perftest'
+DEFAULT_THRESHOLD = 0.05
+
+
+class HistoryError(Exception):
+    pass
+
+
+def summarise(samples):
+    """Reduce a list of numbers to a dictionary of statistics."""
+    samples = sorted(samples)
+    n = len(samples)
+    if n % 2:
+        median = samples[n // 2]
+    else:
+        median = (samples[n // 2 - 1] + samples[n // 2]) / 2.0
+    return {
+        'min': samples[0],
+        'max': samples[-1],
+        'median': median,
+        'spread': samples[-1] - samples[0],
+        'samples': samples,
+    }
+
+
+def read_summary(fn):
+    """Read the {test name: seconds} dictionary that format-subunit-json
+    writes."""
+    with open(fn) as f:
+        return json.load(f)
+
+
+def collate_runs(runs):
+    """Turn a list of runs into a history entry.
+
+    Each run is a dictionary with 'times' ({test: seconds}), and
+    optionally 'cpu' (seconds) and 'max_rss' (KiB). Tests that did not
+    succeed in every run still get an entry, with fewer samples.
+    """
+    times = {}
+    for run in runs:
+        for name, t in run['times'].items():
+            times.setdefault(name, []).append(t)
+
+    entry = {
+        'repeats': len(runs),
+        'tests': dict((k, summarise(v)) for k, v in times.items()),
+    }
+    for k in ('cpu', 'max_rss', 'elapsed'):
+        values = [run[k] for run in runs if run.get(k) is not None]
+        if values:
+            entry[k] = summarise(values)
+    return entry
+
+
+def load_history(fn):
+    """Load the history file, returning a list of entries (oldest first)."""
+    if not os.path.exists(fn):
+        return []
+    with open(fn) as f:
+        history = json.load(f)
+
+    version = history.get('version')
+    if version != HISTORY_VERSION:
+        raise HistoryError("%s is history version %s, but we only understand "
+                           "version %d" % (fn, version, HISTORY_VERSION))
+    return history['runs']
+
+
+def save_history(fn, runs):
+    tmp = fn + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'version': HISTORY_VERSION, 'runs': runs}, f,
+                  sort_keys=True, indent=2, separators=(',', ': '))
+    os.rename(tmp, fn)
+
+
+def find_baseline(runs, label):
+    """Find the most recent history entry with the given label. If label
+    is None, the last entry is the baseline."""
+    if label is None:
+        if runs:
+            return runs[-1]
+        return None
+    for entry in reversed(runs):
+        if entry.get('label') == label:
+            return entry
+    raise HistoryError("no run labelled %r in the history" % label)
+
+
+def is_regression(base, current, threshold):
+    """Is current (a summarise() dict) significantly slower than base?
+
+    The fastest times are compared because they are the least affected
+    by other things happening on the machine. When both sides have more
+    than one sample, we also insist the ranges don't overlap, so a
+    single noisy baseline run doesn't make a regression.
+    """
+    if current['min'] <= base['min'] * (1.0 + threshold):
+        return False
+    if len(base['samples']) > 1 and len(current['samples']) > 1:
+        return current['min'] > base['max']
+    return True
+
+
+def compare(base, current, threshold):
+    """Compare two history entries.
+
+    Returns a list of (test name, base stats, current stats, verdict)
+    tuples, sorted by name, where verdict is one of 'regression',
+    'improvement', 'same', 'new', or 'missing'.
+    """
+    results = []
+    base_tests = base['tests']
+    current_tests = current['tests']
+    for name in sorted(set(base_tests) | set(current_tests)):
+        b = base_tests.get(name)
+        c = current_tests.get(name)
+        if b is None:
+            verdict = 'new'
+        elif c is None:
+            verdict = 'missing'
+        elif is_regression(b, c, threshold):
+            verdict = 'regression'
+        elif is_regression(c, b, threshold):
+            verdict = 'improvement'
+        else:
+            verdict = 'same'
+        results.append((name, b, c, verdict))
+    return results
+
+
+def format_stats(s, unit='s'):
+    if s is None:
+        return '-'
+    return '%.3f%s (median %.3f, spread %.3f, n=%d)' % (s['min'], unit,
+                                                       s['median'],
+                                                       s['spread'],
+                                                       len(s['samples']))
+
+
+def run_command(command, summary):
+    """Run the perf tests once, returning a run dictionary."""
+    if os.path.exists(summary):
+        os.unlink(summary)
+
+    start = time.time()
+    p = subprocess.Popen(command, shell=True)
+    # wait4() gives us the resource usage of the command and all the
+    # descendants it waited for, i.e. the test processes and servers.
+    pid, status, usage = os.wait4(p.pid, 0)
+    elapsed = time.time() - start
+    if os.WIFEXITED(status):
+        returncode = os.WEXITSTATUS(status)
+    else:
+        returncode = -os.WTERMSIG(status)
+    # stop Popen from trying to reap the process again
+    p.returncode = returncode
+
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command)
+
+    if not os.path.exists(summary):
+        raise HistoryError("%r did not write %s" % (command, summary))
+
+    return {
+        'times': read_summary(summary),
+        'cpu': usage.ru_utime + usage.ru_stime,
+        'max_rss': usage.ru_maxrss,
+        'elapsed': elapsed,
+    }
+
+
+def get_revision():
+    try:
+        rev = subprocess.check_output(['git', 'describe', '--always',
+                                       '--dirty'],
+                                      stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return rev.decode().strip()
+
+
+def report(base, entry, threshold, out=None):
+    """Print a comparison, returning the number of regressions."""
+    if out is None:
+        out = sys.stdout
+    print("comparing %s against baseline %s (threshold %.1f%%)" %
+          (entry.get('label'), base.get('label'), threshold * 100), file=out)
+
+    regressions = 0
+    for name, b, c, verdict in compare(base, entry, threshold):
+        if verdict == 'regression':
+            regressions += 1
+        print("%-11s %s" % (verdict.upper(), name), file=out)
+        print("    baseline: %s" % format_stats(b), file=out)
+        print("    current:  %s" % format_stats(c), file=out)
+
+    for k, unit in (('cpu', 's'), ('max_rss', 'KiB')):
+        if k in base or k in entry:
+            print("%s baseline: %s" % (k, format_stats(base.get(k), unit)),
+                  file=out)
+            print("%s current:  %s" % (k, format_stats(entry.get(k), unit)),
+                  file=out)
+
+    print("%d regressions" % regressions, file=out)
+    return regressions
+
+
+def main():
+    parser = optparse.OptionParser("perf_bench.py [options] [SUMMARY.json...]",
+                                   description=__doc__.split('\n\n')[0])
+    parser.add_option("--repeats", type=int, default=5,
+                      help="run the performance tests this many times")
+    parser.add_option("--command", default=DEFAULT_COMMAND,
+                      help="command that runs the tests [%default]")
+    parser.add_option("--summary", default=DEFAULT_SUMMARY,
+                      help="where the command writes its JSON summary "
+                      "[%default]")
+    parser.add_option("--history", default=DEFAULT_HISTORY,
+                      help="JSON file of previous results [%default]")
+    parser.add_option("--label",
+                      help="name for these results [git revision]")
+    parser.add_option("--baseline",
+                      help="compare to the run with this label "
+                      "[the previous run]")
+    parser.add_option("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                      help="ignore differences smaller than this fraction "
+                      "[%default]")
+    parser.add_option("--no-record", action="store_true",
+                      help="don't add these results to the history")
+    opts, args = parser.parse_args()
+
+    if opts.repeats < 1:
+        parser.error("--repeats must be at least 1")
+
+    try:
+        history = load_history(opts.history)
+        base = find_baseline(history, opts.baseline)
+
+        if args:
+            runs = [{'times': read_summary(fn)} for fn in args]
+        else:
+            runs = []
+            for i in range(opts.repeats):
+                print("perf_bench: run %d of %d: %s" % (i + 1, opts.repeats,
+                                                        opts.command))
+                sys.stdout.flush()
+                runs.append(run_command(opts.command, opts.summary))
+    except (HistoryError, subprocess.CalledProcessError, OSError,
+            ValueError) as e:
+        print("perf_bench: %s" % e, file=sys.stderr)
+        return 2
+
+    entry = collate_runs(runs)
+    entry['label'] = opts.label or get_revision() or 'unknown'
+    entry['date'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    if not args:
+        entry['command'] = opts.command
+
+    if not opts.no_record:
+        history.append(entry)
+        save_history(opts.history, history)
+
+    if base is None:
+        print("perf_bench: no baseline to compare against")
+        return 0
+
+    if report(base, entry, opts.threshold):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
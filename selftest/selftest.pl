@@ -57,6 +57,12 @@ my $opt_list = 0;
 my $opt_mitkrb5 = 0;
 my $opt_resetup_env = undef;
 my $opt_load_list = undef;
+my $opt_setup_jobs = $ENV{SELFTEST_SETUP_JOBS} // 0;
+my $opt_env_cache = $ENV{SELFTEST_ENV_CACHE};
+my $opt_env_cache_max_age = $ENV{SELFTEST_ENV_CACHE_MAX_AGE} // 7;
+my $opt_jobs = $ENV{SELFTEST_JOBS} // 1;
+my @opt_concurrent = ();
+my $opt_suite_times = $ENV{SELFTEST_SUITE_TIMES};
 my $opt_libnss_wrapper_so_path = "";
 my $opt_libresolv_wrapper_so_path = "";
 my $opt_libsocket_wrapper_so_path = "";
@@ -71,6 +77,7 @@ my $prefix = "./st";
 
 my @includes = ();
 my @excludes = ();
+my @concurrent = ();
 
 sub find_in_list($$)
 {
@@ -119,6 +126,41 @@ sub expand_environment_strings($)
 
 my $target;
 
+# The wall clock and CPU times of testsuites, in seconds, from this run
+# and from the --suite-times file of earlier runs.
+my %new_suite_times = ();
+my %suite_times = ();
+
+sub read_suite_times($)
+{
+	my ($filename) = @_;
+	my %ret = ();
+
+	open(my $fh, "<", $filename) or return %ret;
+	while (<$fh>) {
+		chomp;
+		my ($wall, $cpu, $name) = split(/\t/, $_, 3);
+		next unless defined($name);
+		$ret{$name} = [$wall, $cpu];
+	}
+	close($fh);
+	return %ret;
+}
+
+sub write_suite_times($$)
+{
+	my ($filename, $times) = @_;
+
+	my $tmpfile = "$filename.tmp.$$";
+	open(my $fh, ">", $tmpfile) or return;
+	foreach my $name (sort keys %{$times}) {
+		my ($wall, $cpu) = @{$times->{$name}};
+		printf $fh "%.3f\t%.3f\t%s\n", $wall, $cpu, $name;
+	}
+	close($fh);
+	rename($tmpfile, $filename);
+}
+
 sub run_testsuite($$$$$)
 {
 	my ($envname, $name, $cmd, $i, $totalsuites) = @_;
@@ -127,7 +169,13 @@ sub run_testsuite($$$$$)
 	Subunit::start_testsuite($name);
 	Subunit::progress_push();
 	Subunit::report_time();
+	my $start = time();
+	my @start_cpu = times();
 	system($cmd);
+	my @end_cpu = times();
+	$new_suite_times{$name} = [time() - $start,
+				   $end_cpu[2] + $end_cpu[3] -
+				   $start_cpu[2] - $start_cpu[3]];
 	Subunit::report_time();
 	Subunit::progress_pop();
 
@@ -189,6 +237,9 @@ Generic options:
  --include=FILE             Include tests listed in the file
  --exclude-env=ENV          Exclude tests for the specified environment
  --include-env=ENV          Include tests for the specified environment
+ --concurrent=FILE          Testsuites listed in the file leave their
+                            environment unchanged, so they may run at the
+                            same time as each other
 
 Paths:
  --prefix=DIR               prefix to run tests in [st]
@@ -216,6 +267,16 @@ Behaviour:
  --quick                    run quick overall test
  --one                      abort when the first test fails
  --testenv                  run a shell in the requested test environment
+ --jobs=N                   run up to N --concurrent testsuites at once
+ --suite-times=FILE         record the time each testsuite takes in FILE,
+                            and run the slowest concurrent testsuites first
+ --setup-jobs=N             provision up to N test environments at once,
+                            ahead of the tests that need them
+ --env-cache=DIR            keep snapshots of the provisioned test
+                            environments in DIR, and restore them rather
+                            than provisioning again while the source tree
+                            and the build are unchanged
+ --env-cache-max-age=DAYS   remove snapshots older than DAYS [7]
  --list                     list available tests
 ";
 	exit(0);
@@ -243,6 +304,12 @@ my $result = GetOptions (
 		'testlist=s' => \@testlists,
 		'random-order' => \$opt_random_order,
 		'load-list=s' => \$opt_load_list,
+		'jobs=i' => \$opt_jobs,
+		'concurrent=s' => \@opt_concurrent,
+		'suite-times=s' => \$opt_suite_times,
+		'setup-jobs=i' => \$opt_setup_jobs,
+		'env-cache=s' => \$opt_env_cache,
+		'env-cache-max-age=f' => \$opt_env_cache_max_age,
 		'nss_wrapper_so_path=s' => \$opt_libnss_wrapper_so_path,
 		'resolv_wrapper_so_path=s' => \$opt_libresolv_wrapper_so_path,
 		'socket_wrapper_so_path=s' => \$opt_libsocket_wrapper_so_path,
@@ -451,6 +518,10 @@ if (defined($ENV{SMBD_MAXTIME}) and $ENV{SMBD_MAXTIME} ne "") {
 $target = new Samba($bindir, $srcdir, $server_maxtime,
 		    $opt_socket_wrapper_pcap,
 		    $opt_socket_wrapper_keep_pcap);
+if (defined($opt_env_cache) and $opt_env_cache ne "") {
+	$target->set_env_cache(abs_path($opt_env_cache) // $opt_env_cache,
+			       $opt_env_cache_max_age);
+}
 unless ($opt_list) {
 	if ($opt_target eq "samba") {
 		$testenv_default = "ad_dc";
@@ -486,6 +557,10 @@ foreach (@opt_include) {
 	push (@includes, read_test_regexes($_));
 }
 
+foreach (@opt_concurrent) {
+	push (@concurrent, read_test_regexes($_));
+}
+
 # We give the selftest client 6 different IPv4 addresses to use. Most tests
 # only use the first (.11) IP. Note that winsreplication.c is one test that
 # uses the other IPs (search for iface_list_count()).
@@ -754,6 +829,7 @@ my $i = 0;
 $| = 1;
 
 my %running_envs = ();
+my %running_suites = ();
 
 sub get_running_env($)
 {
@@ -776,6 +852,8 @@ sub sighandler($)
 	open(STDOUT, ">&STDERR") or die "can't dup STDOUT to STDERR: $!";
 
 	print "$0: PID[$$]: Got SIG${signame} teardown environments.\n";
+	kill("TERM", map { -$_ } keys %running_suites);
+	$target->stop_prepared_envs();
 	teardown_env($_) foreach(keys %running_envs);
 	system("pstree -p $$");
 	print "$0: PID[$$]: Exiting...\n";
@@ -784,6 +862,22 @@ sub sighandler($)
 
 $SIG{INT} = $SIG{QUIT} = $SIG{TERM} = $SIG{PIPE} = \&sighandler;
 
+sub reset_env_for_setup($)
+{
+	my ($envname) = @_;
+
+	# Initially clear out the environment for the provision, so previous envs'
+	# variables don't leak in. Provisioning steps must explicitly set their
+	# necessary variables when calling out to other executables
+	Samba::clear_exported_envvars();
+	delete $ENV{SOCKET_WRAPPER_DEFAULT_IFACE};
+	delete $ENV{SMB_CONF_PATH};
+
+	$ENV{RESOLV_CONF} = "${selftest_resolv_conf_path}.${envname}/ignore";
+	$ENV{KRB5CCNAME} = "FILE:${selftest_krbt_ccache_path}.${envname}/ignore";
+	$ENV{GNUPGHOME} = "${selftest_gnupghome_path}.${envname}/ignore";
+}
+
 sub setup_env($$)
 {
 	my ($name, $prefix) = @_;
@@ -799,16 +893,7 @@ sub setup_env($$)
 
 	$option = "client" if $option eq "";
 
-	# Initially clear out the environment for the provision, so previous envs'
-	# variables don't leak in. Provisioning steps must explicitly set their
-	# necessary variables when calling out to other executables
-	Samba::clear_exported_envvars();
-	delete $ENV{SOCKET_WRAPPER_DEFAULT_IFACE};
-	delete $ENV{SMB_CONF_PATH};
-
-	$ENV{RESOLV_CONF} = "${selftest_resolv_conf_path}.${envname}/ignore";
-	$ENV{KRB5CCNAME} = "FILE:${selftest_krbt_ccache_path}.${envname}/ignore";
-	$ENV{GNUPGHOME} = "${selftest_gnupghome_path}.${envname}/ignore";
+	reset_env_for_setup($envname);
 
 	if (defined(get_running_env($envname))) {
 		$testenv_vars = get_running_env($envname);
@@ -883,6 +968,172 @@ sub teardown_env($)
 	delete $running_envs{$envname};
 }
 
+# Report the testsuite as failed if its environment couldn't be set up
+sub check_testsuite_env($$$)
+{
+	my ($name, $envname, $envvars) = @_;
+
+	if (not defined($envvars)) {
+		Subunit::start_testsuite($name);
+		Subunit::end_testsuite($name, "error",
+			"unable to set up environment $envname - exiting");
+		return 0;
+	} elsif ($envvars eq "UNKNOWN") {
+		Subunit::start_testsuite($name);
+		Subunit::end_testsuite($name, "error",
+			"environment $envname is unknown - exiting");
+		return 0;
+	}
+	return 1;
+}
+
+sub testsuite_cmd($)
+{
+	my ($testsuite) = @_;
+	my $name = $$testsuite[0];
+	my $cmd = $$testsuite[2];
+
+	# Generate a file with the individual tests to run, if the 
+	# test runner for this test suite supports it.
+	if ($individual_tests and $individual_tests->{$name}) {
+		if ($$testsuite[3]) {
+			my ($fh, $listid_file) = tempfile(UNLINK => 0);
+			foreach my $test (@{$individual_tests->{$name}}) {
+				print $fh substr($test, length($name)+1) . "\n";
+			}
+			$cmd =~ s/\$LOADLIST/--load-list=$listid_file/g;
+		} else {
+			warn("Unable to run individual tests in $name, it does not support --loadlist.");
+		}
+	}
+
+	return $cmd;
+}
+
+# Run the testsuites, which can share their environment, in up to
+# $opt_jobs child processes at once. Each child writes the subunit
+# stream of its testsuite to a file, which is copied to our stdout when
+# it finishes, so the streams aren't interleaved.
+sub run_testsuite_pool($$)
+{
+	my ($envname, $testsuites) = @_;
+	my @pending = @{$testsuites};
+
+	while (@pending or %running_suites) {
+		while (@pending and scalar(keys %running_suites) < $opt_jobs) {
+			my $testsuite = shift(@pending);
+			my $name = $$testsuite[0];
+			my $cmd = testsuite_cmd($testsuite);
+			$i++;
+
+			my ($fh, $outfile) = tempfile(DIR => $tmpdir_abs, UNLINK => 0);
+			my $pid = fork();
+			die("Unable to fork: $!") unless defined($pid);
+
+			if ($pid == 0) {
+				$SIG{INT} = $SIG{QUIT} = $SIG{TERM} = $SIG{PIPE} = 'DEFAULT';
+				# so the whole testsuite pipeline can be killed
+				setpgrp(0, 0);
+				open(STDOUT, ">&", $fh) or die("Unable to write to $outfile: $!");
+				$| = 1;
+				# kinit in concurrent testsuites mustn't clobber each other
+				$ENV{KRB5CCNAME} .= ".$$";
+
+				my $exitcode = run_testsuite($envname, $name, $cmd, $i,
+							     $suitestotal);
+				if (open(my $times, ">", "$outfile.times")) {
+					print $times join(" ", @{$new_suite_times{$name}}) . "\n";
+					close($times);
+				}
+				POSIX::_exit($exitcode == 0 ? 0 : 1);
+			}
+			# also here, in case we kill it before it gets there
+			setpgrp($pid, $pid);
+			close($fh);
+			$running_suites{$pid} = [$name, $outfile];
+		}
+
+		# only our testsuites: the servers are our children too
+		my $finished = 0;
+		foreach my $pid (keys %running_suites) {
+			next if (waitpid($pid, WNOHANG) == 0);
+			my $exitcode = $?;
+			my ($name, $outfile) = @{delete($running_suites{$pid})};
+			$finished++;
+
+			if (open(my $out, "<", $outfile)) {
+				local $/ = undef;
+				print <$out>;
+				close($out);
+			}
+			if (open(my $times, "<", "$outfile.times")) {
+				my $line = <$times>;
+				close($times);
+				if (defined($line)) {
+					chomp($line);
+					$new_suite_times{$name} = [split(/ /, $line)];
+				}
+			}
+			unlink($outfile, "$outfile.times");
+
+			if ($exitcode != 0 and $opt_one) {
+				kill("TERM", map { -$_ } keys %running_suites);
+				exit(1);
+			}
+		}
+		select(undef, undef, undef, 0.1) unless ($finished);
+	}
+}
+
+# The expected wall clock time of a testsuite, from earlier runs. We
+# know nothing about new testsuites, so they might take the longest.
+sub expected_suite_time($)
+{
+	my ($name) = @_;
+
+	return 9**9**9 unless defined($suite_times{$name});
+	return $suite_times{$name}->[0];
+}
+
+# Run the testsuites in order. The testsuites that may change their
+# environment run one at a time, as usual, while each run of consecutive
+# testsuites listed by --concurrent for the same environment runs in
+# parallel, the slowest first.
+sub run_testsuites_concurrently($)
+{
+	my ($todo) = @_;
+	my @pending = @{$todo};
+
+	while (@pending) {
+		my $testsuite = shift(@pending);
+		my $name = $$testsuite[0];
+		my $envname = $$testsuite[1];
+		my $envvars = setup_env($envname, $prefix);
+
+		if (not check_testsuite_env($name, $envname, $envvars)) {
+			$i++;
+			next;
+		}
+
+		if (not defined(find_in_list(\@concurrent, $name))) {
+			$i++;
+			run_testsuite($envname, $name, testsuite_cmd($testsuite), $i,
+				      $suitestotal);
+			next;
+		}
+
+		my @shared = ($testsuite);
+		while (@pending and $pending[0][1] eq $envname and
+		       defined(find_in_list(\@concurrent, $pending[0][0]))) {
+			push(@shared, shift(@pending));
+		}
+		@shared = sort {
+			expected_suite_time($$b[0]) <=> expected_suite_time($$a[0])
+		} @shared;
+		run_testsuite_pool($envname, \@shared);
+	}
+}
+
 # This 'global' file needs to be empty when we start
 unlink("$prefix_abs/dns_host_file");
 unlink("$prefix_abs/hosts");
@@ -964,47 +1215,41 @@ $envvarstr
 		}
 	}
 } else {
-	foreach (@todo) {
-		$i++;
-		my $cmd = $$_[2];
-		my $name = $$_[0];
-		my $envname = $$_[1];
-		my $envvars = setup_env($envname, $prefix);
+	my @envnames = map { my $envname = $$_[1]; $envname =~ s/:.*//; $envname } @todo;
+	$target->prepare_envs(\@envnames, $prefix, $opt_setup_jobs,
+			      \&reset_env_for_setup);
 
-		if (not defined($envvars)) {
-			Subunit::start_testsuite($name);
-			Subunit::end_testsuite($name, "error",
-				"unable to set up environment $envname - exiting");
-			next;
-		} elsif ($envvars eq "UNKNOWN") {
-			Subunit::start_testsuite($name);
-			Subunit::end_testsuite($name, "error",
-				"environment $envname is unknown - exiting");
-			next;
-		}
+	if (defined($opt_suite_times)) {
+		%suite_times = read_suite_times($opt_suite_times);
+	}
 
-		# Generate a file with the individual tests to run, if the 
-		# test runner for this test suite supports it.
-		if ($individual_tests and $individual_tests->{$name}) {
-			if ($$_[3]) {
-				my ($fh, $listid_file) = tempfile(UNLINK => 0);
-				foreach my $test (@{$individual_tests->{$name}}) {
-					print $fh substr($test, length($name)+1) . "\n";
-				}
-				$cmd =~ s/\$LOADLIST/--load-list=$listid_file/g;
-			} else {
-				warn("Unable to run individual tests in $name, it does not support --loadlist.");
-			}
-		}
+	if ($opt_jobs > 1 and not $opt_resetup_env) {
+		run_testsuites_concurrently(\@todo);
+	} else {
+		foreach my $testsuite (@todo) {
+			$i++;
+			my $name = $$testsuite[0];
+			my $envname = $$testsuite[1];
+			my $envvars = setup_env($envname, $prefix);
+
+			next unless (check_testsuite_env($name, $envname, $envvars));
 
-		run_testsuite($envname, $name, $cmd, $i, $suitestotal);
+			run_testsuite($envname, $name, testsuite_cmd($testsuite), $i,
+				      $suitestotal);
+
+			teardown_env($envname) if ($opt_resetup_env);
+		}
+	}
 
-		teardown_env($envname) if ($opt_resetup_env);
+	if (defined($opt_suite_times)) {
+		write_suite_times($opt_suite_times,
+				  { %suite_times, %new_suite_times });
 	}
 }
 
 print "\n";
 
+$target->stop_prepared_envs();
 teardown_env($_) foreach (keys %running_envs);
 
 my $failed = 0;
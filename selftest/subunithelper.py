@@ -235,8 +235,161 @@ class SubunitOps(TestProtocolClient, TestsuiteEnabledTestResult):
         self._stream.write(msg)
 
 
+# Characters that end the literal prefix of a regular expression.
+_REGEX_SPECIAL = set('.^$*+?{}[]|()')
+# A literal character followed by one of these is optional or repeated,
+# so it can't be part of the prefix.
+_REGEX_QUANTIFIERS = set('*+?{')
+# Escapes that stand for themselves.
+_REGEX_LITERAL_ESCAPES = set('.^$*+?{}[]|()\\/-_:# ')
+
+
+def _regex_literal_prefix(regex):
+    """Find the literal string that any match of the regex (using
+    re.match) must start with. This may be conservatively short,
+    possibly empty, but is never wrong."""
+    if '|' in regex or regex.startswith('(?'):
+        # a top-level alternation could start with anything, and
+        # we don't want to think too hard about where the '|' is.
+        return ''
+    i = 0
+    if regex.startswith('^'):
+        i = 1
+    prefix = []
+    while i < len(regex):
+        c = regex[i]
+        if c == '\\':
+            if i + 1 >= len(regex) or regex[i + 1] not in _REGEX_LITERAL_ESCAPES:
+                break
+            c = regex[i + 1]
+            width = 2
+        elif c in _REGEX_SPECIAL:
+            break
+        else:
+            width = 1
+        if regex[i + width:i + width + 1] in _REGEX_QUANTIFIERS:
+            break
+        prefix.append(c)
+        i += width
+    return ''.join(prefix)
+
+
+class TestRegexes(dict):
+    """A mapping of regular expressions to reasons, as read from the
+    knownfail, flapping and skip files, that can quickly find the
+    first regex that matches a test name.
+
+    Rather than trying every regex in turn, the regexes are grouped
+    by the first few characters of their literal prefixes, and each
+    group is combined into one big alternation. Python's re module
+    tries alternatives in order, so the first alternative to match is
+    the first regex in the original order to match.
+    """
+
+    # how many characters of literal prefix we index on
+    KEY_LENGTH = 8
+
+    def __init__(self, *args, **kwargs):
+        super(TestRegexes, self).__init__(*args, **kwargs)
+        self._compiled = None
+
+    def __setitem__(self, key, value):
+        self._compiled = None
+        super(TestRegexes, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._compiled = None
+        super(TestRegexes, self).__delitem__(key)
+
+    def update(self, *args, **kwargs):
+        self._compiled = None
+        super(TestRegexes, self).update(*args, **kwargs)
+
+    def setdefault(self, key, default=None):
+        self._compiled = None
+        return super(TestRegexes, self).setdefault(key, default)
+
+    def pop(self, *args):
+        self._compiled = None
+        return super(TestRegexes, self).pop(*args)
+
+    def popitem(self):
+        self._compiled = None
+        return super(TestRegexes, self).popitem()
+
+    def clear(self):
+        self._compiled = None
+        super(TestRegexes, self).clear()
+
+    def _combine(self, indexed):
+        """Make a single regex out of a list of (index, regex) pairs.
+        The index of the matching regex is found in match.lastgroup,
+        as the outer group is the last to close."""
+        alternatives = ['(?P<r%d>%s)' % (i, r) for i, r in indexed]
+        return re.compile('|'.join(alternatives))
+
+    def _compile(self):
+        regexes = list(self.keys())
+        buckets = {}
+        unindexed = []
+        loners = []
+        for i, regex in enumerate(regexes):
+            # Regexes with back-references or named groups can't be
+            # combined without renumbering, and those with flags
+            # don't like not being at the start.
+            if re.search(r'\\[1-9]|\(\?P|\(\?[aiLmsux]', regex):
+                loners.append((i, re.compile(regex)))
+                continue
+            prefix = _regex_literal_prefix(regex)
+            if len(prefix) < self.KEY_LENGTH:
+                unindexed.append((i, regex))
+            else:
+                key = prefix[:self.KEY_LENGTH]
+                buckets.setdefault(key, []).append((i, regex))
+
+        combined = dict((k, self._combine(v)) for k, v in buckets.items())
+        if unindexed:
+            unindexed = self._combine(unindexed)
+        else:
+            unindexed = None
+        reasons = [self[r] for r in regexes]
+        self._compiled = (combined, unindexed, loners, reasons)
+
+    def find(self, fullname):
+        """Return the reason given for the first regex matching
+        fullname, "" if it has no reason, or None if no regex matches.
+        """
+        if self._compiled is None:
+            self._compile()
+        combined, unindexed, loners, reasons = self._compiled
+
+        best = None
+        for pattern in (combined.get(fullname[:self.KEY_LENGTH]),
+                        unindexed):
+            if pattern is None:
+                continue
+            m = pattern.match(fullname)
+            if m is not None:
+                i = int(m.lastgroup[1:])
+                if best is None or i < best:
+                    best = i
+        for i, pattern in loners:
+            if best is not None and i > best:
+                break
+            if pattern.match(fullname):
+                best = i
+                break
+
+        if best is None:
+            return None
+        reason = reasons[best]
+        if reason is None:
+            return ""
+        return reason
+
+
 def read_test_regexes(*names):
-    ret = {}
+    ret = TestRegexes()
     files = []
     for name in names:
         # if we are given a directory, we read all the files it contains
@@ -264,6 +417,8 @@ def read_test_regexes(*names):
 
 
 def find_in_list(regexes, fullname):
+    if isinstance(regexes, TestRegexes):
+        return regexes.find(fullname)
     for regex, reason in regexes.items():
         if re.match(regex, fullname):
             if reason is None:
@@ -436,13 +591,13 @@ class FilterOps(unittest.TestResult):
         self.prefix = prefix
         self.suffix = suffix
         if expected_failures is not None:
-            self.expected_failures = expected_failures
+            self.expected_failures = TestRegexes(expected_failures)
         else:
-            self.expected_failures = {}
+            self.expected_failures = TestRegexes()
         if flapping is not None:
-            self.flapping = flapping
+            self.flapping = TestRegexes(flapping)
         else:
-            self.flapping = {}
+            self.flapping = TestRegexes()
         self.strip_ok_output = strip_ok_output
         self.xfail_added = 0
         self.fail_added = 0
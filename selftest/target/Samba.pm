@@ -11,7 +11,10 @@ use target::Samba3;
 use target::Samba4;
 use POSIX;
 use Cwd qw(abs_path);
+use IO::Handle;
 use IO::Poll qw(POLLIN);
+use Digest::SHA;
+use File::Find;
 
 sub new($$$$$) {
 	my ($classname, $bindir, $srcdir, $server_maxtime,
@@ -47,6 +50,9 @@ foreach my $env (keys %Samba3::ENV_DEPS) {
     $ENV_NEEDS_AD_DC{$env} = ($env =~ /^ad_/);
 }
 
+%Samba::ENV_PROVISION_DEPS = (%Samba4::ENV_PROVISION_DEPS);
+our %ENV_PROVISION_DEPS;
+
 sub setup_pcap($$)
 {
 	my ($self, $name) = @_;
@@ -76,6 +82,17 @@ sub cleanup_pcap($$$)
 	unlink($pcap_file);
 }
 
+sub get_target($$)
+{
+	my ($self, $envname) = @_;
+
+	my %targetlookup = (
+		"Samba3" => $self->{samba3},
+		"Samba4" => $self->{samba4}
+	);
+	return $targetlookup{$ENV_TARGETS{$envname}};
+}
+
 sub setup_env($$$)
 {
 	my ($self, $envname, $path) = @_;
@@ -86,11 +103,7 @@ sub setup_env($$$)
 		return "UNKNOWN";
 	}
 
-	my %targetlookup = (
-		"Samba3" => $self->{samba3},
-		"Samba4" => $self->{samba4}
-	);
-	my $target = $targetlookup{$targetname};
+	my $target = $self->get_target($envname);
 
 	if (defined($target->{vars}->{$envname})) {
 		return $target->{vars}->{$envname};
@@ -143,6 +156,316 @@ sub setup_env($$$)
 	return $env;
 }
 
+# Use snapshots of provisioned testenvs in this directory, rather than
+# provisioning them again, while the source tree and the build are
+# unchanged. Snapshots older than $max_age days are removed.
+sub set_env_cache($$$)
+{
+	my ($self, $cache_dir, $max_age) = @_;
+
+	$self->{env_cache} = $cache_dir;
+	$self->expire_env_cache($max_age);
+}
+
+sub expire_env_cache($$)
+{
+	my ($self, $max_age) = @_;
+
+	opendir(my $dh, $self->{env_cache}) or return;
+	my @snapshots = grep { /\.tar$/ } readdir($dh);
+	closedir($dh);
+	foreach my $name (@snapshots) {
+		my $snapshot = "$self->{env_cache}/$name";
+		if (-f $snapshot and -M $snapshot > $max_age) {
+			unlink($snapshot);
+		}
+	}
+}
+
+# A hash of the source tree (the git HEAD plus any local changes,
+# including untracked files that are not ignored), or undef if it isn't
+# a git checkout.
+sub source_hash($)
+{
+	my ($self) = @_;
+
+	return $self->{source_hash} if exists($self->{source_hash});
+	$self->{source_hash} = undef;
+
+	my $srcdir = $self->{samba4}->{srcdir};
+	my $head = `git -C "$srcdir" rev-parse HEAD 2>/dev/null`;
+	return undef unless ($? == 0 and $head ne "");
+
+	my $sha = Digest::SHA->new(1);
+	$sha->add($head);
+	open(my $diff, "-|", "git", "-C", $srcdir, "diff", "--binary", "HEAD")
+		or return undef;
+	$sha->addfile($diff);
+	close($diff) or return undef;
+
+	open(my $untracked, "-|", "git", "-C", $srcdir, "ls-files",
+	     "--others", "--exclude-standard", "-z")
+		or return undef;
+	my @untracked = do { local $/ = "\0"; my @names = <$untracked>;
+			     chomp(@names); @names };
+	close($untracked) or return undef;
+	foreach my $name (sort @untracked) {
+		my $path = "$srcdir/$name";
+		$sha->add("$name\0");
+		if (-l $path) {
+			$sha->add(readlink($path));
+		} elsif (-f $path and -r $path) {
+			$sha->addfile($path);
+		}
+	}
+
+	$self->{source_hash} = $sha->hexdigest();
+	return $self->{source_hash};
+}
+
+# A hash of the build (the configuration, including the configure
+# options, and the size and modification time of the programs, libraries
+# and python modules it built), or undef if there is no build in the
+# binaries directory.
+sub build_hash($)
+{
+	my ($self) = @_;
+
+	return $self->{build_hash} if exists($self->{build_hash});
+	$self->{build_hash} = undef;
+
+	my $bindir = $self->{samba4}->{bindir};
+	return undef unless (-d "$bindir/c4che");
+
+	my @files = ();
+	my @dirs = ();
+	opendir(my $dh, $bindir) or return undef;
+	foreach my $name (readdir($dh)) {
+		next if ($name eq "." or $name eq "..");
+		if (-f "$bindir/$name" and -x "$bindir/$name") {
+			push(@files, "$bindir/$name");
+		} elsif ($name =~ /^(c4che|shared|modules|python)$/) {
+			push(@dirs, "$bindir/$name");
+		}
+	}
+	closedir($dh);
+	find({ wanted => sub { push(@files, $File::Find::name) if (-f $_) },
+	       follow => 1, follow_skip => 2 }, @dirs);
+
+	my $sha = Digest::SHA->new(1);
+	foreach my $path (sort @files) {
+		$sha->add(substr($path, length($bindir)) . "\0");
+		if ($path =~ m{^\Q$bindir\E/c4che/}) {
+			$sha->addfile($path);
+		} else {
+			my @st = stat($path);
+			$sha->add("$st[7] $st[9]\0");
+		}
+	}
+
+	$self->{build_hash} = $sha->hexdigest();
+	return $self->{build_hash};
+}
+
+sub add_env_with_deps
+{
+	my ($envname, $seen, $ordered) = @_;
+
+	return if ($seen->{$envname});
+	$seen->{$envname} = 1;
+
+	foreach (@{$ENV_DEPS{$envname} // []}, @{$ENV_DEPS_POST{$envname} // []}) {
+		add_env_with_deps($_, $seen, $ordered);
+	}
+	push(@{$ordered}, $envname);
+}
+
+# Provision the testenvs in @$envnames, and those they depend on, ahead
+# of setting them up.
+#
+# The testenvs in %ENV_PROVISION_DEPS are provisioned in the background,
+# by up to $jobs worker processes at once, in the order the tests will
+# need them; the testenvs they need while provisioning are set up first.
+# setup_env() then starts each of them from the provisioned files (see
+# wait_provisioned()), waiting for its worker if need be. The testenvs
+# that join another DC are provisioned by setup_env() as usual, once
+# that DC is running.
+#
+# $reset_env is called with the testenv name in each worker, to clear
+# out the environment variables of the parent.
+sub prepare_envs($$$$$)
+{
+	my ($self, $envnames, $path, $jobs, $reset_env) = @_;
+
+	my %seen = ();
+	my @ordered = ();
+	foreach (@{$envnames}) {
+		add_env_with_deps($_, \%seen, \@ordered);
+	}
+	my @queue = grep { defined($ENV_PROVISION_DEPS{$_}) } @ordered;
+	return if ($jobs < 1 or $#queue == -1);
+
+	my %needed = map { $_ => 1 } map { @{$ENV_PROVISION_DEPS{$_}} } @queue;
+	foreach my $envname (sort keys %needed) {
+		&$reset_env($envname);
+		my $vars = $self->setup_env($envname, $path);
+		if (not defined($vars) or $vars eq "UNKNOWN") {
+			warn("Failed setting up $envname, not provisioning ahead");
+			return;
+		}
+	}
+
+	# once, rather than in every worker
+	if (defined($self->{env_cache})) {
+		$self->source_hash();
+		$self->build_hash();
+	}
+
+	my ($reader, $writer);
+	pipe($reader, $writer) or die("Unable to create pipe: $!");
+	my $pid = fork();
+	die("Unable to fork: $!") unless defined($pid);
+
+	if ($pid == 0) {
+		close($reader);
+		# not the parent's handlers, which tear down its testenvs
+		$SIG{INT} = $SIG{QUIT} = $SIG{TERM} = $SIG{PIPE} = 'DEFAULT';
+		# so stop_prepared_envs() can stop the workers too
+		setpgrp(0, 0);
+		$writer->autoflush(1);
+		$self->run_provision_workers(\@queue, $path, $jobs, $reset_env,
+					     $writer);
+		POSIX::_exit(0);
+	}
+
+	close($writer);
+	$self->{provision_pid} = $pid;
+	$self->{provision_reader} = $reader;
+	$self->{provisioning} = { map { ("$path/$_" => undef) } @queue };
+}
+
+sub run_provision_workers($$$$$$)
+{
+	my ($self, $queue, $path, $jobs, $reset_env, $writer) = @_;
+	my @pending = @{$queue};
+	my %running = ();
+
+	while (@pending or %running) {
+		while (@pending and scalar(keys %running) < $jobs) {
+			my $envname = shift(@pending);
+			my $pid = fork();
+			if (not defined($pid)) {
+				print $writer "failed $path/$envname\n";
+				next;
+			}
+			if ($pid == 0) {
+				close($writer);
+				my $ret = $self->provision_env_only($envname, $path,
+								    $reset_env);
+				POSIX::_exit($ret);
+			}
+			$running{$pid} = $envname;
+		}
+
+		my $pid = waitpid(-1, 0);
+		last if ($pid <= 0);
+		my $envname = delete($running{$pid});
+		next unless defined($envname);
+
+		my %statuses = (0 => "ok", 2 => "unknown");
+		my $status = $statuses{$? >> 8} // "failed";
+		$status = "failed" if ($? & 127);
+		print $writer "$status $path/$envname\n";
+	}
+}
+
+# Runs in a worker process of prepare_envs(): the setup of the testenv
+# stops once Samba4::provisioned_env() returns "PROVISIONED", before the
+# server is started.
+sub provision_env_only($$$$)
+{
+	my ($self, $envname, $path, $reset_env) = @_;
+	my $envdir = "$path/$envname";
+
+	open(STDOUT, ">", "$envdir.provision.log") or return 1;
+	open(STDERR, ">&STDOUT") or return 1;
+	STDOUT->autoflush(1);
+
+	&$reset_env($envname);
+	$ENV{ENVNAME} = $envname;
+	$ENV{KRB5_CONFIG} = "$path/no_krb5.conf";
+	$ENV{RESOLV_CONF} = "$path/no_resolv.conf";
+
+	$self->{provision_only} = 1;
+
+	my $setup_name = $ENV_TARGETS{$envname}."::setup_".$envname;
+	my $setup_sub = \&$setup_name;
+	my $env = eval { &$setup_sub($self->get_target($envname), $envdir) };
+	if ($@) {
+		print "Provisioning $envname failed: $@";
+		return 1;
+	}
+	if (defined($env) and $env eq "PROVISIONED") {
+		return 0;
+	}
+	if (defined($env) and $env eq "UNKNOWN") {
+		return 2;
+	}
+	print "Provisioning $envname failed\n";
+	return 1;
+}
+
+# Whether prepare_envs() provisioned the testenv in $envdir, waiting for
+# it if it is still being provisioned. Each provisioned testenv is only
+# handed out once, so setting it up again provisions it again.
+sub wait_provisioned($$)
+{
+	my ($self, $envdir) = @_;
+	my $provisioning = $self->{provisioning};
+
+	return 0 unless (defined($provisioning) and
+			 exists($provisioning->{$envdir}));
+
+	my $reader = $self->{provision_reader};
+	while (not defined($provisioning->{$envdir})) {
+		my $line = <$reader>;
+		if (not defined($line)) {
+			# the workers are gone
+			foreach (keys %{$provisioning}) {
+				$provisioning->{$_} //= "failed";
+			}
+			last;
+		}
+		chomp($line);
+		my ($status, $dir) = split(/ /, $line, 2);
+		$provisioning->{$dir} = $status;
+	}
+
+	my $status = delete($provisioning->{$envdir});
+	if ($status eq "failed") {
+		warn("Provisioning $envdir ahead failed, trying again");
+		if (open(my $log, "<", "$envdir.provision.log")) {
+			print STDERR <$log>;
+			close($log);
+		}
+	}
+	return $status eq "ok";
+}
+
+sub stop_prepared_envs($)
+{
+	my ($self) = @_;
+
+	my $pid = delete($self->{provision_pid});
+	return unless defined($pid);
+
+	kill("TERM", -$pid);
+	waitpid($pid, 0);
+	close($self->{provision_reader});
+	delete($self->{provision_reader});
+	delete($self->{provisioning});
+}
+
 sub bindir_path($$) {
 	my ($object, $path) = @_;
 
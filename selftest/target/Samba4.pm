@@ -17,6 +17,11 @@ use SocketWrapper;
 use target::Samba;
 use target::Samba3;
 use Archive::Tar;
+use Digest::SHA;
+use Fcntl qw(:flock);
+use File::Basename;
+use File::Spec;
+use Storable qw(nstore retrieve);
 
 sub new($$$$$) {
 	my ($classname, $SambaCtx, $bindir, $srcdir, $server_maxtime) = @_;
@@ -721,6 +726,25 @@ sub has_option
 	return exists $options_dict{$keyword};
 }
 
+# Add a DC to the nss_wrapper hosts file shared by all the testenvs
+sub append_nsswrap_hosts($$$$$)
+{
+	my ($hosts_file, $hostname, $dnsname, $ipv4, $ipv6) = @_;
+
+	$hostname = lc($hostname);
+	my $names = "${hostname}.${dnsname} ${hostname}";
+	if ($hostname eq "localdc") {
+		$names = "${hostname}.${dnsname} ${dnsname} ${hostname}";
+	}
+
+	open(my $hosts, ">>", $hosts_file) or return;
+	# testenvs may be provisioned concurrently
+	flock($hosts, LOCK_EX);
+	print $hosts "$ipv4 $names\n";
+	print $hosts "$ipv6 $names\n";
+	close($hosts);
+}
+
 #
 # Step1 creates the basic configuration
 #
@@ -858,16 +882,8 @@ nogroup:x:65534:nobody
 	close(GRP);
         my $gid_rfc2307test = 65532;
 
-	my $hostname = lc($ctx->{hostname});
-	open(HOSTS, ">>$ctx->{nsswrap_hosts}");
-	if ($hostname eq "localdc") {
-		print HOSTS "$ctx->{ipv4} ${hostname}.$ctx->{dnsname} $ctx->{dnsname} ${hostname}\n";
-		print HOSTS "$ctx->{ipv6} ${hostname}.$ctx->{dnsname} $ctx->{dnsname} ${hostname}\n";
-	} else {
-		print HOSTS "$ctx->{ipv4} ${hostname}.$ctx->{dnsname} ${hostname}\n";
-		print HOSTS "$ctx->{ipv6} ${hostname}.$ctx->{dnsname} ${hostname}\n";
-	}
-	close(HOSTS);
+	append_nsswrap_hosts($ctx->{nsswrap_hosts}, $ctx->{hostname},
+			     $ctx->{dnsname}, $ctx->{ipv4}, $ctx->{ipv6});
 
 	my $configuration = "--configfile=$ctx->{smb_conf}";
 
@@ -2277,6 +2293,173 @@ sub check_env($$)
 	schema_dc => ["schema_pair_dc"],
 );
 
+# The testenvs that can be provisioned ahead of being set up (see
+# Samba::prepare_envs()), and the testenvs that have to be running while
+# they are provisioned. The others join an existing DC, so they can only
+# be provisioned once their ENV_DEPS are running.
+%Samba4::ENV_PROVISION_DEPS = (
+	ad_dc_ntvfs          => ["dns_hub"],
+	ad_dc_fips           => ["dns_hub"],
+	ad_dc                => ["dns_hub"],
+	ad_dc_smb1           => ["dns_hub"],
+	ad_dc_no_nss         => ["dns_hub"],
+	ad_dc_no_ntlm        => ["dns_hub"],
+
+	fl2008r2dc           => ["dns_hub"],
+	fl2003dc             => ["dns_hub"],
+	fl2000dc             => ["dns_hub"],
+	fl2008dc             => ["dns_hub"],
+
+	chgdcpass            => ["dns_hub"],
+	proclimitdc          => ["dns_hub"],
+	preforkrestartdc     => ["dns_hub"],
+	backupfromdc         => ["dns_hub"],
+	schema_dc            => ["dns_hub"],
+);
+
+# The testenv variables of a provisioned testenv are kept in this file
+# in its directory
+my $env_snapshot_vars = "selftest_env_vars.storable";
+
+# A name for the snapshot of a testenv in the cache, which changes with
+# the source tree, the build and the settings the provision depends on.
+sub env_snapshot_key($$)
+{
+	my ($self, $path) = @_;
+
+	my $source_hash = $self->{SambaCtx}->source_hash();
+	return undef unless defined($source_hash);
+	my $build_hash = $self->{SambaCtx}->build_hash();
+	return undef unless defined($build_hash);
+
+	my $sha = Digest::SHA->new(1);
+	$sha->add($source_hash);
+	$sha->add($build_hash);
+	$sha->add(File::Spec->rel2abs($path));
+	foreach my $var (qw(MITKRB5 PYTHON SAMBA_DNS_FAKING
+			    SELFTEST_DONT_REQUIRE_TDB_MUTEX_SUPPORT)) {
+		$sha->add("$var=" . ($ENV{$var} // ""));
+	}
+	return $sha->hexdigest();
+}
+
+sub env_snapshot_file($$)
+{
+	my ($self, $path) = @_;
+
+	my $cache_dir = $self->{SambaCtx}->{env_cache};
+	return undef unless defined($cache_dir);
+
+	my $key = $self->env_snapshot_key($path);
+	return undef unless defined($key);
+
+	return "$cache_dir/" . basename($path) . "-$key.tar";
+}
+
+sub load_env_snapshot($$)
+{
+	my ($self, $path) = @_;
+
+	my $env = eval { retrieve("$path/$env_snapshot_vars") };
+	unless (defined($env)) {
+		warn("Unable to load the testenv variables of $path");
+	}
+	return $env;
+}
+
+# Keep the testenv variables with the provisioned testenv, and add a
+# snapshot of the testenv to the cache, if there is one.
+sub save_env_snapshot($$$)
+{
+	my ($self, $path, $env) = @_;
+
+	unless (nstore($env, "$path/$env_snapshot_vars")) {
+		warn("Unable to save the testenv variables of $path");
+		return;
+	}
+
+	my $snapshot = $self->env_snapshot_file($path);
+	return unless defined($snapshot);
+
+	unless (-d $self->{SambaCtx}->{env_cache} or
+		mkdir($self->{SambaCtx}->{env_cache}, 0777)) {
+		return;
+	}
+
+	# several runs may share the cache
+	my $tmp = "$snapshot.tmp.$$";
+	if (system("tar", "-C", $path, "-cf", $tmp, ".") == 0) {
+		rename($tmp, $snapshot);
+	} else {
+		warn("Unable to save a snapshot of $path in $snapshot");
+		unlink($tmp);
+	}
+}
+
+# Restore a testenv from its snapshot in the cache, if there is one.
+sub restore_env_snapshot($$)
+{
+	my ($self, $path) = @_;
+
+	my $snapshot = $self->env_snapshot_file($path);
+	return undef unless (defined($snapshot) and -f $snapshot);
+
+	unless(-d $path or mkdir($path, 0777)) {
+		warn("Unable to create $path");
+		return undef;
+	}
+	my $path_abs = abs_path($path);
+	die ("path='/'") if $path_abs eq "/";
+
+	unless (system("rm -rf $path_abs/*") == 0 and
+		system("tar", "-C", $path_abs, "-xf", $snapshot) == 0) {
+		warn("Unable to restore $path from $snapshot");
+		return undef;
+	}
+
+	my $env = $self->load_env_snapshot($path);
+	return undef unless defined($env);
+
+	# the shared hosts file was recreated for this run
+	append_nsswrap_hosts($env->{NSS_WRAPPER_HOSTS}, $env->{SERVER},
+			     $env->{DNSNAME}, $env->{SERVER_IP},
+			     $env->{SERVER_IPV6});
+
+	print "Restored $path from $snapshot\n";
+	return $env;
+}
+
+# Provision a testenv with $provision, unless Samba::prepare_envs() has
+# already provisioned it, or it can be restored from the cache.
+#
+# In a prepare_envs() worker this returns "PROVISIONED" rather than the
+# testenv variables, and the setup stops there, before the server is
+# started.
+sub provisioned_env($$$)
+{
+	my ($self, $path, $provision) = @_;
+	my $env = undef;
+
+	if ($self->{SambaCtx}->wait_provisioned($path)) {
+		$env = $self->load_env_snapshot($path);
+		return $env if defined($env);
+	}
+
+	$env = $self->restore_env_snapshot($path);
+	if (not defined($env)) {
+		$env = &$provision();
+		return undef unless defined($env);
+		$self->save_env_snapshot($path, $env);
+	}
+
+	# in a prepare_envs() worker, this is as far as the setup goes
+	if ($self->{SambaCtx}->{provision_only}) {
+		return "PROVISIONED";
+	}
+
+	return $env;
+}
+
 sub return_alias_env
 {
 	my ($self, $path, $env) = @_;
@@ -2290,7 +2473,10 @@ sub setup_fl2008dc
 	my ($self, $path) = @_;
 
 	my $extra_args = ["--base-schema=2008_R2"];
-	my $env = $self->provision_ad_dc_ntvfs($path, $extra_args);
+	my $env = $self->provisioned_env($path, sub {
+		return $self->provision_ad_dc_ntvfs($path, $extra_args);
+	});
+	return $env if (defined($env) and $env eq "PROVISIONED");
 	if (defined $env) {
 	        if (not defined($self->check_or_start($env, "standard"))) {
 		    warn("Failed to start fl2008dc");
@@ -2379,7 +2565,10 @@ sub setup_ad_dc_ntvfs
 {
 	my ($self, $path) = @_;
 
-	my $env = $self->provision_ad_dc_ntvfs($path, undef);
+	my $env = $self->provisioned_env($path, sub {
+		return $self->provision_ad_dc_ntvfs($path, undef);
+	});
+	return $env if (defined($env) and $env eq "PROVISIONED");
 	if (defined $env) {
 	        if (not defined($self->check_or_start($env, "standard"))) {
 		    warn("Failed to start ad_dc_ntvfs");
@@ -2393,7 +2582,10 @@ sub setup_chgdcpass
 {
 	my ($self, $path) = @_;
 
-	my $env = $self->provision_chgdcpass($path);
+	my $env = $self->provisioned_env($path, sub {
+		return $self->provision_chgdcpass($path);
+	});
+	return $env if (defined($env) and $env eq "PROVISIONED");
 	if (defined $env) {
 	        if (not defined($self->check_or_start($env, "standard"))) {
 		        return undef;
@@ -2406,7 +2598,10 @@ sub setup_fl2000dc
 {
 	my ($self, $path, $dc_vars) = @_;
 
-	my $env = $self->provision_fl2000dc($path);
+	my $env = $self->provisioned_env($path, sub {
+		return $self->provision_fl2000dc($path);
+	});
+	return $env if (defined($env) and $env eq "PROVISIONED");
 	if (defined $env) {
 	        if (not defined($self->check_or_start($env, "standard"))) {
 		        return undef;
@@ -2422,7 +2617,10 @@ sub setup_fl2003dc
 {
 	my ($self, $path, $dc_vars) = @_;
 
-	my $env = $self->provision_fl2003dc($path);
+	my $env = $self->provisioned_env($path, sub {
+		return $self->provision_fl2003dc($path);
+	});
+	return $env if (defined($env) and $env eq "PROVISIONED");
 
 	if (defined $env) {
 	        if (not defined($self->check_or_start($env, "standard"))) {
@@ -2438,7 +2636,10 @@ sub setup_fl2008r2dc
 {
 	my ($self, $path, $dc_vars) = @_;
 
-	my $env = $self->provision_fl2008r2dc($path);
+	my $env = $self->provisioned_env($path, sub {
+		return $self->provision_fl2008r2dc($path);
+	});
+	return $env if (defined($env) and $env eq "PROVISIONED");
 
 	if (defined $env) {
 	        if (not defined($self->check_or_start($env, "standard"))) {
@@ -2619,11 +2820,14 @@ sub _setup_ad_dc
 	if (!defined($dom)) {
 		$dom = "addom.samba.example.com";
 	}
-	my $env = $self->provision_ad_dc($path, $server, "ADDOMAIN",
-					 $dom,
-					 undef,
-					 $conf_opts,
-					 undef);
+	my $env = $self->provisioned_env($path, sub {
+		return $self->provision_ad_dc($path, $server, "ADDOMAIN",
+					      $dom,
+					      undef,
+					      $conf_opts,
+					      undef);
+	});
+	return $env if (defined($env) and $env eq "PROVISIONED");
 	unless ($env) {
 		return undef;
 	}
@@ -2674,13 +2878,16 @@ sub setup_ad_dc_no_nss
 	       return "UNKNOWN";
 	}
 
-	my $env = $self->provision_ad_dc($path,
-					 "addc_no_nss",
-					 "ADNONSSDOMAIN",
-					 "adnonssdom.samba.example.com",
-					 undef,
-					 "",
-					 undef);
+	my $env = $self->provisioned_env($path, sub {
+		return $self->provision_ad_dc($path,
+					      "addc_no_nss",
+					      "ADNONSSDOMAIN",
+					      "adnonssdom.samba.example.com",
+					      undef,
+					      "",
+					      undef);
+	});
+	return $env if (defined($env) and $env eq "PROVISIONED");
 	unless ($env) {
 		return undef;
 	}
@@ -2711,13 +2918,16 @@ sub setup_ad_dc_no_ntlm
 	       return "UNKNOWN";
 	}
 
-	my $env = $self->provision_ad_dc($path,
-					 "addc_no_ntlm",
-					 "ADNONTLMDOMAIN",
-					 "adnontlmdom.samba.example.com",
-					 undef,
-					 "ntlm auth = disabled",
-					 undef);
+	my $env = $self->provisioned_env($path, sub {
+		return $self->provision_ad_dc($path,
+					      "addc_no_ntlm",
+					      "ADNONTLMDOMAIN",
+					      "adnontlmdom.samba.example.com",
+					      undef,
+					      "ntlm auth = disabled",
+					      undef);
+	});
+	return $env if (defined($env) and $env eq "PROVISIONED");
 	unless ($env) {
 		return undef;
 	}
@@ -2745,13 +2955,16 @@ sub setup_ad_dc_fips
 	       return "UNKNOWN";
 	}
 
-	my $env = $self->provision_ad_dc($path,
-					 "fipsdc",
-					 "FIPSDOMAIN",
-					 "fips.samba.example.com",
-					 1,
-					 "",
-					 undef);
+	my $env = $self->provisioned_env($path, sub {
+		return $self->provision_ad_dc($path,
+					      "fipsdc",
+					      "FIPSDOMAIN",
+					      "fips.samba.example.com",
+					      1,
+					      "",
+					      undef);
+	});
+	return $env if (defined($env) and $env eq "PROVISIONED");
 	unless ($env) {
 		return undef;
 	}
@@ -2784,13 +2997,16 @@ sub setup_preforkrestartdc
 
 	# note DC name must be <= 15 chars so we use 'prockill' instead of
 	# 'preforkrestart'
-	my $env = $self->provision_ad_dc($path,
-					 "prockilldc",
-					 "PROCKILLDOMAIN",
-					 "prockilldom.samba.example.com",
-					 undef,
-					 "prefork backoff increment = 5\nprefork maximum backoff=10",
-					 undef);
+	my $env = $self->provisioned_env($path, sub {
+		return $self->provision_ad_dc($path,
+					      "prockilldc",
+					      "PROCKILLDOMAIN",
+					      "prockilldom.samba.example.com",
+					      undef,
+					      "prefork backoff increment = 5\nprefork maximum backoff=10",
+					      undef);
+	});
+	return $env if (defined($env) and $env eq "PROVISIONED");
 	unless ($env) {
 		return undef;
 	}
@@ -2830,13 +3046,16 @@ sub setup_proclimitdc
 	       return "UNKNOWN";
 	}
 
-	my $env = $self->provision_ad_dc($path,
-					 "proclimitdc",
-					 "PROCLIMITDOM",
-					 "proclimit.samba.example.com",
-					 undef,
-					 "max smbd processes = 20",
-					 undef);
+	my $env = $self->provisioned_env($path, sub {
+		return $self->provision_ad_dc($path,
+					      "proclimitdc",
+					      "PROCLIMITDOM",
+					      "proclimit.samba.example.com",
+					      undef,
+					      "max smbd processes = 20",
+					      undef);
+	});
+	return $env if (defined($env) and $env eq "PROVISIONED");
 	unless ($env) {
 		return undef;
 	}
@@ -2866,13 +3085,16 @@ sub setup_schema_dc
 	# provision the PDC using an older base schema
 	my $provision_args = ["--base-schema=2008_R2", "--backend-store=mdb"];
 
-	my $env = $self->provision_ad_dc($path,
-					 "liveupgrade1dc",
-					 "SCHEMADOMAIN",
-					 "schema.samba.example.com",
-					 undef,
-					 "drs: max link sync = 2",
-					 $provision_args);
+	my $env = $self->provisioned_env($path, sub {
+		return $self->provision_ad_dc($path,
+					      "liveupgrade1dc",
+					      "SCHEMADOMAIN",
+					      "schema.samba.example.com",
+					      undef,
+					      "drs: max link sync = 2",
+					      $provision_args);
+	});
+	return $env if (defined($env) and $env eq "PROVISIONED");
 	unless ($env) {
 		return undef;
 	}
@@ -2965,13 +3187,16 @@ sub setup_backupfromdc
 
 	my $provision_args = ["--site=Backup-Site"];
 
-	my $env = $self->provision_ad_dc($path,
-					 "backupfromdc",
-					 "BACKUPDOMAIN",
-					 "backupdom.samba.example.com",
-					 undef,
-					 "samba kcc command = /bin/true",
-					 $provision_args);
+	my $env = $self->provisioned_env($path, sub {
+		return $self->provision_ad_dc($path,
+					      "backupfromdc",
+					      "BACKUPDOMAIN",
+					      "backupdom.samba.example.com",
+					      undef,
+					      "samba kcc command = /bin/true",
+					      $provision_args);
+	});
+	return $env if (defined($env) and $env eq "PROVISIONED");
 	unless ($env) {
 		return undef;
 	}
@@ -89,6 +89,11 @@ planpythontestsuite("none", "samba.tests.s3windb")
 planpythontestsuite("none", "samba.tests.s3idmapdb")
 planpythontestsuite("none", "samba.tests.samba3sam")
 planpythontestsuite("none", "samba.tests.dsdb_api")
+planpythontestsuite("none", "samba.tests.subunithelper_regexes",
+                    extra_path=[os.path.join(samba4srcdir, "..", "selftest")])
+planpythontestsuite("none", "samba.tests.perf_bench",
+                    extra_path=[os.path.join(samba4srcdir, "..", "selftest")])
+planpythontestsuite("none", "samba.tests.selftest_env_cache")
 planpythontestsuite(
     "none", "wafsamba.tests.test_suite",
     extra_path=[os.path.join(samba4srcdir, "..", "buildtools"),
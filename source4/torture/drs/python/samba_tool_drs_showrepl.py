@@ -158,6 +158,38 @@ class SambaToolDrsShowReplTests(drs_base.DrsBaseTestCase):
             self.assertTrue(isinstance(n['replicates NC'], list))
             self.assertRegexpMatches(n["remote DN"], "^%s$" % DN_RE)
 
+    def test_samba_tool_showrepl_all_dcs_json(self):
+        """Tests 'samba-tool drs showrepl --all-dcs --json' command.
+        """
+        out = self.check_output("samba-tool drs showrepl %s %s "
+                                "--all-dcs --json --jobs=2" %
+                                (self.dc1, self.cmdline_creds))
+        d = json.loads(get_string(out))
+        self.assertEqual(set(d), set(['time', 'servers']))
+
+        single = json.loads(get_string(self.check_output(
+            "samba-tool drs showrepl %s %s --json" %
+            (self.dc1, self.cmdline_creds))))
+        guids = {}
+        for name, server in d['servers'].items():
+            self.assertRegexpMatches(name, r'^[\w-]+\\\w+$')
+            if 'error' in server:
+                continue
+            self.assertEqual(set(server), set(['dsa', 'repsFrom', 'repsTo']))
+            for k in ["objectGUID", "invocationId"]:
+                self.assertRegexpMatches(server['dsa'][k], '^%s$' % GUID_RE)
+            guids[server['dsa']['objectGUID']] = server
+
+        # DC1 is in there, with the same neighbours as plain showrepl
+        self.assertIn(single['dsa']['objectGUID'], guids)
+        server = guids[single['dsa']['objectGUID']]
+        for reps in ('repsFrom', 'repsTo'):
+            self.assertEqual(
+                sorted((r['NC dn'], r['DSA objectGUID'], r['is deleted'])
+                       for r in server[reps]),
+                sorted((r['NC dn'], r['DSA objectGUID'], r['is deleted'])
+                       for r in single[reps]))
+
     def _force_all_reps(self, samdb, dc, direction):
         if direction == 'inbound':
             info_type = drsuapi.DRSUAPI_DS_REPLICA_INFO_NEIGHBORS
@@ -33,6 +33,14 @@ ldapcmp_result() {
     $SAMBA_TOOL ldapcmp $DB1_PATH $DB2_PATH --filter=interSiteTopologyGenerator
 }
 
+ldapcmp_result_fast() {
+    DB1_PATH="tdb://$PREFIX_ABS/$SERVER/private/sam.ldb"
+    DB2_PATH="tdb://$TARGET_DIR/private/sam.ldb"
+
+    $SAMBA_TOOL ldapcmp $DB1_PATH $DB2_PATH --filter=interSiteTopologyGenerator \
+        --fast --page-size=100
+}
+
 cleanup_output_dir
 
 # check that we can join this DC
@@ -41,6 +49,9 @@ testit "check_dc_join" join_dc
 # check resulting DB matches server DC
 testit "new_db_matches" ldapcmp_result
 
+# and again, comparing hashes first
+testit "new_db_matches_fast" ldapcmp_result_fast
+
 testit "demote_joined_dc" demote_joined_dc
 
 cleanup_output_dir